@@ -7,31 +7,56 @@ __maintainer__ = "Julius Pinsker"
 __email__ = "pinsker@uni-bremen.de"
 __status__ = "fully functional"
 
+import logging
+import multiprocessing
+import os
 import sys
 import time
 import qdarkstyle
-from PyQt5 import QtCore, QtGui, QtWidgets, QtTest
+from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog
 from PyQt5.QtWidgets import QWidget, QLabel, QComboBox, QGridLayout, QPushButton, QMessageBox, QApplication, QInputDialog, QLineEdit, QDialog
 import asyncio
-from serial import Serial
+from array import array
+from itertools import islice
 from typing import Iterator, Tuple
 from serial.tools.list_ports import comports
 from PyQt5.QtCore import QSettings
 from PyQt5.QtGui import QCloseEvent, QColor
 from quamash import QEventLoop
+from checkpoint import Checkpoint, routine_hash
+from axis import Axis, AxisRegistry, Link
+from conex import CONNECT_TIMEOUT, POSITION_TOLERANCE, SETTLE_TIMEOUT, ConexError, Reply, state_name, wait_ready
+from engine import ProgressBus, RoutineEngine, RoutineListener
+from grid import Grid, parse_mask
+from scan import LineScanner, grid_lines, write_crossings
+from motion import MotionModel, calibrate, dump_axis, load_axis, stage_id
+from optimize import optimize_order
+from routine import (BINARY_SUFFIX, DELAY, END, LOOP, MOVE, NO_POSITION, CompiledRoutine, MappedRoutine, RoutineFormatError,
+                     RoutineStore, Step, from_nm, is_binary_routine, mm_text, position_text, read_text_header, read_text_routine,
+                     to_nm, write_binary_routine, write_text_routine)
 
 
+log = logging.getLogger(__name__)
 
-# Object to access the serial port
-x_axis = Serial(timeout=0)
-y_axis = Serial(timeout=0)
+
+# Addresses of daisy chained controllers sharing one serial port, e.g. {'x': 1, 'y': 2}.
+# Select the same port for all of them. Axes not listed here have a port of their own.
+CHAINED_AXES = {}
+
+# Stage axes, each with its serial port, controller and reader, and the position (in mm) it starts at.
+# Another axis (e.g. 'z' focus) is one more entry here.
+chain = Link('chain') if CHAINED_AXES else None
+axes = AxisRegistry([Axis(name, home=home, link=chain if name in CHAINED_AXES else None, address=CHAINED_AXES.get(name))
+                     for name, home in (('x', 23.868719), ('y', 24.194633))])
 
 #Definition of Constants
 SER_BAUDRATE = 921600
 SETTING_PORT_X_NAME = 'port_x_name'
 SETTING_PORT_Y_NAME = 'port_y_name'
 SETTING_MESSAGE = 'message'
+#Motion model of a stage, by the stage identification the controller replies to ID?
+SETTING_MOTION = 'motion/%s'
 
 
 #Step Sizes (Closed Loop Usage)
@@ -46,10 +71,36 @@ SLOW = 500
 FAST = 4000
 FASTEST = 10000
 
-#Timeout between movements to positions (in s)
+#t stored with saved positions (in s), only a placeholder: the engine plans moves with MOVE_TIME
+#or the motion model and a move is done once the axes settled, not after this time
 BUFFER = 1.5
 #Translation to milliseconds
 BUFFER = BUFFER * 1000
+
+#File types offered when saving and opening routines
+ROUTINE_FILTER = "ACI routine (*.aci *.txt);;ACI binary routine (*%s);;All files (*)" %BINARY_SUFFIX
+
+#File types offered when saving the result of a continuous scan
+SCAN_FILTER = "CSV (*.csv);;All files (*)"
+#Distance (in mm) the fast axis runs before the first and after the last site of a scanned row
+SCAN_RUN_UP = 0.05
+#Grids with more sites than this are only generated or scanned after asking
+GRID_CONFIRM_SITES = 1000000
+
+#Number of routine elements added to the list at once while loading a file
+LOAD_BATCH = 10000
+
+#Progress of the running routine is kept here to resume it after a crash
+CHECKPOINT_FILE = 'checkpoint'
+#Longest time to wait for homing after connecting or before resuming (in s)
+HOME_TIMEOUT = 120
+#Time between state polls while homing (in s)
+HOME_INTERVAL = 0.1
+
+#Jog commands are dropped when this many commands still wait to be written to the axis
+JOG_DEPTH = 1
+#Axis jogged by the movement directions, 1 and 3 jog backwards, 2 and 4 forwards
+JOG_AXES = {1: 'x', 2: 'x', 3: 'y', 4: 'y'}
 ###############################################################
 ########################GUI CODE###############################
 ###############################################################
@@ -73,71 +124,343 @@ class InfIter:
 pos_num = iter(InfIter())
 element_num = iter(InfIter())
 
+#Background colour of finished list elements, alternating between repetitions
+def done_color(repetition: int) -> str:
+    if repetition % 2:
+        return "#19232d"
+    return "#00558d"
+
 #Return all available serial ports.
 def gen_serial_ports() -> Iterator[Tuple[str, str]]:
     ports = comports()
     return ((p.description, p.device) for p in ports)
 
-#Send a message to the X-Axis(async).
-def write_x(msg: str) -> None:
-    if x_axis.is_open:
-        x_axis.write(msg.encode())
-        print('We Say to x - axis : %s' %msg)
-            
-#Send a message to the Y-Axis(async).
-def write_y(msg: str) -> None:
-    if y_axis.is_open:
-        y_axis.write(msg.encode())
-        print('We Say to y - axis : %s' %msg)
+#Return the port selected in combo, a typed in device (e.g. an emulator pty from emulator.py)
+#is used as it is.
+def combo_port(combo) -> str:
+    text = combo.currentText()
+    if combo.currentIndex() < 0 or combo.itemText(combo.currentIndex()) != text:
+        return text
+    return combo.currentData() or text
+
     
             
+#Flags of PositionHandler.valid
+VALID_X = 0x1
+VALID_Y = 0x2
+
 class PositionHandler(object):
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
+    """Last position read back from both axes in nm, valid flags the axes that have one."""
+
+    def __init__(self):
+        self.x = NO_POSITION
+        self.y = NO_POSITION
+        self.valid = 0
         
-    def set_x(self,x):
+    def set_x(self, x: int):
         self.x = x
+        self.valid = self.valid | VALID_X if x != NO_POSITION else self.valid & ~VALID_X
         
-    def set_y(self,y):
+    def set_y(self, y: int):
         self.y = y
+        self.valid = self.valid | VALID_Y if y != NO_POSITION else self.valid & ~VALID_Y
+
+    def clear(self):
+        self.set_x(NO_POSITION)
+        self.set_y(NO_POSITION)
         
     def saveable(self):
-        if "NA" in self.x or "NA" in self.y:
-            return False
-        else:
-            return True
+        return self.valid == VALID_X | VALID_Y
         
-    def get_x(self) -> str:
+    def get_x(self) -> int:
         return self.x
         
-    def get_y(self) -> str:
+    def get_y(self) -> int:
         return self.y 
         
     
 
-class PositionItem(QtWidgets.QListWidgetItem):
-    def __init__(self, *args, x, y, t, **kwargs):
-        super().__init__(*args, **kwargs)
-        # optional `value` member, passed in as `value=...`, stored in data(Qt.UserRole)
-        # this is a common thing to want, cf. `QComboBox.itemData()`
-        if x is not None:
-            self.x = x
-
-        if y is not None:
-            self.y = y
-  
-        if t is not None:
-            self.t = t
-            
-    def get_x(self):
-        return self.x
-    
-    def get_y(self):
-        return self.y
-    
-    def get_t(self):
-        return self.t
+#Icons of the step kinds, created once and shared by all rows
+step_icons = {}
+
+def step_icon(kind: int) -> QtGui.QIcon:
+    icon = step_icons.get(kind)
+    if icon is None:
+        icon = QtGui.QIcon()
+        if kind == DELAY:
+            icon.addPixmap(QtGui.QPixmap("media/clock.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        elif kind == LOOP:
+            icon.addPixmap(QtGui.QPixmap("media/arrow_down.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        elif kind == END:
+            icon.addPixmap(QtGui.QPixmap("media/arrow_up.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        else:
+            icon.addPixmap(QtGui.QPixmap("media/waypoint.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
+        step_icons[kind] = icon
+    return icon
+
+
+class RoutineModel(QtCore.QAbstractListModel):
+    """List model of the routine steps over a compact RoutineStore.
+
+    The step being run is a single index (current), RoutineDelegate derives the
+    running/done highlight of every row from it, so moving on to the next
+    step only touches two rows.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.store = RoutineStore()
+        self.current = -1
+        self.repetition = 0
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        if parent.isValid():
+            return 0
+        return len(self.store)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == QtCore.Qt.DisplayRole or role == QtCore.Qt.EditRole:
+            return self.store.names[index.row()]
+        if role == QtCore.Qt.DecorationRole:
+            return step_icon(self.store.kind[index.row()])
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole) -> bool:
+        if role != QtCore.Qt.EditRole or not index.isValid() or not value:
+            return False
+        self.store.rename(index.row(), value)
+        self.dataChanged.emit(index, index)
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return QtCore.Qt.ItemIsDropEnabled
+        flags = QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsDragEnabled
+        if self.store.kind[index.row()] == MOVE:
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def supportedDropActions(self):
+        return QtCore.Qt.MoveAction
+
+    def moveRows(self, sourceParent, sourceRow, count, destinationParent, destinationChild) -> bool:
+        if sourceParent.isValid() or destinationParent.isValid():
+            return False
+        if not self.beginMoveRows(QtCore.QModelIndex(), sourceRow, sourceRow + count - 1, QtCore.QModelIndex(), destinationChild):
+            return False
+        self.store.move(sourceRow, count, destinationChild)
+        self.endMoveRows()
+        return True
+
+    def removeRows(self, row, count, parent=QtCore.QModelIndex()) -> bool:
+        if parent.isValid() or count <= 0 or row < 0 or row + count > len(self.store):
+            return False
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row + count - 1)
+        self.store.remove(row, count)
+        self.endRemoveRows()
+        return True
+
+    #Append steps at the end of the list in one go
+    def append_steps(self, steps) -> None:
+        steps = list(steps)
+        if not steps:
+            return
+        first = len(self.store)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(steps) - 1)
+        self.store.extend(steps)
+        self.endInsertRows()
+
+    #Append routine columns (names, kind, x, y, t) at once
+    def append_columns(self, names, kind, x, y, t) -> None:
+        if not len(kind):
+            return
+        first = len(self.store)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(kind) - 1)
+        self.store.extend_columns(names, kind, x, y, t)
+        self.endInsertRows()
+
+    #Insert steps in front of row
+    def insert_steps(self, row: int, steps) -> None:
+        steps = list(steps)
+        if not steps:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), row, row + len(steps) - 1)
+        self.store.insert(row, steps)
+        self.endInsertRows()
+
+    #Show the steps of a mapped binary routine file instead of the current ones, they are not copied
+    def use_mapped(self, routine: MappedRoutine) -> None:
+        self.beginResetModel()
+        self.store.use_mapped(routine)
+        self.current = -1
+        self.endResetModel()
+
+    def clear(self) -> None:
+        self.beginResetModel()
+        self.store.clear()
+        self.current = -1
+        self.endResetModel()
+
+    #Rearrange the rows, row i becomes the row at order[i]
+    def reorder(self, order) -> None:
+        self.beginResetModel()
+        self.store.reorder(order)
+        self.endResetModel()
+
+    def step(self, row: int) -> Step:
+        return self.store[row]
+
+    #Background colour of a row, None if it is not highlighted
+    def highlight(self, row: int):
+        if self.current < 0:
+            return None
+        if row == self.current:
+            return "#e78200"
+        if row < self.current:
+            return done_color(self.repetition)
+        if self.repetition > 0:
+            return done_color(self.repetition - 1)
+        return None
+
+    #Mark row as running in repetition, -1 removes all highlights
+    def set_current(self, repetition: int, row: int) -> None:
+        previous = self.current
+        self.current = row
+        self.repetition = repetition
+        if not len(self.store):
+            return
+        if row < 0 or previous < 0:
+            self.dataChanged.emit(self.index(0), self.index(len(self.store) - 1))
+        elif row < previous:
+            #jumped back to the start of a loop, the rows in between are not done anymore
+            self.dataChanged.emit(self.index(row), self.index(previous))
+        else:
+            self.dataChanged.emit(self.index(previous), self.index(previous))
+            self.dataChanged.emit(self.index(row), self.index(row))
+
+
+class RoutineDelegate(QtWidgets.QStyledItemDelegate):
+    """Paints the running/done highlight RoutineModel gives each row."""
+
+    brushes = {}
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        color = index.model().highlight(index.row())
+        if color is not None:
+            brush = RoutineDelegate.brushes.get(color)
+            if brush is None:
+                brush = RoutineDelegate.brushes[color] = QtGui.QBrush(QColor(color))
+            option.backgroundBrush = brush
+
+
+
+class GridDialog(QDialog):
+    """Asks for the corners, size and order of a grid of sites, for a scan also for the scan velocity."""
+
+    def __init__(self, parent=None, scan=False):
+        super().__init__(parent)
+        self.setWindowTitle("Continuous Scan" if scan else "Generate Grid")
+        layout = QtWidgets.QFormLayout(self)
+        self.corners = []
+        for label in ("First site", "Last site of first row", "Last site of first column"):
+            row = QtWidgets.QHBoxLayout()
+            boxes = []
+            for axis in "xy":
+                box = QtWidgets.QDoubleSpinBox(self)
+                box.setDecimals(6)
+                box.setRange(0, 48)
+                box.setSuffix(" mm")
+                box.setPrefix("%s: " %axis)
+                row.addWidget(box)
+                boxes.append(box)
+            current = QPushButton("Current", self)
+            current.setStatusTip("Use the current position of the stages")
+            current.setEnabled(any(name in axes and axes[name].is_open for name in "xy"))
+            current.clicked.connect(lambda checked, boxes=boxes: loop.create_task(self.use_position(boxes)))
+            row.addWidget(current)
+            layout.addRow(label, row)
+            self.corners.append(boxes)
+        self.columns = QtWidgets.QSpinBox(self)
+        self.columns.setRange(1, 100000)
+        layout.addRow("Columns", self.columns)
+        self.rows = QtWidgets.QSpinBox(self)
+        self.rows.setRange(1, 100000)
+        layout.addRow("Rows", self.rows)
+        self.serpentine = QtWidgets.QCheckBox("Serpentine (every other row backwards)", self)
+        self.serpentine.setChecked(True)
+        layout.addRow(self.serpentine)
+        self.dwell = QtWidgets.QDoubleSpinBox(self)
+        self.dwell.setRange(0, 86400)
+        self.dwell.setSuffix(" s")
+        self.velocity = QtWidgets.QDoubleSpinBox(self)
+        self.velocity.setDecimals(4)
+        self.velocity.setRange(0.0001, 10)
+        self.velocity.setValue(0.1)
+        self.velocity.setSuffix(" mm/s")
+        if scan:
+            self.dwell.setVisible(False)
+            layout.addRow("Velocity of the x axis", self.velocity)
+        else:
+            self.velocity.setVisible(False)
+            layout.addRow("Delay at every site", self.dwell)
+        self.mask = QLineEdit(self)
+        self.mask.setPlaceholderText("column,row; column,row")
+        layout.addRow("Skipped sites", self.mask)
+        buttons = QtWidgets.QDialogButtonBox(QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel, parent=self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    #Ask the connected axes where they are and put it into boxes
+    async def use_position(self, boxes):
+        for box, name in zip(boxes, "xy"):
+            if name not in axes or not axes[name].is_open:
+                continue
+            try:
+                reply = await axes[name].control.query('TP')
+            except ConexError as e:
+                self.parent().messagebar(str(e))
+                continue
+            position = to_nm(reply.value)
+            if position != NO_POSITION:
+                box.setValue(from_nm(position))
+
+    #Closes the dialog, for a very large grid only once that is confirmed
+    def accept(self):
+        sites = self.columns.value() * self.rows.value()
+        if sites > GRID_CONFIRM_SITES:
+            answer = QMessageBox.question(self, self.windowTitle(),
+                                          "The grid has %s sites, this takes a lot of memory and time. Continue?" %sites)
+            if answer != QMessageBox.Yes:
+                return
+        super().accept()
+
+    #Grid described by the dialog
+    def grid(self) -> Grid:
+        origin, column_end, row_end = (tuple(box.value() for box in boxes) for boxes in self.corners)
+        return Grid.from_corners(origin, column_end, row_end, self.columns.value(), self.rows.value())
+
+
+class RoutineProgress(RoutineListener):
+    """Forwards the coalesced progress of the routine engine to the main window."""
+
+    def __init__(self, ui):
+        self.ui = ui
+
+    def routine_started(self, routine):
+        self.ui.routine_started(routine)
+
+    def progress(self, snapshot):
+        self.ui.show_progress(snapshot)
+
+    def routine_finished(self, completed):
+        self.ui.routine_finished(completed)
+
+    def message(self, text):
+        self.ui.messagebar(text)
 
 
             
@@ -151,7 +474,7 @@ class Ui_MainWindow(QWidget):
     #Data-structure to store Coordinates and Delays
     point_list = []
 
-    position = PositionHandler(x = 'NA', y = 'NA')
+    position = PositionHandler()
     
     #unit of delay spinbox
     seconds = True
@@ -165,6 +488,25 @@ class Ui_MainWindow(QWidget):
     
     def setup_ui(self, MainWindow):
      
+        #Runs the routines, reports progress back to this window
+        data = QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.AppDataLocation)
+        self.checkpoint = Checkpoint(os.path.join(data, CHECKPOINT_FILE))
+        #Checkpoint record and whether to home first, once the user chose to resume an interrupted routine
+        self.resume = None
+        #Progress reaches the window as snapshots at a bounded rate, drawing never holds up the engine
+        self.progress_bus = ProgressBus(RoutineProgress(self))
+        self.routine_engine = RoutineEngine(axes.controls(), listener=self.progress_bus,
+                                            tolerance=POSITION_TOLERANCE, move_timeout=SETTLE_TIMEOUT,
+                                            checkpoint=self.checkpoint)
+        self.progress_bus.engine = self.routine_engine
+        #Whatever the start button stops, the routine engine or a running scan
+        self.engine = self.routine_engine
+        
+        #Calibrated motion time of the connected stages, planned move times come from it once both axes have one
+        self.motion = MotionModel()
+        
+        #Connect tasks of axes that are still starting up, by name
+        self.connecting = {}
         
         MainWindow.setObjectName("MainWindow")
         MainWindow.resize(1650, 600)
@@ -189,7 +531,11 @@ class Ui_MainWindow(QWidget):
         self.layout_leftside.addWidget(self.button_delete_pos)
         
         #Data-structure containing 
-        self.list_pos = QtWidgets.QListWidget(self.centralwidget)
+        self.list_pos = QtWidgets.QListView(self.centralwidget)
+        self.routine_model = RoutineModel(self.list_pos)
+        self.list_pos.setModel(self.routine_model)
+        self.list_pos.setItemDelegate(RoutineDelegate(self.list_pos))
+        self.list_pos.setUniformItemSizes(True)
         self.list_pos.setAcceptDrops(True)
         self.list_pos.setDragEnabled(True)
         self.list_pos.setDragDropOverwriteMode(False)
@@ -225,6 +571,28 @@ class Ui_MainWindow(QWidget):
         self.layout_delay.addWidget(self.button_add_delay)
         
         self.layout_leftside.addLayout(self.layout_delay)
+        self.layout_loop = QtWidgets.QHBoxLayout()
+        self.layout_loop.setObjectName("layout_loop")
+        
+        #Spinbox used to set how often a new loop repeats its elements
+        self.spinbox_loop_count = QtWidgets.QSpinBox(self.centralwidget)
+        self.spinbox_loop_count.setObjectName("spinbox_loop_count")
+        self.spinbox_loop_count.setMinimum(1)
+        self.spinbox_loop_count.setMaximum(1000000)
+        self.spinbox_loop_count.setValue(2)
+        self.layout_loop.addWidget(self.spinbox_loop_count)
+        
+        #Label behind the loop spinbox saying "Times"
+        self.label_loop = QtWidgets.QLabel(self.centralwidget)
+        self.label_loop.setObjectName("label_loop")
+        self.layout_loop.addWidget(self.label_loop)
+        
+        #Button to wrap the selected elements of list_pos into a loop
+        self.button_add_loop = QtWidgets.QPushButton(self.centralwidget)
+        self.button_add_loop.setObjectName("button_add_loop")
+        self.layout_loop.addWidget(self.button_add_loop)
+        
+        self.layout_leftside.addLayout(self.layout_loop)
         self.layout_line_repetitions = QtWidgets.QHBoxLayout()
         self.layout_line_repetitions.setObjectName("layout_line_repetitions")
         
@@ -564,6 +932,8 @@ class Ui_MainWindow(QWidget):
         self.menubar.setObjectName("menubar")
         self.menuFile = QtWidgets.QMenu(self.menubar)
         self.menuFile.setObjectName("menuFile")
+        self.menuRoutine = QtWidgets.QMenu(self.menubar)
+        self.menuRoutine.setObjectName("menuRoutine")
 
         #Add names to Actions
         MainWindow.setMenuBar(self.menubar)
@@ -577,18 +947,37 @@ class Ui_MainWindow(QWidget):
         self.actionConnect_X.setObjectName("actionConnect_X")
         self.actionConnect_Y = QtWidgets.QAction(MainWindow)
         self.actionConnect_Y.setObjectName("actionConnect_Y")
+        self.actionConnectAll = QtWidgets.QAction(MainWindow)
+        self.actionConnectAll.setObjectName("actionConnectAll")
         self.actionClose = QtWidgets.QAction(MainWindow)
         self.actionClose.setObjectName("actionClose")
+        self.actionOptimize = QtWidgets.QAction(MainWindow)
+        self.actionOptimize.setObjectName("actionOptimize")
+        self.actionCalibrate = QtWidgets.QAction(MainWindow)
+        self.actionCalibrate.setObjectName("actionCalibrate")
+        self.actionGrid = QtWidgets.QAction(MainWindow)
+        self.actionGrid.setObjectName("actionGrid")
+        self.actionScan = QtWidgets.QAction(MainWindow)
+        self.actionScan.setObjectName("actionScan")
 
         #Add the menu functionalities
         self.menuFile.addAction(self.actionSave)
         self.menuFile.addAction(self.actionNew)
         self.menuFile.addAction(self.actionOpen)
+        self.menuFile.addAction(self.actionConnectAll)
         self.menuFile.addAction(self.actionClose)
         self.menubar.addAction(self.menuFile.menuAction())
+        self.menuRoutine.addAction(self.actionGrid)
+        self.menuRoutine.addAction(self.actionOptimize)
+        self.menuRoutine.addAction(self.actionScan)
+        self.menuRoutine.addAction(self.actionCalibrate)
+        self.menubar.addAction(self.menuRoutine.menuAction())
 
         #Update User Interface
         self.retranslateUi(MainWindow)
+        
+        #Offer to resume a routine interrupted by a crash once the window is shown
+        QtCore.QTimer.singleShot(0, self.offer_resume)
 
         #Connect all the Interfaces to eachother
         self.actionClose.triggered.connect(MainWindow.close)
@@ -599,7 +988,7 @@ class Ui_MainWindow(QWidget):
         self.step_textbox.valueChanged['int'].connect(self.step_slider.setValue)
         self.step_textbox.valueChanged['int'].connect(lambda:self.movement_normalize("MainWindow"))
         self.spinbox_delay_length.valueChanged.connect(lambda: self.update_spinbox_delay("MainWindow"))
-        self.button_delete_pos.clicked.connect(lambda:self.list_pos.takeItem(self.list_pos.currentRow()))
+        self.button_delete_pos.clicked.connect(lambda:self.delete_selected())
         
 
         self.button_smallest.clicked.connect(lambda:self.step_slider.setValue(SMALLEST))
@@ -623,11 +1012,19 @@ class Ui_MainWindow(QWidget):
         #Save a delay element to the data structure
         self.button_add_delay.clicked.connect(lambda:self.save_delay("MainWindow"))
         
+        #Wrap the selected elements into a loop
+        self.button_add_loop.clicked.connect(lambda:self.add_loop())
+        
+        #Port box and connect button of every axis
+        self.axis_widgets = {'x': (self.comboBox_x, self.pushButton_connectX), 'y': (self.comboBox_y, self.pushButton_connectY)}
+        for axis in axes:
+            axis.on_reply = self.read_reply
+        
         #Connect to serial device (x-Axis) via button
-        self.pushButton_connectX.clicked.connect(lambda:self.connect_X())
+        self.pushButton_connectX.clicked.connect(lambda:self.connect_axis('x'))
         
         #Connect to serial device (y-Axis) via button
-        self.pushButton_connectY.clicked.connect(lambda:self.connect_Y())
+        self.pushButton_connectY.clicked.connect(lambda:self.connect_axis('y'))
 
         #Start measurement via start-button
         self.button_start.clicked.connect(lambda:self.start_routine("MainWindow"))
@@ -637,6 +1034,11 @@ class Ui_MainWindow(QWidget):
         self.actionSave.triggered.connect(lambda:self.save_routine())
         self.actionOpen.triggered.connect(lambda:self.open_routine("MainWindow"))
         self.actionNew.triggered.connect(lambda:self.new_routine("MainWindow"))
+        self.actionOptimize.triggered.connect(lambda:loop.create_task(self.optimize_routine()))
+        self.actionCalibrate.triggered.connect(lambda:loop.create_task(self.calibrate_motion()))
+        self.actionConnectAll.triggered.connect(lambda:loop.create_task(self.connect_all()))
+        self.actionGrid.triggered.connect(lambda:self.generate_grid())
+        self.actionScan.triggered.connect(lambda:self.start_scan())
 
         
         QtCore.QMetaObject.connectSlotsByName(MainWindow)
@@ -663,32 +1065,21 @@ class Ui_MainWindow(QWidget):
         elif self.check_reverse_y.isChecked() and direction ==4:
             self.direction = 3  
 
-        msg = ''
-        if self.direction == 1:
-            msg +='PR-%s' %('{:f}'.format(Ui_MainWindow.speed)) + '\r\n'
-            if x_axis.is_open:
-                loop.call_soon(write_x, msg)
-
-        elif self.direction == 2:
-            msg +='PR%s' %('{:f}'.format(Ui_MainWindow.speed)) + '\r\n'
-            if x_axis.is_open:
-                loop.call_soon(write_x, msg)
-
-        elif self.direction == 3:
-            msg +='PR-%s' %('{:f}'.format(Ui_MainWindow.speed)) + '\r\n'
-            if y_axis.is_open:
-                loop.call_soon(write_y, msg)
-
-        elif self.direction == 4:
-            msg +='PR%s' %('{:f}'.format(Ui_MainWindow.speed)) + '\r\n'
-            if y_axis.is_open:
-                loop.call_soon(write_y, msg)
-        elif self.direction == 5:
-            loop.call_soon(write_x, 'PA0\r\n')
-            loop.call_soon(write_y, 'PA48\r\n')
-        elif self.direction == 6:
-            loop.call_soon(write_x, 'PA48\r\n')
-            loop.call_soon(write_y, 'PA0\r\n')
+        try:
+            #jog steps are dropped while the previous one still waits to be written
+            if self.direction in JOG_AXES:
+                axis = axes[JOG_AXES[self.direction]]
+                msg = 'PR%s%s' %('-' if self.direction in (1, 3) else '', '{:f}'.format(Ui_MainWindow.speed)) + '\r\n'
+                if axis.is_open:
+                    axis.control.write(msg, depth=JOG_DEPTH)
+            elif self.direction == 5:
+                axes['x'].write('PA0\r\n')
+                axes['y'].write('PA48\r\n')
+            elif self.direction == 6:
+                axes['x'].write('PA48\r\n')
+                axes['y'].write('PA0\r\n')
+        except ConexError as e:
+            self.messagebar(str(e))
 
 
 
@@ -697,149 +1088,364 @@ class Ui_MainWindow(QWidget):
     def save_routine(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
-        name, _  = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Configuration')
+        name, selected  = QtWidgets.QFileDialog.getSaveFileName(self, 'Save Configuration', '', ROUTINE_FILTER)
+        if not name:
+            return
+        if BINARY_SUFFIX in selected and not name.endswith(BINARY_SUFFIX):
+            name += BINARY_SUFFIX
         
-        file = open(name, "w")
-        file.write("####ACI####\r")
-        for j in range(self.spinbox_rep_count.value()):
-            for i in range(self.list_pos.count()):
-                
-                text = ""
-
-                pos_name ="%s;" %self.list_pos.item(i).text()            
-                x = "%s;" %self.list_pos.item(i).get_x()
-                y = "%s;" %self.list_pos.item(i).get_y()
-                t = "%s \r" %self.list_pos.item(i).get_t()
-                
-                text += str(pos_name)
-                text += str(x)
-                text += str(y)
-                text += str(t)
-                file.write(text)
-                
-        file.close()
-                
-                
+        try:
+            self.write_routine(name, name.endswith(BINARY_SUFFIX))
+        except OSError as e:
+            self.messagebar(str(e))
+
+    #Write list_pos to a file through a temporary one, so a routine still mapped from it is not cut off
+    def write_routine(self, name, binary):
+        store = self.routine_model.store
+        store.detach(name)
+        temporary = name + ".tmp"
+        with open(temporary, "wb" if binary else "w") as file:
+            if binary:
+                write_binary_routine(file, store, self.spinbox_rep_count.value())
+            else:
+                write_text_routine(file, store, self.spinbox_rep_count.value())
+        os.replace(temporary, name)
 
 
 
     def new_routine(self, MainWindow):
-        self.list_pos.clear() 
+        self.routine_model.clear()
 
 
     def open_routine(self, MainWindow):
 
-        filename = QFileDialog.getOpenFileName(self,'Open File')
-        f = open(filename[0],'r')
-        icon = QtGui.QIcon()
-        x = f.readline()
-        
-        if "####ACI####" not in x :
-            self.messagebar("Please only try to use ACI files")
-            print(x)
+        filename = QFileDialog.getOpenFileName(self,'Open File', '', ROUTINE_FILTER)
+        if filename[0]:
+            loop.create_task(self.load_routine(filename[0]))
+
+    #Stream a routine file into list_pos in batches, the GUI stays responsive meanwhile
+    async def load_routine(self, filename):
+        size = max(os.path.getsize(filename), 1)
+        progress = lambda read: self.messagebar("Loading routine: %s %%" %int(100*read/size))
+        self.button_start.setEnabled(False)
+        try:
+            if is_binary_routine(filename):
+                #the list shows the mapped columns, they are only copied once the routine is edited
+                routine = MappedRoutine(filename)
+                self.routine_model.use_mapped(routine)
+                self.spinbox_rep_count.setValue(routine.repetitions)
+                pos_num.num += routine.kind.tobytes().count(MOVE)
+                element_num.num += len(routine)
+                self.messagebar("Routine loaded: %s elements" %self.routine_model.rowCount())
+                return
+            with open(filename, 'r') as f:
+                self.spinbox_rep_count.setValue(read_text_header(f))
+                steps = read_text_routine(f, progress=progress, batch=LOAD_BATCH)
+                batch = list(islice(steps, LOAD_BATCH))
+                self.routine_model.clear()
+                while batch:
+                    self.routine_model.append_steps(batch)
+                    moves = sum(1 for step in batch if step.kind == MOVE)
+                    pos_num.num += moves
+                    element_num.num += len(batch)
+                    await asyncio.sleep(0)
+                    batch = list(islice(steps, LOAD_BATCH))
+            self.messagebar("Routine loaded: %s elements" %self.routine_model.rowCount())
+        except (OSError, ValueError) as e:
+            self.messagebar(str(e))
+        finally:
+            self.button_start.setEnabled(True)
+
+    #Reorder the positions of list_pos for shorter travel, asks before the new order is applied
+    async def optimize_routine(self):
+        if Ui_MainWindow.running:
             return
-        
-        self.list_pos.clear() 
-        for i in range(len(open(filename[0],'r').readlines())-1):
-            i = f.readline().split("\n",1)[0]
-            data = i.split(";",-1)
-            
-            pos = Ui_MainWindow.position
-            pos.x = data[1]
-            pos.y = data[2]
-            if data[3] == "NA":
-                data[3] = 0
-            print(data)
-            item = PositionItem(QtWidgets.QListWidgetItem(data[0]), x = pos.get_x() , y = pos.get_y() , t = float(data[3]))
-            if "Sleep" in data[0]:                        
-                next(element_num)
-                icon.addPixmap(QtGui.QPixmap("media/clock.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)               
-            else:               
-                icon.addPixmap(QtGui.QPixmap("media/waypoint.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
-                next(pos_num)
-                next(element_num)
-            item.setIcon(icon)
-            self.list_pos.addItem(item)
+        store = self.routine_model.store
+        kind, x, y, t = array('b', store.kind), array('q', store.x), array('q', store.y), array('d', store.t)
+        anchors = [index.row() for index in self.list_pos.selectionModel().selectedIndexes()]
+        self.messagebar("Optimizing order of %s elements" %len(kind))
+        self.actionOptimize.setEnabled(False)
+        try:
+            motion = self.motion if self.motion.ready else None
+            ordering = await loop.run_in_executor(None, optimize_order, kind, x, y, anchors, None, motion)
+        finally:
+            self.actionOptimize.setEnabled(True)
+        #with a motion model the time is minimized, the distance may even grow
+        if not ordering.changed or ordering.saved_time <= 0:
+            self.messagebar("Order is already optimal")
+            return
+        answer = QMessageBox.question(self, 'Optimize Order',
+                                      "Travel per repetition: %.3f mm -> %.3f mm\nThis saves about %.1f s per repetition. Apply the new order?"
+                                      %(ordering.before, ordering.after, ordering.saved_time))
+        #the routine may have been edited meanwhile, the order only fits the steps it was found for
+        if answer != QMessageBox.Yes or Ui_MainWindow.running:
+            self.messagebar("Order unchanged")
+            return
+        if store.kind != kind or store.x != x or store.y != y or store.t != t:
+            self.messagebar("Routine was changed while optimizing, order unchanged")
+            return
+        self.routine_model.reorder(ordering.order)
+        self.messagebar("Order optimized, saves about %.1f s per repetition" %ordering.saved_time)
 
-    def start_routine(self, MainWindow):
-        i=0
-        ii=0
-        success = True
+    #Ask for a grid of sites and append its positions to list_pos
+    def generate_grid(self):
+        dialog = GridDialog(self)
+        if not dialog.exec_():
+            return
+        try:
+            grid = dialog.grid()
+            mask = parse_mask(dialog.mask.text())
+        except ValueError as e:
+            self.messagebar(str(e))
+            return
+        names, kind, x, y, t = grid.routine(dialog.serpentine.isChecked(), mask, dialog.dwell.value() * 1000)
+        self.routine_model.append_columns(names, kind, x, y, t)
+        moves = kind.count(MOVE)
+        pos_num.num += moves
+        element_num.num += len(kind)
+        self.messagebar("Grid added: %s sites" %moves)
+
+    #Ask for a grid and a file, then scan the grid continuously and store the crossed sites in the file
+    def start_scan(self):
+        if Ui_MainWindow.running or not axes.all_open(('x', 'y')):
+            self.messagebar("Connect both axes to scan")
+            return
+        dialog = GridDialog(self, scan=True)
+        if not dialog.exec_():
+            return
+        try:
+            lines = grid_lines(dialog.grid(), dialog.serpentine.isChecked(), parse_mask(dialog.mask.text()), SCAN_RUN_UP)
+        except ValueError as e:
+            self.messagebar(str(e))
+            return
+        name, _ = QFileDialog.getSaveFileName(self, 'Save Scan', '', SCAN_FILTER)
+        if name:
+            loop.create_task(self.run_scan(lines, dialog.velocity.value(), name))
+
+    async def run_scan(self, lines, velocity, filename):
+        scanner = LineScanner(axes['x'].control, axes['y'].control, velocity, tolerance=POSITION_TOLERANCE)
+        #the start button stops the scan
+        self.engine = scanner
         Ui_MainWindow.running = True
+        self.button_start.setChecked(True)
+        self.button_start.setText(QtCore.QCoreApplication.translate("MainWindow", "Stop"))
+        self.messagebar("Scanning %s lines" %len(lines))
+        start = time.monotonic()
+        error = None
+        try:
+            try:
+                await scanner.run(lines)
+            except ConexError as e:
+                error = e
+            #the sites crossed before a failure are written as well
+            crossings = scanner.crossings
+            with open(filename, "w") as file:
+                write_crossings(file, crossings)
+            if error is not None:
+                self.messagebar("%s, the %s sites crossed before were written" %(error, len(crossings)))
+            else:
+                elapsed = time.monotonic() - start
+                self.messagebar("Scan done: %s sites crossed, %.0f samples/s" %(len(crossings), scanner.samples / max(elapsed, 1e-9)))
+        except OSError as e:
+            self.messagebar(str(e))
+        finally:
+            self.engine = self.routine_engine
+            Ui_MainWindow.running = False
+            self.button_start.setChecked(False)
+            self.button_start.setText(QtCore.QCoreApplication.translate("MainWindow", "Start"))
+
+    #Load the stored motion model of the stage on control
+    async def load_motion(self, control):
+        try:
+            stage = await stage_id(control)
+        except ConexError as e:
+            self.messagebar(str(e))
+            return
+        model = load_axis(QSettings().value(SETTING_MOTION %stage))
+        setattr(self.motion, control.name, model)
+        if model is not None:
+            self.messagebar("%s - Motion model of %s loaded: %s" %(control.name, stage, model))
+
+    #Drive both axes through the calibration moves and store the fitted motion models per stage
+    async def calibrate_motion(self):
+        if Ui_MainWindow.running or not axes.all_open(('x', 'y')):
+            self.messagebar("Connect both axes to calibrate")
+            return
+        self.messagebar("Calibrating motion, the stages are moving")
+        self.actionCalibrate.setEnabled(False)
+        self.button_start.setEnabled(False)
+        controls = [axes['x'].control, axes['y'].control]
+        try:
+            stages = await asyncio.gather(*(stage_id(control) for control in controls))
+            models = await calibrate(controls)
+        except ConexError as e:
+            self.messagebar(str(e))
+            return
+        finally:
+            self.actionCalibrate.setEnabled(True)
+            self.button_start.setEnabled(True)
+        settings = QSettings()
+        for control, stage in zip(controls, stages):
+            setattr(self.motion, control.name, models[control])
+            settings.setValue(SETTING_MOTION %stage, dump_axis(models[control]))
+        self.messagebar("Motion calibrated: x %s; y %s" %(self.motion.x, self.motion.y))
+
+    #Remove all selected elements from list_pos
+    def delete_selected(self):
+        rows = sorted(index.row() for index in self.list_pos.selectionModel().selectedIndexes())
+        if not rows and self.list_pos.currentIndex().isValid():
+            rows = [self.list_pos.currentIndex().row()]
+        #remove contiguous blocks from the end, so the other rows keep their index
+        while rows:
+            last = rows.pop()
+            first = last
+            while rows and rows[-1] == first - 1:
+                first = rows.pop()
+            self.routine_model.removeRows(first, last - first + 1)
+
+    def start_routine(self, MainWindow):
         if self.button_start.isChecked():
-            self.list_pos.repaint()
+            if Ui_MainWindow.running or self.routine_model.rowCount() == 0:
+                self.button_start.setChecked(Ui_MainWindow.running)
+                return
+            #the checkpoint copy of the routine is written below, the run must not use a mapping of that file
+            self.routine_model.store.detach(self.checkpoint.routine_path)
+            try:
+                routine = self.current_routine()
+            except RoutineFormatError as e:
+                self.messagebar(str(e))
+                self.button_start.setChecked(False)
+                return
+            if not axes.all_open(routine.commands):
+                missing = [name for name in routine.commands if not axes.all_open((name,))]
+                self.messagebar("Connect to %s - Axis to start the routine" %", ".join(missing))
+                self.button_start.setChecked(False)
+                return
+            resume = self.resume
+            self.resume = None
+            if resume is not None and resume[0].hash != routine_hash(routine):
+                self.messagebar("Routine was changed, starting from the beginning")
+                resume = None
+            if resume is None:
+                self.save_checkpoint_routine()
+            Ui_MainWindow.running = True
             self.button_start.setText(QtCore.QCoreApplication.translate("MainWindow", "Stop"))
             self.show_status(True)
             self.progressBar.setProperty("value", 0)
-            start = time.time()
-            for j in range(self.spinbox_rep_count.value()):
-                if self.button_start.isChecked():
-                    self.update_cycles(index = j)
-                    self.list_pos.item(0).setBackground(QColor("#e78200"))
-                    for i in range(self.list_pos.count()):
-                        if self.button_start.isChecked() and Ui_MainWindow.running:
-                            self.update_actions( index = i)
-                            #Change of background color Animation
-                            if i>0:
-                                self.list_pos.item(i).setBackground(QColor("#e78200"))
-                                if j % 2:
-                                    self.list_pos.item(i-1).setBackground(QColor("#19232d"))
-                                else:                                    
-                                    self.list_pos.item(i-1).setBackground(QColor("#00558d"))
-                                    
-                            if self.spinbox_rep_count.value()>0:
-                                if not j%2 and not j==0 and i == 0:
-                                        self.list_pos.item(self.list_pos.count()-1).setBackground(QColor("#19232d"))         
-
-                                if j%2  and not j==0 and i == 0:
-                                        self.list_pos.item(self.list_pos.count()-1).setBackground(QColor("#00558d"))        
-                                
-                                    
-                            text = self.list_pos.item(i).text()
-                            
-                            QtTest.QTest.qWait(int(self.list_pos.item(i).get_t()))
-                            
-                            if "Sleep" not in text:
-                               
-                                loop.call_soon(write_x,(" %s\r\n" %self.list_pos.item(i).get_x())) 
-                                loop.call_soon(write_y,(" %s\r\n" %self.list_pos.item(i).get_y()))                                
-
-                                #loop.call_soon(write_y,str(self.list_pos.item(i).get_y()))
-
-                            self.update_progressbar(start_time = start, total_time = self.total_time())
-                        else:
-                            for i in range(self.list_pos.count()):
-                                self.list_pos.item(i).setBackground(QColor("#19232d"))
-                            success = False
-                            Ui_MainWindow.running = False
-                            break
-
-
-            for i in range(self.list_pos.count()):
-                self.list_pos.item(i).setBackground(QColor("#19232d"))
-            if success:
-                self.progressBar.setProperty("value", 100)
-                self.messagebar("Measurement has been successfull")
+            self.list_pos.setDragDropMode(QtWidgets.QAbstractItemView.NoDragDrop)
+            self.button_delete_pos.setEnabled(False)
+            if resume is None:
+                loop.create_task(self.routine_engine.run(routine))
             else:
-                self.messagebar("Measurement has been interrupted")
-            self.button_start.setChecked(False)
-            Ui_MainWindow.running = False
-            self.start_routine("MainWindow")
-            
-
+                loop.create_task(self.resume_routine(routine, *resume))
         else:
-            self.show_status(False)
-            self.button_start.setText(QtCore.QCoreApplication.translate("MainWindow", "Start"))
-            Ui_MainWindow.running = False
-
+            self.engine.stop()
 
+    #Copy the routine next to the checkpoint, so it can be resumed even if it was never saved
+    def save_checkpoint_routine(self):
+        try:
+            os.makedirs(os.path.dirname(self.checkpoint.routine_path), exist_ok=True)
+            self.write_routine(self.checkpoint.routine_path, True)
+        except OSError as e:
+            self.messagebar("Progress can not be resumed: %s" %e)
+
+    #Run routine from the step recorded in a checkpoint, homing all connected axes first if asked to
+    async def resume_routine(self, routine, record, home):
+        if home:
+            self.messagebar("Homing before resuming")
+            try:
+                controls = [axis.control for axis in axes.connected()]
+                for control in controls:
+                    control.write('RFH\r\n')
+                homed = await asyncio.gather(*(wait_ready(control, HOME_TIMEOUT, HOME_INTERVAL) for control in controls))
+            except ConexError as e:
+                homed = [False]
+                self.messagebar(str(e))
+            if not all(homed):
+                self.messagebar("Homing failed, routine not resumed")
+                self.routine_finished(False)
+                return
+        self.messagebar("Resuming at repetition %s, element %s" %(record.repetition + 1, record.index + 1))
+        await self.routine_engine.run(routine, resume=(record.repetition, record.index, record.iterations))
+
+    #Ask whether to resume a routine a crash interrupted, loads it if so
+    def offer_resume(self):
+        record = self.checkpoint.read()
+        if record is None or not os.path.exists(self.checkpoint.routine_path):
+            return
+        box = QMessageBox(QMessageBox.Question, 'Resume Routine',
+                          "A routine started %s was interrupted at repetition %s, element %s on %s. Resume it?"
+                          %(time.strftime("%c", time.localtime(record.started)), record.repetition + 1, record.index + 1,
+                            time.strftime("%c", time.localtime(record.time))),
+                          QMessageBox.Yes | QMessageBox.No, self)
+        home = QtWidgets.QCheckBox("Home the stages before resuming")
+        box.setCheckBox(home)
+        if box.exec_() != QMessageBox.Yes:
+            self.checkpoint.discard()
+            return
+        self.resume = (record, home.isChecked())
+        loop.create_task(self.load_resumed(self.checkpoint.routine_path))
+
+    async def load_resumed(self, filename):
+        await self.load_routine(filename)
+        if self.resume is not None:
+            record = self.resume[0]
+            self.messagebar("Connect both axes and press Start to resume at repetition %s, element %s"
+                            %(record.repetition + 1, record.index + 1))
+
+    #Compiled routine of the elements in list_pos, run by the engine
+    def current_routine(self) -> CompiledRoutine:
+        return self.routine_model.store.compile(self.spinbox_rep_count.value(), self.motion if self.motion.ready else None)
+
+    #Routine started by the engine
+    def routine_started(self, routine):
+        self.run_names = routine.names
+        self.run_kind = routine.kind
+        self.run_shown = (-1, -1)
+
+    #Latest progress of the engine, highlight the running step and mark the ones before as done
+    def show_progress(self, snapshot):
+        repetition, index = snapshot.repetition, snapshot.index
+        if (repetition, index) != self.run_shown:
+            if repetition != self.run_shown[0]:
+                self.update_cycles(index = repetition)
+            if index >= 0:
+                self.update_actions(index = index)
+            self.routine_model.set_current(repetition, index)
+            self.run_shown = (repetition, index)
+        self.update_progressbar(elapsed = snapshot.elapsed, total_time = snapshot.total)
+
+    #Routine finished by the engine
+    def routine_finished(self, completed):
+        self.routine_model.set_current(0, -1)
+        self.list_pos.setDragDropMode(QtWidgets.QAbstractItemView.InternalMove)
+        self.button_delete_pos.setEnabled(True)
+        scheduler = self.routine_engine.scheduler
+        late = ""
+        if scheduler.late_steps:
+            late = ", %s steps started late (up to %.1f ms)" %(scheduler.late_steps, scheduler.max_late_ns / 1000000)
+        skew = self.routine_engine.skew
+        if skew.count:
+            late += ", axes settled up to %.1f ms apart" %(skew.max_ns / 1000000)
+        bus = self.progress_bus
+        log.info('Progress: %s events shown in %s updates, %s coalesced', bus.events, bus.snapshots, bus.coalesced)
+        if completed:
+            self.progressBar.setProperty("value", 100)
+            self.messagebar("Measurement has been successfull" + late)
+        else:
+            self.messagebar("Measurement has been interrupted" + late)
+        Ui_MainWindow.running = False
+        self.button_start.setChecked(False)
+        self.show_status(False)
+        self.button_start.setText(QtCore.QCoreApplication.translate("MainWindow", "Start"))
 
     def movement_normalize(self, MainWindow):
         Ui_MainWindow.speed = self.step_slider.value()/1000000
     
 
     
-    def movement_init(self, MainWindow):
+    #Set up a freshly connected axis, home it and send it to its home position
+    async def movement_init(self, axis):
         msg = ''
         #Set to closed loop state
         msg += 'OR' + '\r\n'
@@ -857,105 +1463,83 @@ class Ui_MainWindow(QWidget):
         msg += 'RFH' + '\r\n'
         
         
+        axis.write(msg)
+        #Report the states the controller passes while homing
+        report = lambda state: self.messagebar("%s - Axis %s" %(axis.name, state_name(state)))
+        if not await wait_ready(axis.control, HOME_TIMEOUT, HOME_INTERVAL, report):
+            raise ConexError("%s - Axis not homed within %s s" %(axis.name, HOME_TIMEOUT))
+        #Starting position
+        if axis.home is not None:
+            axis.write('PA%s\r\n' %mm_text(to_nm(axis.home)))
+
+    #Open the port of axis, wait until its controller answers and home it, all without blocking the GUI
+    async def start_axis(self, axis):
+        combo, button = self.axis_widgets[axis.name]
+        combo.setEnabled(False)
+        self.messagebar("%s - Axis connecting" %axis.name)
         try:
-            loop.call_soon(write_y, msg)
-            loop.call_soon(write_x, msg)
-            #Starting positions
-            loop.call_soon(write_y, 'PA24.194633')
-            loop.call_soon(write_x, 'PA23.868719')
-        except Exception as e:
-                self.messagebar(str(e))
-
-
-
-            
-    def connect_Y(self) -> None:
-        """Open serial connection to the specified port."""
-        if y_axis.is_open:
-            y_axis.close()
-        if self.pushButton_connectY.isChecked():
-            y_axis.port = self.yport
-            y_axis.baudrate = SER_BAUDRATE
-            try:
-                y_axis.open()
-            except Exception as e:
-                self.messagebar(str(e))
-                
-            if y_axis.is_open:
-                self.show_control(True)
-                time.sleep(1.8)
-                self.movement_init("MainWindow")
-                self.messagebar("y - Axis connected")
-                loop.create_task(self.read_y())
-                self.comboBox_y.setEnabled(False)
-
-        elif not self.pushButton_connectY.isChecked():
-            self.button_start.setChecked(False)
-            self.comboBox_y.setEnabled(True)
-            try:
-                y_axis.close()
-                self.messagebar("y - Axis disconnected")
-                self.show_control(False)
-
-            except Exception as e:
-                self.messagebar(str(e))
- 
-
-
-    def connect_X(self) -> None:
+            version = await axis.connect(combo_port(combo), SER_BAUDRATE, CONNECT_TIMEOUT)
+            self.messagebar("%s - Axis answered: %s" %(axis.name, version.text))
+            await self.movement_init(axis)
+        except (ConexError, OSError, ValueError) as e:
+            axis.close()
+            button.setChecked(False)
+            combo.setEnabled(True)
+            self.messagebar(str(e))
+            return False
+        self.show_control(True)
+        self.messagebar("%s - Axis connected" %axis.name)
+        loop.create_task(self.load_motion(axis.control))
+        return True
+
+    #Connect all axes that are not connected yet side by side, takes as long as the slowest one
+    async def connect_all(self):
+        started = time.monotonic()
+        for axis in axes:
+            combo, button = self.axis_widgets[axis.name]
+            if not button.isChecked():
+                button.setChecked(True)
+                self.connect_axis(axis.name)
+        tasks = [task for task in self.connecting.values() if not task.done()]
+        connected = await asyncio.gather(*tasks, return_exceptions=True)
+        if tasks and all(result is True for result in connected):
+            self.messagebar("All axes connected in %.1f s" %(time.monotonic() - started))
+
+    #Connect or disconnect an axis as its connect button says
+    def connect_axis(self, name: str) -> None:
         """Open serial connection to the specified port."""
-        if x_axis.is_open:
-            x_axis.close()
-        if self.pushButton_connectX.isChecked():
-            x_axis.port = self.xport
-            x_axis.baudrate = SER_BAUDRATE
-            try:
-                x_axis.open()
-            except Exception as e:
-                self.messagebar(str(e))
-            if x_axis.is_open:
-                self.show_control(True)
-                time.sleep(1.8)
-                self.movement_init("MainWindow")
-                self.messagebar("x - Axis connected")
-                self.comboBox_x.setEnabled(False)
-                loop.create_task(self.read_x())
-        elif not self.pushButton_connectX.isChecked():
+        axis = axes[name]
+        combo, button = self.axis_widgets[name]
+        task = self.connecting.pop(name, None)
+        if task is not None:
+            task.cancel()
+        if axis.is_open:
+            axis.close()
+        if button.isChecked():
+            self.connecting[name] = loop.create_task(self.start_axis(axis))
+        else:
             self.button_start.setChecked(False)
-            self.comboBox_x.setEnabled(True)
+            self.engine.stop()
+            combo.setEnabled(True)
             try:
-                x_axis.close()
-                self.messagebar("x - Axis disconnected")
+                axis.close()
+                self.messagebar("%s - Axis disconnected" %name)
                 self.show_control(False)
             except Exception as e:
                 self.messagebar(str(e))
 
-    #Asks for PA x Position       
-    def get_x_position(self, port) -> None:
-        if port.is_open:
-            loop.call_soon(write_x, "PA?")
-            
-    #Asks for PA y Position       
-    def get_y_position(self, port) -> None:
-        if port.is_open:
-            loop.call_soon(write_y, "PA?")
-            
     #Function to add position-elements to list
     def add_position(self):
         coordinate = Ui_MainWindow.position
-        print("Coordinate data: x Position: %s ,y Position: %s" %(coordinate.get_x(),coordinate.get_y()))
+        print("Coordinate data: x Position: %s ,y Position: %s" %(position_text(coordinate.get_x()), position_text(coordinate.get_y())))
 
         #Set name and icon of new position-element
         if coordinate.saveable():
-            item = PositionItem(QtWidgets.QListWidgetItem("Position %s" %pos_num.num), x = coordinate.get_x() , y = coordinate.get_y() ,t=BUFFER)
-            print("Item saved: x Position %s" %item.get_x())
-            print("Item saved: y Position %s" %item.get_y())
-            icon = QtGui.QIcon()
-            icon.addPixmap(QtGui.QPixmap("media/waypoint.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
-            item.setIcon(icon)
-            item.setFlags(item.flags() | QtCore.Qt.ItemIsEditable)
+            step = Step("Position %s" %pos_num.num, MOVE, coordinate.get_x(), coordinate.get_y(), BUFFER)
+            print("Item saved: x Position %s" %mm_text(step.x))
+            print("Item saved: y Position %s" %mm_text(step.y))
             #add element to list
-            self.list_pos.addItem(item)
+            self.routine_model.append_steps([step])
 
 
         else:
@@ -963,17 +1547,40 @@ class Ui_MainWindow(QWidget):
     
         #iterate list position
         next(pos_num)
-        coordinate.set_y("NA")
-        coordinate.set_x("NA")
+        coordinate.clear()
           
     def save_position(self):
-        self.get_x_position(x_axis)
-        self.get_y_position(y_axis)
-        QtTest.QTest.qWait(25)
+        loop.create_task(self.capture_position())
+
+    #Query both axes concurrently and store the position once both replied
+    async def capture_position(self):
+        coordinate = Ui_MainWindow.position
+        x, y = await asyncio.gather(axes['x'].control.query("PA?"), axes['y'].control.query("PA?"), return_exceptions=True)
+        for axis, reply in (('x', x), ('y', y)):
+            if isinstance(reply, ConexError):
+                self.messagebar(str(reply))
+            elif isinstance(reply, Exception):
+                raise reply
+            elif axis == 'x':
+                coordinate.set_x(to_nm(reply.value))
+            else:
+                coordinate.set_y(to_nm(reply.value))
         self.add_position()
                 
 
     
+    #Function to wrap the selected elements into a loop, adds an empty loop at the end if nothing is selected
+    def add_loop(self):
+        count = self.spinbox_loop_count.value()
+        start = Step("Repeat %s times" %count, LOOP, NO_POSITION, NO_POSITION, count)
+        end = Step("End of loop", END, NO_POSITION, NO_POSITION, 0)
+        rows = sorted(index.row() for index in self.list_pos.selectionModel().selectedIndexes())
+        if rows:
+            self.routine_model.insert_steps(rows[-1] + 1, [end])
+            self.routine_model.insert_steps(rows[0], [start])
+        else:
+            self.routine_model.append_steps([start, end])
+    
     #Function to add Delay-elements to List
     def save_delay(self, MainWindow):
         #Make sure no 0s delays can be added
@@ -981,19 +1588,15 @@ class Ui_MainWindow(QWidget):
             #Set name and icon of new position-element
             length = self.spinbox_delay_length.value()
             if Ui_MainWindow.seconds:
-                item = PositionItem(QtWidgets.QListWidgetItem("Sleep for %s s" %length), x = "NA" , y = "NA" ,t = length *1000)
+                step = Step("Sleep for %s s" %length, DELAY, NO_POSITION, NO_POSITION, length *1000)
             if Ui_MainWindow.minutes:
-                item = PositionItem(QtWidgets.QListWidgetItem("Sleep for %s min" %length), x = "NA" , y = "NA" ,t = length*60*1000)
+                step = Step("Sleep for %s min" %length, DELAY, NO_POSITION, NO_POSITION, length*60*1000)
             if Ui_MainWindow.hours:
-                item = PositionItem(QtWidgets.QListWidgetItem("Sleep for %s h" %length), x = "NA" , y = "NA" ,t = length*60*60*1000)
+                step = Step("Sleep for %s h" %length, DELAY, NO_POSITION, NO_POSITION, length*60*60*1000)
                 
             print("Item saved: Delay, length: %s" %length)
-            icon = QtGui.QIcon()
-            icon.addPixmap(QtGui.QPixmap("media/clock.png"), QtGui.QIcon.Normal, QtGui.QIcon.Off)
-            item.setIcon(icon)
             #add element to list
-            self.list_pos.addItem(item)
-            item = self.list_pos.item(element_num.num)
+            self.routine_model.append_steps([step])
             #iterate list position
             next(element_num)
 
@@ -1013,11 +1616,10 @@ class Ui_MainWindow(QWidget):
         
     def show_control(self, show):
         if show:
-            if x_axis.isOpen() and not y_axis.isOpen():
-                self.messagebar("Connect to y - Axis to enable control")
-            if y_axis.isOpen() and not x_axis.isOpen():
-                self.messagebar("Connect to x - Axis to enable control")
-            if y_axis.isOpen() and  x_axis.isOpen():
+            missing = [axis.name for axis in axes if not axis.is_open]
+            if missing and len(missing) < len(axes):
+                self.messagebar("Connect to %s - Axis to enable control" %", ".join(missing))
+            if not missing:
                 self.button_move_up.setVisible(show)
                 self.button_move_down.setVisible(show)
                 self.button_move_right.setVisible(show)
@@ -1053,30 +1655,12 @@ class Ui_MainWindow(QWidget):
         MainWindow.statusBar().showMessage(message)
 
 
-    def total_time(self)->float:
-        total_time=0
-        for j in range(self.spinbox_rep_count.value()):
-            for i in range(self.list_pos.count()):
-                text = self.list_pos.item(i).text()
-                if "Sleep" in text:
-                    total_time += self.list_pos.item(i).get_t()
-                else:
-                    total_time += BUFFER
-        return total_time       
-        
-        
-    def update_progressbar(self, start_time, total_time):
+    def update_progressbar(self, elapsed, total_time):
         if self.progressBar.value() < 97 :
             total = total_time/1000
-            start = start_time
-            now = time.time()
-            print("start: %s" %(start))
-            progress = int(100*(now-start)/total)
-            print("now: %s" %(now-start))
-            print("total: %s" %(total))
-            self.messagebar(self.show_time_left(start, now, total))
-            
-            
+            now = elapsed/1000
+            progress = int(100*now/total) if total > 0 else 100
+            self.messagebar(self.show_time_left(0, now, total))
             self.progressBar.setProperty("value", progress)
     
     #adapt units to total time left    
@@ -1099,20 +1683,22 @@ class Ui_MainWindow(QWidget):
          
     #updates actions in the progress viewer
     def update_actions(self, index):
-        if index +1 < self.list_pos.count():
-            nex = self.list_pos.item(index+1).text()
-            if "Sleep" in nex:
+        names = self.run_names
+        kind = self.run_kind
+        if index +1 < len(names):
+            nex = names[index+1]
+            if kind[index+1] != MOVE:
                 self.next.setText(QtCore.QCoreApplication.translate("MainWindow", nex))            
-            elif "Sleep" not in nex:
+            else:
                 self.next.setText(QtCore.QCoreApplication.translate("MainWindow",  "Moving to %s" %nex)) 
-        elif index +1 > self.list_pos.count():
+        else:
             self.next.setText(QtCore.QCoreApplication.translate("MainWindow", "--")) 
 
-        cur = self.list_pos.item(index).text()
+        cur = names[index]
         
-        if "Sleep" in cur:
+        if kind[index] != MOVE:
             self.now.setText(QtCore.QCoreApplication.translate("MainWindow", cur))
-        elif "Sleep" not in cur:
+        else:
             self.now.setText(QtCore.QCoreApplication.translate("MainWindow", "Moving to %s" %cur))
         
               
@@ -1164,6 +1750,8 @@ class Ui_MainWindow(QWidget):
         #Set all Texts on Buttons
         self.button_delete_pos.setText(_translate("MainWindow", "Delete Selected"))  
         self.button_add_delay.setText(_translate("MainWindow", "Add Delay"))   
+        self.label_loop.setText(_translate("MainWindow", "Times"))
+        self.button_add_loop.setText(_translate("MainWindow", "Add Loop"))
         self.label_repetitions.setText(_translate("MainWindow", "Repetitions"))
         self.button_start.setText(_translate("MainWindow", "Start"))
         self.label_axis_settings.setText(_translate("MainWindow", "Axis Settings"))
@@ -1187,7 +1775,18 @@ class Ui_MainWindow(QWidget):
         self.actionOpen.setText(_translate("MainWindow", "Open"))
         self.actionConnect_X.setText(_translate("MainWindow", "Connect X"))
         self.actionConnect_Y.setText(_translate("MainWindow", "Connect Y"))
+        self.actionConnectAll.setText(_translate("MainWindow", "Connect All Axes"))
+        self.actionConnectAll.setStatusTip(_translate("MainWindow", "Connect and home all axes at once"))
         self.actionClose.setText(_translate("MainWindow", "Close"))
+        self.menuRoutine.setTitle(_translate("MainWindow", "Routine"))
+        self.actionOptimize.setText(_translate("MainWindow", "Optimize Order"))
+        self.actionOptimize.setStatusTip(_translate("MainWindow", "Reorder positions between delays for shorter travel, selected elements keep their place"))
+        self.actionCalibrate.setText(_translate("MainWindow", "Calibrate Motion"))
+        self.actionGrid.setText(_translate("MainWindow", "Generate Grid"))
+        self.actionGrid.setStatusTip(_translate("MainWindow", "Add positions on a grid of sites to the routine"))
+        self.actionScan.setText(_translate("MainWindow", "Continuous Scan"))
+        self.actionScan.setStatusTip(_translate("MainWindow", "Scan the rows of a grid at constant velocity and record when its sites are crossed"))
+        self.actionCalibrate.setStatusTip(_translate("MainWindow", "Measure how long moves of the connected stages take"))
         self.update_spinbox_delay("MainWindow")        
         
         #Set all the Status Tips
@@ -1203,6 +1802,7 @@ class Ui_MainWindow(QWidget):
         self.button_delete_pos.setStatusTip(_translate("MainWindow", "Shortcut: del"))
         self.button_start.setStatusTip(_translate("MainWindow", "Shortcut: Space"))        
         self.button_add_delay.setStatusTip(_translate("MainWindow", "Add Delay; Shortcut: D"))
+        self.button_add_loop.setStatusTip(_translate("MainWindow", "Repeat the selected elements; Shortcut: L"))
         self.button_smallest.setStatusTip(_translate("MainWindow", "Move with smallest Steps; Shortcut: 1"))
         self.button_small.setStatusTip(_translate("MainWindow", "Move with small Steps; Shortcut: 2"))
         self.button_big.setStatusTip(_translate("MainWindow", "Move with big Steps; Shortcut: 3"))
@@ -1226,6 +1826,7 @@ class Ui_MainWindow(QWidget):
         self.button_move_right.setShortcut(_translate("MainWindow", "Right"))
         self.button_start.setShortcut(_translate("MainWindow", "Space"))
         self.button_add_delay.setShortcut(_translate("MainWindow", "D"))
+        self.button_add_loop.setShortcut(_translate("MainWindow", "L"))
         self.button_delete_pos.setShortcut(_translate("MainWindow", "Del"))        
         self.actionClose.setShortcut(_translate("MainWindow", "Ctrl+X"))
         
@@ -1243,10 +1844,6 @@ class Ui_MainWindow(QWidget):
         
 
         
-        __sortingEnabled = self.list_pos.isSortingEnabled()
-        self.list_pos.setSortingEnabled(False)       
-        self.list_pos.setSortingEnabled(__sortingEnabled)
-        
         self._load_settings()
     
     #Load settings on startup.
@@ -1288,52 +1885,35 @@ class Ui_MainWindow(QWidget):
     #Return the current serial X axis port.
     @property
     def xport(self) -> str:
-        return self.comboBox_x.currentData()
+        return combo_port(self.comboBox_x)
     
     #Return the current serial Y axis port.
     @property
     def yport(self) -> str:
-        return self.comboBox_y.currentData()
+        return combo_port(self.comboBox_y)
     
     #Handle Close event of the Widget.
     def closeEvent(self, event: QCloseEvent) -> None:
         
-        if x_axis.is_open:
-            x_axis.close()
-            
-        if y_axis.is_open:
-            y_axis.close()
+        axes.close()
 
         self._save_settings()
 
         event.accept()
     
-    #Wait for incoming data and convert it to text
-    async def read_x(self) -> None:
-        while x_axis.is_open:
-                msg = x_axis.readline()
-                if msg != b'':    
-                    text = msg.decode().strip()
-                    if "PA" in text:
-                        Ui_MainWindow.position.set_x(text)
-                    print('X-Axis %s' %text)    
-                await asyncio.sleep(0)
-                
-         
-    #Wait for incoming data and convert it to text
-    async def read_y(self) -> None:
-        while y_axis.is_open:
-                msg = y_axis.readline()
-                if msg != b'':
-                    text = msg.decode().strip()
-                    if "PA" in text:
-                        Ui_MainWindow.position.set_y(text)
-                    print('Y-Axis %s' %text) 
-                await asyncio.sleep(0)
+    #Handle a reply of an axis, called once its controller got it
+    def read_reply(self, axis, reply: Reply) -> None:
+        if reply.mnemonic == 'PA':
+            if axis.name == 'x':
+                Ui_MainWindow.position.set_x(axis.position)
+            elif axis.name == 'y':
+                Ui_MainWindow.position.set_y(axis.position)
 
 
 
 if __name__ == "__main__":
+    #the optimizer runs worker processes, in the frozen release they must not start the GUI again
+    multiprocessing.freeze_support()
     app = QtWidgets.QApplication(sys.argv)
     app.setStyleSheet(qdarkstyle.load_stylesheet(qt_api='pyqt5'))
     loop = QEventLoop()
@@ -0,0 +1,204 @@
+import asyncio
+import logging
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from serial import Serial
+
+from conex import CONNECT_TIMEOUT, ConexError, Controller, Reply, SerialReader, WriteQueue, probe
+from routine import NO_POSITION, to_nm
+
+
+log = logging.getLogger(__name__)
+
+
+class Axis(object):
+    """One stage axis: its serial port, the Controller (and write queue) on it, the reader serving the port
+    and the last position the controller replied.
+
+    Nothing is shared between axes, every axis reads and writes on its own,
+    so any number of them run side by side. Daisy chained controllers are
+    the exception, axes given a ``link`` share its port, reader and queue
+    and are told apart by their ``address``. ``home`` (in mm) is where the
+    axis is sent after connecting, ``on_reply`` is called with the axis and
+    every Reply after the controller got it.
+    """
+
+    def __init__(self, name: str, port=None, home: Optional[float] = None,
+                 on_reply: Optional[Callable[['Axis', Reply], None]] = None,
+                 link: Optional['Link'] = None, address: Optional[int] = None):
+        self.name = name
+        self.link = link
+        self.address = address
+        if link is not None:
+            if address is None:
+                raise ValueError("%s - Axis needs an address on a shared port" %name)
+            self.port = link.port
+            self.control = Controller(self.port, name, link.queue, address)
+            self.reader = link.reader
+            link.attach(self)
+        else:
+            self.port = port if port is not None else Serial(timeout=0)
+            self.control = Controller(self.port, name, address=address)
+            self.reader = SerialReader()
+        self.home = home
+        self.on_reply = on_reply
+        #last position replied to PA? in nm
+        self.position = NO_POSITION
+        self._connected = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._connected and self.port.is_open
+
+    #Open the port on device and start reading it, raises what the port raises if that fails
+    def open(self, device: str, baudrate: int) -> None:
+        self.close()
+        if self.link is not None:
+            self.link.open(device, baudrate)
+        else:
+            self.port.port = device
+            self.port.baudrate = baudrate
+            self.port.open()
+            self.reader.add(self.name, self.port, self.feed)
+        self._connected = True
+
+    #Open the port and wait until the controller answers, returns its version reply.
+    #Closes the port again if it does not answer within timeout (in s), see probe.
+    async def connect(self, device: str, baudrate: int, timeout: float = CONNECT_TIMEOUT) -> Reply:
+        self.open(device, baudrate)
+        try:
+            return await probe(self.control, timeout)
+        except (ConexError, asyncio.CancelledError):
+            self.close()
+            raise
+
+    #Stop reading, fail waiting queries and close the port (a shared one once no axis uses it any more)
+    def close(self) -> None:
+        self.control.cancel()
+        self._connected = False
+        self.position = NO_POSITION
+        if self.link is not None:
+            self.link.release()
+            return
+        if self.name in self.reader:
+            log.info('%s - Axis reply latency: %s', self.name, self.reader.latency(self.name))
+            log.info('%s - Axis write queue: %s', self.name, self.control.queue)
+            self.reader.remove(self.name)
+        if self.port.is_open:
+            self.port.close()
+
+    #Send a message through the write queue if the axis is connected
+    def write(self, msg: str) -> None:
+        if self.port.is_open:
+            self.control.write(msg)
+            log.debug('%s - Axis sent %r', self.name, msg)
+
+    #Handle a reply of the controller, called by the reader when it arrives
+    def feed(self, reply: Reply) -> None:
+        self.control.feed(reply)
+        if reply.mnemonic == 'PA':
+            self.position = to_nm(reply.value)
+        if self.on_reply is not None:
+            self.on_reply(self, reply)
+
+
+class Link(object):
+    """Serial port shared by daisy chained controllers, each axis on it has its own address.
+
+    One reader serves the port and routes every reply to the axis of its
+    address (replies without one go to the only axis, if there is just one),
+    one write queue takes the commands of all axes in turns.
+    """
+
+    def __init__(self, name: str, port=None):
+        self.name = name
+        self.port = port if port is not None else Serial(timeout=0)
+        self.queue = WriteQueue(self.port, name)
+        self.reader = SerialReader()
+        self.axes: Dict[int, Axis] = {}
+        #replies no axis was found for
+        self.unrouted = 0
+
+    def attach(self, axis: Axis) -> None:
+        if axis.address in self.axes:
+            raise ValueError("Address %s is already used on %s" %(axis.address, self.name))
+        self.axes[axis.address] = axis
+
+    #Open the port unless it already is, it has to be the same device for all axes
+    def open(self, device: str, baudrate: int) -> None:
+        if self.port.is_open:
+            if self.port.port != device:
+                raise ConexError("%s is already connected to %s" %(self.name, self.port.port))
+            return
+        self.port.port = device
+        self.port.baudrate = baudrate
+        self.port.open()
+        self.reader.add(self.name, self.port, self.feed)
+
+    #Close the port once none of its axes is connected any more
+    def release(self) -> None:
+        if any(axis.is_open for axis in self.axes.values()):
+            return
+        if self.name in self.reader:
+            log.info('%s reply latency: %s', self.name, self.reader.latency(self.name))
+            log.info('%s write queue: %s', self.name, self.queue)
+            self.reader.remove(self.name)
+        if self.port.is_open:
+            self.port.close()
+
+    def feed(self, reply: Reply) -> None:
+        axis = self.axes.get(reply.address)
+        if axis is None and not reply.address and len(self.axes) == 1:
+            axis = next(iter(self.axes.values()))
+        if axis is None or not axis.is_open:
+            self.unrouted += 1
+            return
+        axis.feed(reply)
+
+
+class AxisRegistry(object):
+    """Axes by name, in the order they were added."""
+
+    def __init__(self, axes: Iterable[Axis] = ()):
+        self._axes: Dict[str, Axis] = {}
+        for axis in axes:
+            self.add(axis)
+
+    def add(self, axis: Axis) -> Axis:
+        if axis.name in self._axes:
+            raise ValueError("There already is a %s - Axis" %axis.name)
+        self._axes[axis.name] = axis
+        return axis
+
+    def __getitem__(self, name: str) -> Axis:
+        return self._axes[name]
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._axes
+
+    def __iter__(self) -> Iterator[Axis]:
+        return iter(self._axes.values())
+
+    def __len__(self) -> int:
+        return len(self._axes)
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._axes)
+
+    #Axes with an open port
+    def connected(self) -> List[Axis]:
+        return [axis for axis in self if axis.is_open]
+
+    #True if all axes of names (all axes if None) are connected
+    def all_open(self, names: Optional[Iterable[str]] = None) -> bool:
+        names = self._axes if names is None else names
+        return all(name in self._axes and self._axes[name].is_open for name in names)
+
+    #Controllers of all axes by name, as the RoutineEngine drives them
+    def controls(self) -> Dict[str, Controller]:
+        return {name: axis.control for name, axis in self._axes.items()}
+
+    def close(self) -> None:
+        for axis in self:
+            axis.close()
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import struct
+import time
+import zlib
+from array import array
+from collections import namedtuple
+from typing import Optional, Tuple
+
+from routine import BINARY_SUFFIX, DELAY, CompiledRoutine
+
+
+#Longest time (in s) a written checkpoint may stay unsynced, fsync is not done for every step
+SYNC_INTERVAL = 1.0
+
+#Deepest loop nesting whose iterations are kept
+MAX_DEPTH = 8
+
+#magic, sequence number, routine hash, repetition, step, loop depth, routine start and step start
+#(unix time in s), iterations of the enclosing loops; followed by the crc32 of all that
+CHECKPOINT_MAGIC = b"ACICHK\x00\x01"
+CHECKPOINT_RECORD = struct.Struct("<8sQ32sIQBdd%sI" %MAX_DEPTH)
+CHECKPOINT_CRC = struct.Struct("<I")
+RECORD_SIZE = CHECKPOINT_RECORD.size + CHECKPOINT_CRC.size
+
+#Progress read back from a checkpoint file
+CheckpointRecord = namedtuple('CheckpointRecord', 'sequence hash repetition index iterations started time')
+
+
+#Fingerprint of what a routine does: steps, positions of all axes, delays, loops and repetitions.
+#Planned move times and names don't count, they may change without changing the routine.
+def routine_hash(routine: CompiledRoutine) -> bytes:
+    digest = hashlib.sha256()
+    digest.update(struct.pack("<IQ", routine.repetitions, len(routine)))
+    digest.update(bytes(routine.kind))
+    digest.update(array('q', routine.x).tobytes())
+    digest.update(array('q', routine.y).tobytes())
+    digest.update(array('d', (d if k == DELAY else 0 for k, d in zip(routine.kind, routine.dwell))).tobytes())
+    digest.update(array('q', routine.counts).tobytes())
+    for name in sorted(routine.optional):
+        digest.update(name.encode())
+        digest.update(array('q', routine.positions[name]).tobytes())
+    return digest.digest()
+
+
+class Checkpoint(object):
+    """Progress of the running routine in a small file that survives a crash.
+
+    Records are written alternately into two fixed slots of the file, each
+    with a sequence number and a checksum, so a torn write never destroys
+    the previous record. Writing one is a seek and a write of ~130 bytes,
+    fsync happens at most every ``sync_interval`` seconds. A copy of the
+    routine itself can be kept next to it at ``routine_path``.
+    """
+
+    def __init__(self, path: str, sync_interval: float = SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self._fd = None
+        self._hash = b''
+        self._sequence = 0
+        self._started = 0.0
+        self._synced = 0.0
+
+    @property
+    def routine_path(self) -> str:
+        return self.path + BINARY_SUFFIX
+
+    @property
+    def active(self) -> bool:
+        return self._fd is not None
+
+    #Start recording a run of the routine with the given routine_hash whose loops are nested depth deep.
+    #Raises ValueError if that is deeper than a record keeps, its steps could not be placed on resuming.
+    def start(self, digest: bytes, depth: int = 0) -> None:
+        if depth > MAX_DEPTH:
+            raise ValueError("Loops nested deeper than %s can not be resumed" %MAX_DEPTH)
+        self.close()
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0))
+        self._hash = digest
+        self._sequence = 0
+        self._started = time.time()
+        self._synced = time.monotonic()
+
+    #Record that step index of repetition starts now, inside loops at the given iterations
+    def record(self, repetition: int, index: int, iterations: Tuple[int, ...] = ()) -> None:
+        if self._fd is None:
+            return
+        depth = min(len(iterations), MAX_DEPTH)
+        loops = tuple(iterations[:depth]) + (0,) * (MAX_DEPTH - depth)
+        self._sequence += 1
+        body = CHECKPOINT_RECORD.pack(CHECKPOINT_MAGIC, self._sequence, self._hash, repetition, index, depth,
+                                      self._started, time.time(), *loops)
+        os.lseek(self._fd, (self._sequence % 2) * RECORD_SIZE, os.SEEK_SET)
+        os.write(self._fd, body + CHECKPOINT_CRC.pack(zlib.crc32(body)))
+        now = time.monotonic()
+        if now - self._synced >= self.sync_interval:
+            os.fsync(self._fd)
+            self._synced = now
+
+    #Stop recording, the files are removed unless keep is set
+    def finish(self, keep: bool = False) -> None:
+        if self._fd is not None and keep:
+            os.fsync(self._fd)
+        self.close()
+        if not keep:
+            self.discard()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    #Remove the checkpoint and the routine copy
+    def discard(self) -> None:
+        for path in (self.path, self.routine_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    #Latest valid record of the checkpoint file, None if there is none
+    def read(self) -> Optional[CheckpointRecord]:
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read(2 * RECORD_SIZE)
+        except OSError:
+            return None
+        latest = None
+        for offset in range(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            body = data[offset:offset + CHECKPOINT_RECORD.size]
+            crc, = CHECKPOINT_CRC.unpack_from(data, offset + CHECKPOINT_RECORD.size)
+            if zlib.crc32(body) != crc:
+                continue
+            magic, sequence, digest, repetition, index, depth, started, at, *loops = CHECKPOINT_RECORD.unpack(body)
+            if magic != CHECKPOINT_MAGIC:
+                continue
+            if latest is None or sequence > latest.sequence:
+                latest = CheckpointRecord(sequence, digest, repetition, index, tuple(loops[:depth]), started, at)
+        return latest
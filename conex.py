@@ -0,0 +1,656 @@
+import asyncio
+import logging
+import os
+import threading
+import math
+import time
+from collections import deque, namedtuple
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+
+#Every CONEX command and reply ends with carriage return + line feed
+TERMINATOR = b'\r\n'
+
+#Time to wait for a reply (in s) before the query is sent again
+QUERY_TIMEOUT = 0.2
+QUERY_TIMEOUTS = {
+    'PA': 0.1,
+    'TP': 0.1,
+    'TS': 0.1,
+}
+QUERY_RETRIES = 2
+
+#Longest reply line (in bytes), longer runs without a terminator are dropped as noise
+MAX_REPLY = 256
+
+#Controller states (last two characters of a TS reply) in which an axis is ready for the next move
+READY_STATES = ('32', '33', '34', '35', '36', '37', '38')
+#Names of the controller states for messages
+STATE_NAMES = {
+    '0A': 'not referenced', '0B': 'not referenced', '0C': 'not referenced', '0D': 'not referenced',
+    '0E': 'not referenced', '0F': 'not referenced', '10': 'not referenced', '14': 'configuring',
+    '1E': 'homing', '28': 'moving', '3C': 'disabled', '3D': 'disabled', '46': 'jogging',
+}
+
+#Time (in s) a controller may take to answer after its port was opened, e.g. while it starts up
+CONNECT_TIMEOUT = 5
+
+#Commands per second a controller is sent at most, and how many may go out at once after a pause
+COMMAND_RATE = 1000
+COMMAND_BURST = 20
+#Most commands waiting to be written to one controller
+QUEUE_DEPTH = 64
+
+#Settling of a move: allowed deviation from the target (in mm), time between polls and the maximum time (in s)
+POSITION_TOLERANCE = 0.0001
+SETTLE_INTERVAL = 0.01
+SETTLE_TIMEOUT = 30
+
+
+class ConexError(Exception):
+    pass
+
+
+class QueryTimeout(ConexError):
+    pass
+
+
+class QueueFull(ConexError):
+    pass
+
+
+#The port of the controller is closed, nothing sent to it arrives
+class NotConnected(ConexError):
+    pass
+
+
+#Characters of the controller address in front of a mnemonic
+ADDRESS_CHARS = "0123456789 "
+
+
+#Return the two letter mnemonic of a command or reply, e.g. '1PA?' -> 'PA'
+def mnemonic(text: str) -> str:
+    return text.lstrip(ADDRESS_CHARS)[:2].upper()
+
+
+#Return the number following the mnemonic of a reply, e.g. '1TP12.5' -> 12.5
+def reply_value(text: str) -> float:
+    return float(text.lstrip(ADDRESS_CHARS)[2:])
+
+
+#Replies carrying text instead of a number
+TEXT_REPLIES = ('VE', 'ID')
+
+
+class Reply(namedtuple('Reply', 'address mnemonic value text')):
+    """One decoded controller reply.
+
+    address is 0 if the reply has none, value is the number following the
+    mnemonic (NaN if there is none). TS replies carry the error bits in value
+    and the state in text, TE the error code in text, VE and ID their text.
+    """
+
+    __slots__ = ()
+
+    def __str__(self) -> str:
+        address = self.address or ''
+        if self.mnemonic == 'TS':
+            return "%sTS%04X%s" %(address, 0 if math.isnan(self.value) else int(self.value), self.text)
+        if self.mnemonic in TEXT_REPLIES:
+            return "%s%s %s" %(address, self.mnemonic, self.text)
+        if self.text:
+            return "%s%s%s" %(address, self.mnemonic, self.text)
+        return "%s%s%.6f" %(address, self.mnemonic, self.value)
+
+
+#Two letter texts (mnemonics and states) by their two bytes, so every reply shares the same str objects
+_pairs: Dict[int, str] = {}
+
+
+def _pair(key: int) -> str:
+    text = _pairs[key] = chr(key >> 8) + chr(key & 0xFF)
+    return text
+
+
+#Build a Reply from a tuple without the keyword handling of Reply()
+def _reply(fields: tuple, _new=tuple.__new__) -> Reply:
+    return _new(Reply, fields)
+
+
+#Decode the reply in line[start:end] (bytes like, without terminator), None if it is too short to hold a mnemonic
+def parse_reply(line, start: int = 0, end: Optional[int] = None) -> Optional[Reply]:
+    if end is None:
+        end = len(line)
+    while end > start and line[end - 1] in (13, 32):
+        end -= 1
+    if end - start < 2:
+        return None
+    c = line[start]
+    if 48 <= c <= 57 and line[start + 1] > 64:
+        #single digit address, the usual case
+        address = c - 48
+        start += 1
+    else:
+        address = 0
+        while start < end:
+            c = line[start]
+            if c > 57 or (c < 48 and c != 32):
+                break
+            if c != 32:
+                address = address * 10 + c - 48
+            start += 1
+        if end - start < 2:
+            return None
+    #upper case of both letters
+    key = (line[start] << 8 | line[start + 1]) & 0xDFDF
+    name = _pairs.get(key) or _pair(key)
+    start += 2
+    if name == 'TS':
+        if end - start < 6:
+            return _reply((address, name, math.nan, ''))
+        try:
+            value = int(bytes(line[start:start + 4]), 16)
+        except ValueError:
+            value = math.nan
+        key = line[start + 4] << 8 | line[start + 5]
+        return _reply((address, name, value, _pairs.get(key) or _pair(key)))
+    if name == 'TE':
+        return _reply((address, name, math.nan, chr(line[start]) if end > start else ''))
+    if name in TEXT_REPLIES:
+        return _reply((address, name, math.nan, bytes(line[start:end]).decode(errors='replace').strip()))
+    try:
+        return _reply((address, name, float(line[start:end]), ''))
+    except ValueError:
+        return _reply((address, name, math.nan, ''))
+
+
+class ReplyParser(object):
+    """Incremental framing of the byte stream of a controller into Reply records.
+
+    Bytes are collected in one reusable buffer and split at the terminator
+    through memoryview slices, so a chunk holding any number of replies is
+    decoded without copying or decoding it to text first.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.garbled = 0
+
+    #Add received bytes, returns the replies they complete
+    def feed(self, data) -> List[Reply]:
+        buffer = self.buffer
+        buffer += data
+        replies = []
+        start = 0
+        with memoryview(buffer) as view:
+            while True:
+                end = buffer.find(TERMINATOR, start)
+                if end < 0:
+                    break
+                reply = parse_reply(view, start, end)
+                if reply is not None:
+                    replies.append(reply)
+                elif end > start:
+                    self.garbled += 1
+                start = end + len(TERMINATOR)
+        if len(buffer) - start > MAX_REPLY:
+            self.garbled += 1
+            start = len(buffer)
+        if start:
+            del buffer[:start]
+        return replies
+
+
+class LatencyStats(object):
+    """Time between bytes arriving on a port and the parsed message being handed on."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, ns: int) -> None:
+        self.count += 1
+        self.total_ns += ns
+        if ns > self.max_ns:
+            self.max_ns = ns
+
+    @property
+    def mean_us(self) -> float:
+        if not self.count:
+            return 0.0
+        return self.total_ns / self.count / 1000
+
+    def __str__(self) -> str:
+        return "%s messages, mean %.1f us, max %.1f us" %(self.count, self.mean_us, self.max_ns / 1000)
+
+
+class WriteQueue(object):
+    """Outbound commands of one port, written without blocking the event loop.
+
+    Commands are written right away while the port takes them, otherwise
+    they wait in order and ``loop.add_writer`` resumes writing once the port
+    is writable again. A token bucket lets at most ``rate`` commands per
+    second (``burst`` at once) through, and no more than ``depth`` commands
+    may wait, beyond that ``put`` raises QueueFull. How long commands waited
+    is collected in ``wait``. Ports without a file descriptor are written
+    directly.
+
+    Several controllers sharing the port (see Controller.address) put their
+    commands under their own key: every key has its own depth and the keys
+    take turns, so a busy controller does not hold up the others.
+    """
+
+    def __init__(self, port, name: str, rate: float = COMMAND_RATE, burst: int = COMMAND_BURST,
+                 depth: int = QUEUE_DEPTH, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.port = port
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.depth = depth
+        self.wait = LatencyStats()
+        self.dropped = 0
+        self.peak = 0
+        self._loop = loop
+        self._queues: Dict[object, Deque[Tuple[bytes, int]]] = {}
+        #keys with waiting commands in the order they get their turn
+        self._turns: Deque[object] = deque()
+        self._count = 0
+        #key of a command that is only partly written, it has to be finished first
+        self._partial = None
+        self._tokens = float(burst)
+        self._refilled = time.monotonic()
+        self._fd = None
+        self._timer = None
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def __len__(self) -> int:
+        return self._count
+
+    #Queue data for writing, depth overrides the maximum number of waiting commands for this one,
+    #e.g. 1 to drop jog commands while the previous one still waits
+    def put(self, data, depth: Optional[int] = None, key=None) -> None:
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+        if len(queue) >= (self.depth if depth is None else depth):
+            self.dropped += 1
+            raise QueueFull("%s - Axis is busy, command dropped" %self.name)
+        queue.append((bytes(data), time.perf_counter_ns()))
+        if len(queue) == 1:
+            self._turns.append(key)
+        self._count += 1
+        if self._count > self.peak:
+            self.peak = self._count
+        if self._fd is None and self._timer is None:
+            self._drain()
+
+    #Drop the waiting commands of key (all if None), e.g. before the port is closed.
+    #A partly written command is still finished, so the line is not left broken.
+    def clear(self, key=None) -> None:
+        keys = list(self._queues) if key is None else [key]
+        for key in keys:
+            queue = self._queues.get(key)
+            if not queue:
+                continue
+            keep = 1 if key == self._partial else 0
+            self._count -= len(queue) - keep
+            while len(queue) > keep:
+                queue.pop()
+            if not keep:
+                self._turns.remove(key)
+        if not self._count:
+            self._unwatch()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def __str__(self) -> str:
+        return "waited %s, peak depth %s, %s dropped" %(self.wait, self.peak, self.dropped)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    #Write waiting commands while tokens are left and the port takes them, one command per key in turn
+    def _drain(self) -> None:
+        self._refill()
+        turns = self._turns
+        try:
+            fd = self.port.fileno()
+        except (AttributeError, OSError, NotImplementedError):
+            fd = None
+        while turns and self._tokens >= 1:
+            key = turns[0]
+            queue = self._queues[key]
+            data, queued = queue[0]
+            if fd is None:
+                self.port.write(data)
+            else:
+                try:
+                    written = os.write(fd, data)
+                except BlockingIOError:
+                    written = 0
+                if written < len(data):
+                    #the rest goes out once the port is writable again
+                    queue[0] = (data[written:], queued)
+                    self._partial = key
+                    self._watch(fd)
+                    return
+            self._partial = None
+            queue.popleft()
+            self._count -= 1
+            turns.popleft()
+            if queue:
+                turns.append(key)
+            self._tokens -= 1
+            self.wait.add(time.perf_counter_ns() - queued)
+        self._unwatch()
+        if turns:
+            self._timer = self.loop.call_later((1 - self._tokens) / self.rate, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._drain()
+
+    def _watch(self, fd: int) -> None:
+        if self._fd != fd:
+            self._unwatch()
+            self.loop.add_writer(fd, self._drain)
+            self._fd = fd
+
+    def _unwatch(self) -> None:
+        if self._fd is not None:
+            self.loop.remove_writer(self._fd)
+            self._fd = None
+
+
+class _Watch(object):
+    def __init__(self, port, callback):
+        self.port = port
+        self.callback = callback
+        self.parser = ReplyParser()
+        self.latency = LatencyStats()
+        self.thread = None
+        self.fd = None
+
+
+class SerialReader(object):
+    """Event driven reader that serves any number of serial ports from one event loop.
+
+    Ports exposing a file descriptor are registered with ``loop.add_reader`` so
+    nothing runs until bytes arrive. Ports without one (COM ports on Windows)
+    get a helper thread blocking in ``read()``, which hands the bytes over to
+    the loop. Either way the bytes are framed by a ReplyParser of the port and
+    every Reply is passed to its callback.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop
+        self._watches: Dict[str, _Watch] = {}
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    #Start watching an opened port, callback receives every Reply
+    def add(self, name: str, port, callback: Callable[[Reply], None]) -> None:
+        self.remove(name)
+        watch = _Watch(port, callback)
+        self._watches[name] = watch
+        try:
+            watch.fd = port.fileno()
+        except (AttributeError, OSError, NotImplementedError):
+            watch.fd = None
+        if watch.fd is not None:
+            try:
+                self.loop.add_reader(watch.fd, self._on_readable, name)
+                return
+            except NotImplementedError:
+                watch.fd = None
+        watch.thread = threading.Thread(target=self._read_blocking, args=(name, watch), daemon=True)
+        watch.thread.start()
+
+    #Stop watching a port, call this before closing it
+    def remove(self, name: str) -> None:
+        watch = self._watches.pop(name, None)
+        if watch is None:
+            return
+        if watch.fd is not None:
+            self.loop.remove_reader(watch.fd)
+        elif watch.thread is not None and hasattr(watch.port, 'cancel_read'):
+            watch.port.cancel_read()
+
+    def latency(self, name: str) -> LatencyStats:
+        return self._watches[name].latency
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._watches
+
+    def _on_readable(self, name: str) -> None:
+        watch = self._watches.get(name)
+        if watch is None:
+            return
+        arrival = time.perf_counter_ns()
+        try:
+            data = watch.port.read(watch.port.in_waiting or 1)
+        except Exception as e:
+            log.warning('Reading %s failed: %s', name, e)
+            self.remove(name)
+            return
+        self._feed(watch, data, arrival)
+
+    def _read_blocking(self, name: str, watch: _Watch) -> None:
+        watch.port.timeout = None
+        while self._watches.get(name) is watch and watch.port.is_open:
+            try:
+                data = watch.port.read(1)
+                if watch.port.in_waiting:
+                    data += watch.port.read(watch.port.in_waiting)
+            except Exception:
+                break
+            if data:
+                self.loop.call_soon_threadsafe(self._feed, watch, data, time.perf_counter_ns())
+
+    def _feed(self, watch: _Watch, data: bytes, arrival: int) -> None:
+        for reply in watch.parser.feed(data):
+            watch.latency.add(time.perf_counter_ns() - arrival)
+            watch.callback(reply)
+
+
+class Controller(object):
+    """CONEX controller on a serial port with replies correlated to the queries asking for them.
+
+    Every query returns when the next reply carrying the same mnemonic
+    arrives, queries of one mnemonic are answered in the order they were sent.
+    Replies have to be passed in through ``feed``. Commands go out through
+    ``queue``, a WriteQueue on the port unless another one is given. With an
+    ``address`` every command line is prefixed with it, so several daisy
+    chained controllers can share a port and its queue.
+    """
+
+    def __init__(self, port, name: str, queue: Optional[WriteQueue] = None, address: Optional[int] = None):
+        self.port = port
+        self.name = name
+        self.queue = queue if queue is not None else WriteQueue(port, name)
+        self.address = address
+        self._prefix = b'%d' %address if address is not None else b''
+        self._pending: Dict[str, Deque[asyncio.Future]] = {}
+        #monotonic ns the last reply of every mnemonic was fed in, e.g. to time a TP reading by its arrival
+        self.arrived: Dict[str, int] = {}
+
+    def write(self, msg: str, depth: Optional[int] = None) -> None:
+        self.send(msg.encode(), depth)
+
+    #Queue an already encoded command, see WriteQueue.put for depth
+    def send(self, data, depth: Optional[int] = None) -> None:
+        if not self.port.is_open:
+            raise NotConnected("%s - Axis is not connected" %self.name)
+        if self._prefix:
+            prefix = self._prefix
+            data = TERMINATOR.join(prefix + line if line else line for line in bytes(data).split(TERMINATOR))
+        self.queue.put(data, depth, self)
+
+    #Send a command expecting a reply and wait for it, e.g. await query('PA?')
+    async def query(self, command: str, timeout: Optional[float] = None, retries: int = QUERY_RETRIES) -> Reply:
+        key = mnemonic(command)
+        if timeout is None:
+            timeout = QUERY_TIMEOUTS.get(key, QUERY_TIMEOUT)
+        waiting = self._pending.setdefault(key, deque())
+        for attempt in range(retries + 1):
+            future = asyncio.get_event_loop().create_future()
+            waiting.append(future)
+            try:
+                self.write(command + '\r\n')
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if not future.done():
+                    future.cancel()
+                    waiting.remove(future)
+        raise QueryTimeout("%s - Axis did not answer %s" %(self.name, command))
+
+    #Query TS and return whether the controller is ready for the next move
+    async def is_ready(self) -> bool:
+        reply = await self.query('TS')
+        return reply.text in READY_STATES
+
+    #Query TP and return the current position in mm
+    async def position(self) -> float:
+        return (await self.query('TP')).value
+
+    #Resolve the oldest query waiting for this reply, returns False if nobody asked for it
+    def feed(self, reply: Reply) -> bool:
+        self.arrived[reply.mnemonic] = time.monotonic_ns()
+        waiting = self._pending.get(reply.mnemonic)
+        while waiting:
+            future = waiting.popleft()
+            if not future.done():
+                future.set_result(reply)
+                return True
+        return False
+
+    #Drop waiting commands and fail all waiting queries, e.g. when the port is closed
+    def cancel(self) -> None:
+        self.queue.clear(self)
+        for waiting in self._pending.values():
+            while waiting:
+                future = waiting.popleft()
+                if not future.done():
+                    future.set_exception(NotConnected("%s - Axis disconnected" %self.name))
+        self._pending.clear()
+
+
+class MoveResult(object):
+    """Outcome of a coordinated move, times are monotonic ns.
+
+    ``settled`` maps every controller to the moment it was found settled on
+    its target, or None if it did not settle within the timeout.
+    """
+
+    def __init__(self, started: int, settled: Dict[Controller, Optional[int]]):
+        self.started = started
+        self.settled = settled
+
+    @property
+    def done(self) -> bool:
+        return None not in self.settled.values()
+
+    #Time from sending the commands until the slowest axis settled
+    @property
+    def duration_ns(self) -> int:
+        return max(t for t in self.settled.values() if t is not None) - self.started if self.done else 0
+
+    #Time between the first and the last axis settling
+    @property
+    def skew_ns(self) -> int:
+        times = self.settled.values()
+        return max(times) - min(times) if self.done and times else 0
+
+
+#Poll TS and TP of one controller until it is ready within tolerance of target (in mm).
+#Returns the monotonic ns it settled at, or None if that did not happen before deadline (loop time in s).
+async def settle(control: Controller, target: float, deadline: float, tolerance: float = POSITION_TOLERANCE,
+                 interval: float = SETTLE_INTERVAL) -> Optional[int]:
+    loop = asyncio.get_event_loop()
+    while True:
+        ready, position = await asyncio.gather(control.is_ready(), control.position())
+        if ready and abs(position - target) <= tolerance:
+            return time.monotonic_ns()
+        if loop.time() + interval > deadline:
+            return None
+        await asyncio.sleep(interval)
+
+
+#Send every command of moves ({controller: (command, target in mm)}) back to back, then track each axis
+#until it settled on its target. Returns when the slowest axis settled or timeout (in s) passed.
+async def move_together(moves: Dict[Controller, tuple], tolerance: float = POSITION_TOLERANCE,
+                        timeout: float = SETTLE_TIMEOUT, interval: float = SETTLE_INTERVAL) -> MoveResult:
+    controllers = list(moves)
+    for control in controllers:
+        control.send(moves[control][0])
+    started = time.monotonic_ns()
+    deadline = asyncio.get_event_loop().time() + timeout
+    times = await asyncio.gather(*(settle(c, moves[c][1], deadline, tolerance, interval) for c in controllers))
+    return MoveResult(started, dict(zip(controllers, times)))
+
+
+#Name of a controller state, e.g. '1E' -> 'homing'
+def state_name(state: str) -> str:
+    if state in READY_STATES:
+        return 'ready'
+    return STATE_NAMES.get(state, 'in state %s' %state)
+
+
+#Query VE until the controller answers, e.g. while it starts up after its port was opened.
+#Returns the version reply, raises QueryTimeout if there was none within timeout (in s).
+async def probe(control: Controller, timeout: float = CONNECT_TIMEOUT) -> Reply:
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while True:
+        try:
+            return await control.query('VE', retries=0)
+        except QueryTimeout:
+            if loop.time() >= deadline:
+                raise QueryTimeout("%s - Axis did not answer within %s s" %(control.name, timeout))
+
+
+#Poll TS until the controller is ready, e.g. after homing. Returns False if that did not happen within timeout (in s).
+#on_state is called with every state the controller reports that differs from the one before.
+async def wait_ready(control: Controller, timeout: float = SETTLE_TIMEOUT, interval: float = SETTLE_INTERVAL,
+                     on_state: Optional[Callable[[str], None]] = None) -> bool:
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    state = None
+    while True:
+        await asyncio.sleep(interval)
+        reply = await control.query('TS')
+        if reply.text != state:
+            state = reply.text
+            if on_state is not None:
+                on_state(state)
+        if state in READY_STATES:
+            return True
+        if loop.time() + interval > deadline:
+            return False
+
+
+#Poll TS and TP of all controllers until every one is ready and within tolerance of its target (in mm).
+#Returns False if that did not happen within timeout (in s).
+async def wait_settled(targets: Dict[Controller, float], tolerance: float = POSITION_TOLERANCE,
+                       timeout: float = SETTLE_TIMEOUT, interval: float = SETTLE_INTERVAL) -> bool:
+    deadline = asyncio.get_event_loop().time() + timeout
+    times = await asyncio.gather(*(settle(c, t, deadline, tolerance, interval) for c, t in targets.items()))
+    return None not in times
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import heapq
+import os
+import random
+import selectors
+import threading
+import time
+import tty
+from typing import Dict, List, Optional
+
+from conex import ADDRESS_CHARS, READY_STATES, TERMINATOR
+from motion import AxisModel, STAGE_MAX, STAGE_MIN
+
+
+#Motion of an emulated stage when nothing else is given
+EMULATED_MOTION = AxisModel(velocity=0.4, acceleration=2.0, settle=0.02)
+
+#Controller states as the last two characters of a TS reply
+NOT_REFERENCED = '0A'
+HOMING = '1E'
+MOVING = '28'
+READY_HOMING = '32'
+READY_MOVING = '33'
+DISABLED = '3C'
+READY_DISABLE = '36'
+
+#Error codes as replied to TE
+NO_ERROR = '@'
+UNKNOWN_COMMAND = 'A'
+PARAMETER_OUT_OF_RANGE = 'C'
+NOT_ALLOWED = 'H'
+
+VERSION = "CONEX-AGP Emulator 1.0"
+
+
+class EmulatedAxis(object):
+    """State of one emulated CONEX controller and its stage, positions in mm.
+
+    Moves follow ``motion`` from the time they were commanded, the position
+    is worked out when asked for, so nothing runs between commands.
+    """
+
+    def __init__(self, motion: AxisModel = EMULATED_MOTION, position: float = 0.0):
+        self.motion = motion
+        self.low = STAGE_MIN
+        self.high = STAGE_MAX
+        self.state = NOT_REFERENCED
+        self.error = NO_ERROR
+        self.start = position
+        self.target = position
+        self.started = 0.0
+        self.finished = 0.0
+        self.done_state = NOT_REFERENCED
+
+    #Position at time now (time.monotonic)
+    def position(self, now: float) -> float:
+        if now >= self.finished:
+            return self.target
+        distance = self.target - self.start
+        elapsed = now - self.started
+        travel = self.motion.move_time(distance) - self.motion.settle
+        if elapsed >= travel:
+            return self.target
+        #constant velocity over the move is close enough for an emulation
+        return self.start + distance * elapsed / travel
+
+    #Current state, moves and homing end by themselves
+    def status(self, now: float) -> str:
+        if self.state in (MOVING, HOMING) and now >= self.finished:
+            self.state = self.done_state
+        return self.state
+
+    def _move(self, target: float, now: float, state: str = MOVING, done: str = READY_MOVING) -> None:
+        self.start = self.position(now)
+        self.target = target
+        self.started = now
+        self.finished = now + self.motion.move_time(target - self.start)
+        self.state = state
+        self.done_state = done
+
+    def _fail(self, error: str) -> None:
+        self.error = error
+
+    #Handle one command (without address), returns the reply without address or None
+    def command(self, text: str, now: float) -> Optional[str]:
+        name = text[:2].upper()
+        argument = text[2:].strip()
+        state = self.status(now)
+        try:
+            if name in ('OR', 'RF'):
+                #home search, RFH is the same here
+                if state in (DISABLED, MOVING, HOMING):
+                    return self._fail(NOT_ALLOWED)
+                self._move(0.0, now, HOMING, READY_HOMING)
+            elif name == 'MM':
+                if argument == '0':
+                    if state in READY_STATES:
+                        self.state = DISABLED
+                elif argument == '1':
+                    if state == DISABLED:
+                        self.state = READY_DISABLE
+                else:
+                    return self._fail(PARAMETER_OUT_OF_RANGE)
+            elif name in ('SR', 'SL'):
+                if argument == '?':
+                    return "%s%g" %(name, self.high if name == 'SR' else self.low)
+                if name == 'SR':
+                    self.high = float(argument)
+                else:
+                    self.low = float(argument)
+            elif name in ('PA', 'PR'):
+                if argument == '?':
+                    return "PA%.6f" %self.target
+                if state not in READY_STATES and state != MOVING:
+                    return self._fail(NOT_ALLOWED)
+                value = float(argument)
+                target = value if name == 'PA' else self.target + value
+                if not self.low <= target <= self.high:
+                    return self._fail(PARAMETER_OUT_OF_RANGE)
+                self._move(target, now)
+            elif name == 'TP':
+                return "TP%.6f" %self.position(now)
+            elif name == 'TS':
+                return "TS0000%s" %state
+            elif name == 'TE':
+                error, self.error = self.error, NO_ERROR
+                return "TE%s" %error
+            elif name == 'ST':
+                if state in (MOVING, HOMING):
+                    self.target = self.start = self.position(now)
+                    self.finished = now
+                    self.state = READY_MOVING if state == MOVING else NOT_REFERENCED
+            elif name == 'VA':
+                if argument == '?':
+                    return "VA%.6f" %self.motion.velocity
+                velocity = float(argument)
+                if velocity <= 0:
+                    return self._fail(PARAMETER_OUT_OF_RANGE)
+                self.motion = AxisModel(velocity, self.motion.acceleration, self.motion.settle)
+            elif name == 'VE':
+                return "VE %s" %VERSION
+            elif name == 'ID':
+                return "ID %s" %VERSION
+            else:
+                return self._fail(UNKNOWN_COMMAND)
+        except ValueError:
+            return self._fail(PARAMETER_OUT_OF_RANGE)
+        return None
+
+
+class ConexEmulator(object):
+    """Emulated CONEX controllers on one pseudo terminal, for testing and benchmarking without hardware.
+
+    ``path`` is the device to open like any serial port. Commands are
+    routed to the axis of their address (1 if there is none). Replies go
+    out ``latency`` s after the command, no faster than ``baudrate`` allows
+    (10 bits per byte, None for unlimited). Faults: ``drop_rate`` and
+    ``garble_rate`` are the chances a reply is lost or has a corrupted byte,
+    ``stall`` makes the controller ignore everything for a while. Runs in a
+    thread of its own, so it does not share the event loop of ACI.
+    """
+
+    def __init__(self, axes: Optional[Dict[int, EmulatedAxis]] = None, latency: float = 0.0,
+                 baudrate: Optional[int] = None, drop_rate: float = 0.0, garble_rate: float = 0.0,
+                 seed: Optional[int] = None):
+        self.axes = axes if axes is not None else {1: EmulatedAxis()}
+        self.latency = latency
+        self.baudrate = baudrate
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        self.commands = 0
+        self.replies = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._stalled_until = 0.0
+        self._buffer = bytearray()
+        self._outgoing: List[tuple] = []
+        self._line_free = 0.0
+        self._sequence = 0
+        self._wake_read, self._wake_write = os.pipe()
+        self._running = False
+        self._thread = None
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+
+    #Ignore all commands for the next seconds
+    def stall(self, seconds: float) -> None:
+        self._stalled_until = time.monotonic() + seconds
+
+    def start(self) -> 'ConexEmulator':
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self) -> None:
+        self._running = False
+        os.write(self._wake_write, b'x')
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self.master, self.slave, self._wake_read, self._wake_write):
+            os.close(fd)
+
+    def __enter__(self) -> 'ConexEmulator':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _serve(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self.master, selectors.EVENT_READ)
+        selector.register(self._wake_read, selectors.EVENT_READ)
+        while self._running:
+            timeout = None
+            if self._outgoing:
+                timeout = max(self._outgoing[0][0] - time.monotonic(), 0)
+            for key, _ in selector.select(timeout):
+                if key.fd == self.master:
+                    try:
+                        self._receive(os.read(self.master, 4096))
+                    except (BlockingIOError, OSError):
+                        pass
+            self._send_due()
+        selector.close()
+
+    def _receive(self, data: bytes) -> None:
+        now = time.monotonic()
+        buffer = self._buffer
+        buffer += data
+        start = 0
+        while True:
+            end = buffer.find(TERMINATOR, start)
+            if end < 0:
+                break
+            line = buffer[start:end].decode(errors='replace').strip()
+            start = end + len(TERMINATOR)
+            if line and now >= self._stalled_until:
+                self._handle(line, now)
+        del buffer[:start]
+
+    def _handle(self, line: str, now: float) -> None:
+        self.commands += 1
+        text = line.lstrip(ADDRESS_CHARS)
+        prefix = line[:len(line) - len(text)].strip()
+        address = int(prefix) if prefix else 1
+        axis = self.axes.get(address)
+        if axis is None:
+            return
+        reply = axis.command(text, now)
+        if reply is None:
+            return
+        if self._random.random() < self.drop_rate:
+            self.dropped += 1
+            return
+        data = ("%s%s" %(address, reply)).encode()
+        if self._random.random() < self.garble_rate:
+            data = bytearray(data)
+            data[self._random.randrange(len(data))] = self._random.randrange(33, 127)
+            data = bytes(data)
+        data += TERMINATOR
+        due = now + self.latency
+        if self.baudrate:
+            due = max(due, self._line_free) + len(data) * 10 / self.baudrate
+            self._line_free = due
+        self._sequence += 1
+        heapq.heappush(self._outgoing, (due, self._sequence, data))
+
+    def _send_due(self) -> None:
+        now = time.monotonic()
+        while self._outgoing and self._outgoing[0][0] <= now:
+            _, _, data = heapq.heappop(self._outgoing)
+            try:
+                os.write(self.master, data)
+                self.replies += 1
+            except (BlockingIOError, OSError):
+                self.dropped += 1
+
+
+#Query port (a path) back to back for seconds and print replies per second and the round trip time
+async def benchmark(path: str, seconds: float = 5.0, command: str = 'TP') -> None:
+    from serial import Serial
+    from conex import Controller, LatencyStats, SerialReader
+    port = Serial(path, timeout=0)
+    reader = SerialReader()
+    control = Controller(port, 'emulator')
+    reader.add('emulator', port, control.feed)
+    rtt = LatencyStats()
+    end = time.monotonic() + seconds
+    count = 0
+    while time.monotonic() < end:
+        sent = time.perf_counter_ns()
+        await control.query(command)
+        rtt.add(time.perf_counter_ns() - sent)
+        count += 1
+    reader.remove('emulator')
+    port.close()
+    print("%s: %.0f replies/s, round trip %s" %(command, count / seconds, rtt))
+
+
+#Decode count replies (TP, TS, TE, PA and VE mixed) arriving in chunks of chunk bytes and print replies per second
+def benchmark_parser(count: int = 1000000, chunk: int = 4096) -> None:
+    from conex import ReplyParser
+    replies = [b"1TP12.345678\r\n", b"1TS000033\r\n", b"1TE@\r\n", b"1PA24.194633\r\n", b"1VE %s\r\n" %VERSION.encode()]
+    stream = b"".join(replies) * (count // len(replies))
+    parser = ReplyParser()
+    decoded = 0
+    started = time.perf_counter()
+    for start in range(0, len(stream), chunk):
+        decoded += len(parser.feed(stream[start:start + chunk]))
+    elapsed = time.perf_counter() - started
+    print("Parser: %s replies in %.3f s, %.0f replies/s, %s garbled" %(decoded, elapsed, decoded / elapsed, parser.garbled))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulated CONEX controllers on pseudo terminals")
+    parser.add_argument('--ports', type=int, default=2, help="number of emulated ports")
+    parser.add_argument('--latency', type=float, default=0.0, help="reply latency in ms")
+    parser.add_argument('--baudrate', type=int, default=None, help="limit replies to this baud rate")
+    parser.add_argument('--velocity', type=float, default=EMULATED_MOTION.velocity, help="in mm/s")
+    parser.add_argument('--acceleration', type=float, default=EMULATED_MOTION.acceleration, help="in mm/s^2")
+    parser.add_argument('--settle', type=float, default=EMULATED_MOTION.settle * 1000, help="in ms")
+    parser.add_argument('--drop', type=float, default=0.0, help="chance a reply is lost")
+    parser.add_argument('--garble', type=float, default=0.0, help="chance a reply is corrupted")
+    parser.add_argument('--boot', type=float, default=0.0, help="ignore commands for this many ms after start, like a controller powering up")
+    parser.add_argument('--benchmark', type=float, default=0.0, help="query the first port for this many s")
+    parser.add_argument('--parser', type=int, default=0, help="only benchmark the reply parser with this many replies")
+    args = parser.parse_args()
+    if args.parser:
+        benchmark_parser(args.parser)
+        raise SystemExit
+    motion = AxisModel(args.velocity, args.acceleration, args.settle / 1000)
+    emulators = [ConexEmulator({1: EmulatedAxis(motion)}, args.latency / 1000, args.baudrate, args.drop, args.garble).start()
+                 for _ in range(args.ports)]
+    for emulator in emulators:
+        emulator.stall(args.boot / 1000)
+        print("Emulated controller on %s" %emulator.path)
+    try:
+        if args.benchmark:
+            asyncio.get_event_loop().run_until_complete(benchmark(emulators[0].path, args.benchmark))
+        else:
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for emulator in emulators:
+            emulator.close()
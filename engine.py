@@ -0,0 +1,381 @@
+import asyncio
+import time
+from collections import namedtuple
+from typing import Dict, Optional
+
+from conex import ConexError, Controller, LatencyStats, MoveResult, NotConnected, POSITION_TOLERANCE, SETTLE_TIMEOUT, move_together
+from checkpoint import Checkpoint, routine_hash
+from routine import DELAY, END, LOOP, CompiledRoutine, Routine, from_nm
+
+
+#Steps starting later than this after their deadline (in ms) are reported as late
+LATE_AFTER = 5
+
+#Most progress snapshots per second a ProgressBus passes on
+PROGRESS_RATE = 30
+
+#State of a running routine as a ProgressBus passes it on: the running step, the planned time (in ms)
+#at the end of the last finished step and of the whole routine, the number of late steps so far and
+#how many events the snapshot stands for
+ProgressSnapshot = namedtuple('ProgressSnapshot', 'repetition index elapsed total late_steps events')
+
+
+class RoutineListener(object):
+    """Receives the progress of a running routine, override the callbacks of interest."""
+
+    def routine_started(self, routine: CompiledRoutine) -> None:
+        pass
+
+    def repetition_started(self, repetition: int) -> None:
+        pass
+
+    def step_started(self, repetition: int, index: int) -> None:
+        pass
+
+    def step_finished(self, repetition: int, index: int) -> None:
+        pass
+
+    def step_late(self, repetition: int, index: int, late: float) -> None:
+        pass
+
+    def move_finished(self, repetition: int, index: int, result: MoveResult) -> None:
+        pass
+
+    def routine_finished(self, completed: bool) -> None:
+        pass
+
+    def message(self, text: str) -> None:
+        pass
+
+    #Coalesced progress, see ProgressBus
+    def progress(self, snapshot: ProgressSnapshot) -> None:
+        pass
+
+
+class ProgressBus(RoutineListener):
+    """Coalesces the step events of a routine into snapshots for a slow consumer, e.g. the GUI.
+
+    Step events only update the latest state, which is passed to
+    ``consumer.progress`` at most ``rate`` times per second from the event
+    loop, so the engine never waits for the consumer to draw. Start, end and
+    messages are passed on right away, a pending snapshot is delivered
+    before the end. Set ``engine`` to place steps inside loops correctly.
+    """
+
+    def __init__(self, consumer: RoutineListener, rate: float = PROGRESS_RATE):
+        self.consumer = consumer
+        self.interval = 1 / rate
+        self.engine = None
+        self.events = 0
+        self.snapshots = 0
+        self._timeline = None
+        self._pending = 0
+        self._handle = None
+        self._last = 0.0
+        self._state = (0, -1)
+        self._elapsed = 0.0
+        self._late = 0
+
+    #Events that were merged into another snapshot instead of causing their own
+    @property
+    def coalesced(self) -> int:
+        return self.events - self.snapshots
+
+    def routine_started(self, routine: CompiledRoutine) -> None:
+        self._timeline = routine.timeline
+        self.events = 0
+        self.snapshots = 0
+        self._state = (0, -1)
+        self._elapsed = 0.0
+        self._late = 0
+        self.consumer.routine_started(routine)
+
+    def repetition_started(self, repetition: int) -> None:
+        self._publish()
+
+    def step_started(self, repetition: int, index: int) -> None:
+        self._state = (repetition, index)
+        self._publish()
+
+    def step_finished(self, repetition: int, index: int) -> None:
+        iterations = self.engine.iterations if self.engine is not None else ()
+        self._elapsed = self._timeline.end_of(repetition, index, iterations)
+        self._publish()
+
+    def step_late(self, repetition: int, index: int, late: float) -> None:
+        self._late += 1
+        self._publish()
+
+    def move_finished(self, repetition: int, index: int, result: MoveResult) -> None:
+        self.consumer.move_finished(repetition, index, result)
+
+    def routine_finished(self, completed: bool) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._flush()
+        self.consumer.routine_finished(completed)
+
+    def message(self, text: str) -> None:
+        self.consumer.message(text)
+
+    #Count an event and make sure a snapshot follows within the interval
+    def _publish(self) -> None:
+        self.events += 1
+        self._pending += 1
+        if self._handle is None:
+            delay = max(self._last + self.interval - time.monotonic(), 0)
+            self._handle = asyncio.get_event_loop().call_later(delay, self._flush)
+
+    def _flush(self) -> None:
+        self._handle = None
+        self._last = time.monotonic()
+        repetition, index = self._state
+        self.snapshots += 1
+        events, self._pending = self._pending, 0
+        self.consumer.progress(ProgressSnapshot(repetition, index, self._elapsed, self._timeline.total, self._late, events))
+
+
+class Scheduler(object):
+    """Deadlines of routine steps on the monotonic clock.
+
+    Every deadline is the start of the routine plus the planned durations of
+    all steps before, so time spent between steps does not add up over a
+    run. Steps whose end is not planned (moves) re-anchor the schedule on
+    the moment they finished, early or late, a late one is reported as
+    such. Delays are never shortened to catch up, see plan_delay.
+    """
+
+    def __init__(self, late_after: float = LATE_AFTER):
+        self.late_after_ns = int(late_after * 1000000)
+        self.origin = 0
+        self.next = 0
+        self.late_steps = 0
+        self.max_late_ns = 0
+
+    def start(self) -> None:
+        self.origin = self.next = time.monotonic_ns()
+        self.late_steps = 0
+        self.max_late_ns = 0
+
+    #Count late (in ns) if it is more than late_after, returns it in ms if so, else 0
+    def _late(self, late: int) -> float:
+        if late <= self.late_after_ns:
+            return 0
+        self.late_steps += 1
+        if late > self.max_late_ns:
+            self.max_late_ns = late
+        return late / 1000000
+
+    #Call when a step starts, returns how late (in ms) it is if that is more than late_after, else 0
+    def begin(self) -> float:
+        return self._late(time.monotonic_ns() - self.next)
+
+    #Plan the running step to take duration ms, returns its deadline
+    def plan(self, duration: float) -> int:
+        self.next += int(duration * 1000000)
+        return self.next
+
+    #Plan a delay of duration ms, returns its deadline. It lasts at least duration even if the
+    #schedule is behind, the schedule then continues from its end.
+    def plan_delay(self, duration: float) -> int:
+        self.next = max(self.next, time.monotonic_ns()) + int(duration * 1000000)
+        return self.next
+
+    #Let the schedule continue from now after a step whose end is not planned, e.g. a move.
+    #Returns how far (in ms) it overran its deadline if that is more than late_after, else 0.
+    def reanchor(self) -> float:
+        now = time.monotonic_ns()
+        late = self._late(now - self.next)
+        self.next = now
+        return late
+
+    #Seconds till deadline, negative if it passed
+    @staticmethod
+    def remaining(deadline: int) -> float:
+        return (deadline - time.monotonic_ns()) / 1000000000
+
+
+class RoutineEngine(object):
+    """Runs routines on the event loop without any GUI.
+
+    ``axes`` are the controllers by axis name. Moves are sent to the axes of
+    the routine back to back and are done once the slowest axis settled on
+    its target, see CompiledRoutine.add_axis. How far apart the axes settled is
+    collected in ``skew``. Delays sleep until their deadline, see Scheduler.
+    With ``fixed_schedule`` moves also last until the end of their planned
+    dwell, so every step starts at a fixed time after the routine started
+    unless a move overruns its plan. Delays always last their full time.
+    With a ``checkpoint`` the start of every step is recorded, it is kept if
+    the run ends with an error and removed if it ends or is stopped. An axis
+    that is not connected ends the run with an error, other failed moves are
+    reported and the routine goes on.
+    ``stop`` ends the routine after the running step was interrupted.
+    """
+
+    def __init__(self, axes: Dict[str, Controller], listener: Optional[RoutineListener] = None,
+                 tolerance: float = POSITION_TOLERANCE, move_timeout: float = SETTLE_TIMEOUT,
+                 fixed_schedule: bool = False, checkpoint: Optional[Checkpoint] = None):
+        self.axes = axes
+        self.listener = listener if listener is not None else RoutineListener()
+        self.tolerance = tolerance
+        self.move_timeout = move_timeout
+        self.fixed_schedule = fixed_schedule
+        self.checkpoint = checkpoint
+        self.scheduler = Scheduler()
+        self.skew = LatencyStats()
+        self._stop = None
+        self._loops = []
+
+    @property
+    def running(self) -> bool:
+        return self._stop is not None and not self._stop.is_set()
+
+    def stop(self) -> None:
+        if self._stop is not None:
+            self._stop.set()
+
+    #Current iteration of every loop enclosing the running step, outermost first
+    @property
+    def iterations(self) -> tuple:
+        return tuple(iteration for loop, iteration in self._loops)
+
+    #Run all repetitions of routine, returns True if it was not stopped.
+    #start_at (in ms of the planned timeline) skips everything planned before it, resume
+    #(repetition, index, iterations as recorded in a checkpoint) everything before that step.
+    async def run(self, routine, start_at: float = 0, resume: Optional[tuple] = None) -> bool:
+        if isinstance(routine, Routine):
+            routine = routine.compile()
+        timeline = routine.timeline
+        if resume is not None:
+            first_repetition, first_index, first_iterations = resume
+        else:
+            first_repetition, first_index, first_iterations = timeline.locate(start_at)
+        kind = routine.kind
+        dwell = routine.dwell
+        counts = routine.counts
+        match = routine.match
+        count = len(kind)
+        self._stop = asyncio.Event()
+        listener = self.listener
+        scheduler = self.scheduler
+        checkpoint = self.checkpoint
+        if checkpoint is not None:
+            try:
+                checkpoint.start(routine_hash(routine), timeline.depth)
+            except (OSError, ValueError) as e:
+                listener.message("Progress is not saved: %s" %e)
+                checkpoint = None
+        listener.routine_started(routine)
+        scheduler.start()
+        self.skew = LatencyStats()
+        completed = True
+        failed = True
+        try:
+            for repetition in range(first_repetition, routine.repetitions):
+                listener.repetition_started(repetition)
+                index = 0
+                self._loops = []
+                if repetition == first_repetition:
+                    index = first_index
+                    self._loops = [[loop, iteration] for loop, iteration in zip(timeline.enclosing(index), first_iterations)]
+                while index < count:
+                    if self._stop.is_set():
+                        completed = False
+                        break
+                    k = kind[index]
+                    if k == LOOP:
+                        if counts[index] > 0:
+                            self._loops.append([index, 0])
+                            index += 1
+                        else:
+                            index = match[index] + 1
+                        continue
+                    if k == END:
+                        loop = self._loops[-1]
+                        loop[1] += 1
+                        if loop[1] < counts[loop[0]]:
+                            index = loop[0] + 1
+                        else:
+                            self._loops.pop()
+                            index += 1
+                        continue
+                    late = scheduler.begin()
+                    if late:
+                        listener.step_late(repetition, index, late)
+                    if checkpoint is not None:
+                        checkpoint.record(repetition, index, self.iterations)
+                    listener.step_started(repetition, index)
+                    if k == DELAY:
+                        await self._sleep_until(scheduler.plan_delay(dwell[index]))
+                    else:
+                        await self._move(routine, repetition, index, scheduler.plan(dwell[index]))
+                    listener.step_finished(repetition, index)
+                    index += 1
+                if not completed:
+                    break
+            if self._stop.is_set():
+                completed = False
+            failed = False
+        except NotConnected as e:
+            listener.message("%s, routine aborted" %e)
+            completed = False
+        finally:
+            self._stop.set()
+            if checkpoint is not None:
+                checkpoint.finish(keep=failed)
+            listener.routine_finished(completed)
+        return completed
+
+    #Sleep until deadline unless the routine is stopped earlier
+    async def _sleep_until(self, deadline: int) -> None:
+        remaining = self.scheduler.remaining(deadline)
+        if remaining <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._stop.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+    #Await coro, returns None right away if the routine is stopped meanwhile
+    async def _unless_stopped(self, coro):
+        task = asyncio.ensure_future(coro)
+        stopped = asyncio.ensure_future(self._stop.wait())
+        await asyncio.wait((task, stopped), return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+        if not task.done():
+            task.cancel()
+            return None
+        return task.result()
+
+    #Send all axes to the position of step index and wait until the slowest one settled there
+    async def _move(self, routine: CompiledRoutine, repetition: int, index: int, deadline: int) -> None:
+        try:
+            moves = {}
+            for name, commands in routine.commands.items():
+                command = commands[index]
+                if not command:
+                    if name in routine.optional:
+                        continue
+                    raise ValueError("%s has no valid position" %routine.names[index])
+                control = self.axes.get(name)
+                if control is None:
+                    raise ValueError("%s needs a %s - Axis" %(routine.names[index], name))
+                moves[control] = (command, from_nm(routine.positions[name][index]))
+            result = await self._unless_stopped(move_together(moves, tolerance=self.tolerance, timeout=self.move_timeout))
+            if result is not None:
+                if result.done:
+                    self.skew.add(result.skew_ns)
+                else:
+                    self.listener.message("%s not reached within %s s" %(routine.names[index], self.move_timeout))
+                self.listener.move_finished(repetition, index, result)
+        except NotConnected:
+            raise
+        except (ConexError, ValueError) as e:
+            self.listener.message(str(e))
+            await self._sleep_until(deadline)
+        if self.fixed_schedule:
+            await self._sleep_until(deadline)
+        else:
+            late = self.scheduler.reanchor()
+            if late:
+                self.listener.step_late(repetition, index, late)
@@ -0,0 +1,97 @@
+from array import array
+from typing import Collection, List, Tuple
+
+from routine import DELAY, MOVE, MOVE_TIME, NO_POSITION, to_nm
+
+
+Point = Tuple[float, float]
+
+
+class Grid(object):
+    """Parallelogram of sites, site (column, row) is at origin + column * column_pitch + row * row_pitch.
+
+    Positions and pitches are (x, y) in mm, columns and rows are counted from 0.
+    """
+
+    def __init__(self, origin: Point, column_pitch: Point, row_pitch: Point, columns: int, rows: int):
+        if columns < 1 or rows < 1:
+            raise ValueError("A grid needs at least one column and one row")
+        self.origin = origin
+        self.column_pitch = column_pitch
+        self.row_pitch = row_pitch
+        self.columns = columns
+        self.rows = rows
+
+    #Grid with its first site at origin, the last site of the first row at column_end
+    #and the last site of the first column at row_end
+    @classmethod
+    def from_corners(cls, origin: Point, column_end: Point, row_end: Point, columns: int, rows: int) -> 'Grid':
+        def pitch(end, count):
+            if count < 2:
+                return (0.0, 0.0)
+            return ((end[0] - origin[0]) / (count - 1), (end[1] - origin[1]) / (count - 1))
+        return cls(origin, pitch(column_end, columns), pitch(row_end, rows), columns, rows)
+
+    def __len__(self) -> int:
+        return self.columns * self.rows
+
+    #Position of one site
+    def site(self, column: int, row: int) -> Point:
+        return (self.origin[0] + column * self.column_pitch[0] + row * self.row_pitch[0],
+                self.origin[1] + column * self.column_pitch[1] + row * self.row_pitch[1])
+
+    #x and y (in mm), column and row of all sites in visiting order, row after row.
+    #serpentine runs every other row backwards, mask holds (column, row) pairs that are skipped.
+    def sites(self, serpentine: bool = True, mask: Collection[Tuple[int, int]] = ()) -> Tuple[array, array, array, array]:
+        mask = set(mask)
+        forward = range(self.columns)
+        backward = range(self.columns - 1, -1, -1)
+        #offsets of the columns are the same in every row, only the start of the row moves
+        offset_x = [column * self.column_pitch[0] for column in forward]
+        offset_y = [column * self.column_pitch[1] for column in forward]
+        x = array('d')
+        y = array('d')
+        columns = array('l')
+        rows = array('l')
+        for row in range(self.rows):
+            order = backward if serpentine and row % 2 else forward
+            if mask:
+                order = [column for column in order if (column, row) not in mask]
+            start_x, start_y = self.site(0, row)
+            x.extend([start_x + offset_x[column] for column in order])
+            y.extend([start_y + offset_y[column] for column in order])
+            columns.extend(order)
+            rows.extend([row] * len(order))
+        return x, y, columns, rows
+
+    #Routine columns (names, kind, x, y in nm, t) visiting all sites, see sites.
+    #With a dwell (in ms) every site is followed by a delay of that length.
+    def routine(self, serpentine: bool = True, mask: Collection[Tuple[int, int]] = (),
+                dwell: float = 0) -> Tuple[List[str], array, array, array, array]:
+        x, y, columns, rows = self.sites(serpentine, mask)
+        x = array('q', map(to_nm, x))
+        y = array('q', map(to_nm, y))
+        count = len(x)
+        names = ["Site %s/%s" %(column + 1, row + 1) for column, row in zip(columns, rows)]
+        if not dwell:
+            return names, array('b', [MOVE]) * count, x, y, array('d', [MOVE_TIME]) * count
+        #every site becomes a move and a delay
+        steps_x = array('q', [NO_POSITION]) * (2 * count)
+        steps_y = array('q', [NO_POSITION]) * (2 * count)
+        steps_x[::2] = x
+        steps_y[::2] = y
+        steps_names = ["Sleep for %g s" %(dwell / 1000)] * (2 * count)
+        steps_names[::2] = names
+        return (steps_names, array('b', [MOVE, DELAY]) * count, steps_x, steps_y,
+                array('d', [MOVE_TIME, dwell]) * count)
+
+
+#Parse a mask like "3,4; 10,2" (column,row counted from 1) into (column, row) pairs counted from 0
+def parse_mask(text: str) -> List[Tuple[int, int]]:
+    mask = []
+    for site in text.replace("\n", ";").split(";"):
+        if not site.strip():
+            continue
+        column, row = site.split(",")
+        mask.append((int(column) - 1, int(row) - 1))
+    return mask
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import math
+from typing import Dict, List, Optional, Tuple
+
+from conex import ConexError, Controller, POSITION_TOLERANCE, SETTLE_TIMEOUT, move_together
+from routine import move_command, to_nm
+
+
+#Travel range of the stages (in mm), the limits SL and SR set when connecting
+STAGE_MIN = 0
+STAGE_MAX = 48
+
+#Step distances (in mm) every axis is driven through while calibrating
+CALIBRATION_DISTANCES = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2, 5)
+
+#Search range of the fit: velocity (in mm/s) and acceleration (in mm/s^2)
+VELOCITY_RANGE = (0.001, 10)
+ACCELERATION_RANGE = (0.01, 1000)
+FIT_STEPS = 30
+FIT_ITERATIONS = 40
+
+
+class AxisModel(object):
+    """Time one axis needs for a move: trapezoidal velocity profile plus a fixed settle time.
+
+    velocity in mm/s, acceleration in mm/s^2, settle in s.
+    """
+
+    def __init__(self, velocity: float, acceleration: float, settle: float):
+        self.velocity = velocity
+        self.acceleration = acceleration
+        self.settle = settle
+
+    #Time (in s) from command to settled for a move over distance (in mm)
+    def move_time(self, distance: float) -> float:
+        distance = abs(distance)
+        if distance == 0:
+            return self.settle
+        return self.settle + _profile_time(distance, self.velocity, self.acceleration)
+
+    def to_dict(self) -> dict:
+        return {'velocity': self.velocity, 'acceleration': self.acceleration, 'settle': self.settle}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'AxisModel':
+        return cls(float(data['velocity']), float(data['acceleration']), float(data['settle']))
+
+    def __str__(self) -> str:
+        return "v = %.4g mm/s, a = %.4g mm/s^2, settle = %.1f ms" %(self.velocity, self.acceleration, self.settle * 1000)
+
+
+#Time (in s) to travel distance (in mm) accelerating to velocity and braking again
+def _profile_time(distance: float, velocity: float, acceleration: float) -> float:
+    if distance < velocity * velocity / acceleration:
+        #velocity is never reached
+        return 2 * math.sqrt(distance / acceleration)
+    return distance / velocity + velocity / acceleration
+
+
+#Fit an AxisModel to measured (distance in mm, time in s) samples by least squares.
+#Acceleration is searched on a log grid and then refined around the best point, velocity by
+#golden section search for every acceleration tried. The settle time of a candidate is the mean of
+#what its profile leaves unexplained.
+def fit_axis(samples: List[Tuple[float, float]]) -> AxisModel:
+    if not samples:
+        raise ValueError("No samples to fit")
+    samples = [(abs(d), t) for d, t in samples]
+    grid = _log_range(*ACCELERATION_RANGE, FIT_STEPS)
+    fits = [_fit_velocity(samples, acceleration) for acceleration in grid]
+    best = min(range(len(fits)), key=lambda i: fits[i][0])
+    low, high = grid[max(best - 1, 0)], grid[min(best + 1, len(grid) - 1)]
+    acceleration = _golden(lambda a: _fit_velocity(samples, a)[0], low, high)
+    fit = _fit_velocity(samples, acceleration)
+    if fits[best][0] < fit[0]:
+        acceleration, fit = grid[best], fits[best]
+    return AxisModel(fit[1], acceleration, fit[2])
+
+
+#Best (error, velocity, settle) for a given acceleration
+def _fit_velocity(samples: List[Tuple[float, float]], acceleration: float) -> Tuple[float, float, float]:
+    def fit(velocity):
+        rest = [t - (_profile_time(d, velocity, acceleration) if d else 0) for d, t in samples]
+        settle = max(sum(rest) / len(rest), 0)
+        return sum((r - settle) ** 2 for r in rest), velocity, settle
+    return fit(_golden(lambda v: fit(v)[0], *VELOCITY_RANGE))
+
+
+#Minimum of f between low and high (both > 0) by golden section search on a log scale
+def _golden(f, low: float, high: float, iterations: int = FIT_ITERATIONS) -> float:
+    ratio = (math.sqrt(5) - 1) / 2
+    a, b = math.log(low), math.log(high)
+    c = b - ratio * (b - a)
+    d = a + ratio * (b - a)
+    fc, fd = f(math.exp(c)), f(math.exp(d))
+    for _ in range(iterations):
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - ratio * (b - a)
+            fc = f(math.exp(c))
+        else:
+            a, c, fc = c, d, fd
+            d = a + ratio * (b - a)
+            fd = f(math.exp(d))
+    return math.exp((a + b) / 2)
+
+
+def _log_range(low: float, high: float, steps: int) -> List[float]:
+    ratio = (high / low) ** (1 / (steps - 1))
+    return [low * ratio ** i for i in range(steps)]
+
+
+class MotionModel(object):
+    """Motion time models of the x and y axis, both axes move at the same time."""
+
+    def __init__(self, x: Optional[AxisModel] = None, y: Optional[AxisModel] = None):
+        self.x = x
+        self.y = y
+
+    #True once both axes have a model
+    @property
+    def ready(self) -> bool:
+        return self.x is not None and self.y is not None
+
+    #Time (in s) of a move by dx and dy (in mm), the slower axis counts
+    def move_time(self, dx: float, dy: float) -> float:
+        return max(self.x.move_time(dx), self.y.move_time(dy))
+
+
+#Text to persist an AxisModel with, e.g. in QSettings
+def dump_axis(model: AxisModel) -> str:
+    return json.dumps(model.to_dict())
+
+
+#AxisModel stored by dump_axis, None if text holds none
+def load_axis(text) -> Optional[AxisModel]:
+    if not text:
+        return None
+    try:
+        return AxisModel.from_dict(json.loads(text))
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+#Identification of the stage on a controller (text of the ID? reply)
+async def stage_id(control: Controller) -> str:
+    return (await control.query('ID?')).text
+
+
+#Drive one axis through distances (in mm) back and forth around its position, measuring the time
+#from command to settled. Returns the (distance, time in s) samples.
+async def measure_axis(control: Controller, distances=CALIBRATION_DISTANCES, tolerance: float = POSITION_TOLERANCE,
+                       timeout: float = SETTLE_TIMEOUT) -> List[Tuple[float, float]]:
+    origin = await control.position()
+    samples = []
+    for distance in distances:
+        target = origin + distance if origin + distance <= STAGE_MAX else origin - distance
+        if target < STAGE_MIN:
+            continue
+        for position in (target, origin):
+            result = await move_together({control: (move_command(to_nm(position)), position)}, tolerance, timeout)
+            if not result.done:
+                raise ConexError("%s - Axis did not settle at %.6f mm while calibrating" %(control.name, position))
+            samples.append((distance, result.duration_ns / 1000000000))
+    return samples
+
+
+#Measure and fit every controller of controls at the same time, returns their models by controller
+async def calibrate(controls: List[Controller], distances=CALIBRATION_DISTANCES) -> Dict[Controller, AxisModel]:
+    samples = await asyncio.gather(*(measure_axis(control, distances) for control in controls))
+    return {control: fit_axis(s) for control, s in zip(controls, samples)}
@@ -0,0 +1,259 @@
+import math
+import os
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+
+from routine import DELAY, MOVE, NM_PER_MM, NO_POSITION
+
+
+#Moves are improved in blocks of this many points, the ends of a block stay where they are
+BLOCK_SIZE = 200
+#Maximum number of 2-opt sweeps over one block
+TWO_OPT_PASSES = 10
+#Routines with fewer movable points are optimized without worker processes
+PARALLEL_MIN = 2000
+#Speed (in mm/s) used to turn travel into time when no motion model is given
+TRAVEL_SPEED = 0.4
+
+#Positions are in nm like in the routine
+Point = Tuple[int, int]
+
+
+#Travel between two points: both axes move at once, so the longer one counts
+def distance(a: Point, b: Point) -> int:
+    return max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+
+
+#Summed distance (in mm) of all moves in order (row indices), moves without a valid position are skipped.
+#With a motion model the summed move time (in s) instead.
+def travel(kind, x, y, order: Optional[Iterable[int]] = None, motion=None) -> float:
+    if order is None:
+        order = range(len(kind))
+    total = 0.0
+    last = None
+    for row in order:
+        if kind[row] != MOVE or x[row] == NO_POSITION or y[row] == NO_POSITION:
+            continue
+        if last is not None:
+            if motion is None:
+                total += max(abs(x[row] - last[0]), abs(y[row] - last[1]))
+            else:
+                total += motion.move_time((x[row] - last[0]) / NM_PER_MM, (y[row] - last[1]) / NM_PER_MM)
+        last = (x[row], y[row])
+    return total / NM_PER_MM if motion is None else total
+
+
+class Ordering(object):
+    """Result of optimize_order: row ``i`` of the new routine is row ``order[i]`` of the old one.
+
+    Travel before and after is in mm, the travel time in s.
+    """
+
+    def __init__(self, order: array, before: float, after: float, time_before: float, time_after: float):
+        self.order = order
+        self.before = before
+        self.after = after
+        self.time_before = time_before
+        self.time_after = time_after
+
+    #Travel saved per repetition in mm
+    @property
+    def saved(self) -> float:
+        return self.before - self.after
+
+    #Travel time saved per repetition in s
+    @property
+    def saved_time(self) -> float:
+        return self.time_before - self.time_after
+
+    @property
+    def changed(self) -> bool:
+        return any(row != i for i, row in enumerate(self.order))
+
+
+#Split the rows into runs of moves that may be reordered among each other, returns (first, end) row pairs.
+#Everything else stays in place: delays and loop elements, moves without a position, anchors and
+#the move right before a delay, since that delay waits at its position.
+def segments(kind, x, y, anchors: Iterable[int] = ()) -> List[Tuple[int, int]]:
+    anchors = set(anchors)
+    count = len(kind)
+    result = []
+    first = None
+    for row in range(count + 1):
+        movable = (row < count and kind[row] == MOVE and row not in anchors
+                   and x[row] != NO_POSITION and y[row] != NO_POSITION
+                   and not (row + 1 < count and kind[row + 1] == DELAY))
+        if movable and first is None:
+            first = row
+        elif not movable and first is not None:
+            if row - first > 1:
+                result.append((first, row))
+            first = None
+    return result
+
+
+#Order points by always going to the nearest one left, starting after start (or at the first point).
+#Points are kept in a grid, so only cells around the current point are searched.
+def nearest_neighbour(points: List[Point], start: Optional[Point] = None) -> List[int]:
+    count = len(points)
+    if count < 2:
+        return list(range(count))
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    low_x, low_y = min(xs), min(ys)
+    extent = max(max(xs) - low_x, max(ys) - low_y)
+    cell = extent / math.sqrt(count / 2) if extent > 0 else 1.0
+    grid = {}
+    for i, (px, py) in enumerate(points):
+        grid.setdefault((int((px - low_x) / cell), int((py - low_y) / cell)), []).append(i)
+    size = int(extent / cell) + 1
+
+    def take(i):
+        px, py = points[i]
+        key = (int((px - low_x) / cell), int((py - low_y) / cell))
+        bucket = grid[key]
+        bucket.remove(i)
+        if not bucket:
+            del grid[key]
+
+    if start is None:
+        order = [0]
+        take(0)
+        start = points[0]
+    else:
+        order = []
+    cx, cy = start
+    while grid:
+        gx = int((cx - low_x) / cell)
+        gy = int((cy - low_y) / cell)
+        best = None
+        best_distance = math.inf
+        ring = 0
+        rings = size + max(abs(gx), abs(gy)) + 1
+        #points in ring r+1 are at least r cells away
+        while best_distance > (ring - 1) * cell and ring <= rings:
+            for i in range(gx - ring, gx + ring + 1):
+                for j in range(gy - ring, gy + ring + 1):
+                    if ring and abs(i - gx) != ring and abs(j - gy) != ring:
+                        continue
+                    for candidate in grid.get((i, j), ()):
+                        px, py = points[candidate]
+                        d = max(abs(px - cx), abs(py - cy))
+                        if d < best_distance or (d == best_distance and candidate < best):
+                            best = candidate
+                            best_distance = d
+            ring += 1
+        take(best)
+        order.append(best)
+        cx, cy = points[best]
+    return order
+
+
+#Improve a path with 2-opt: reverse parts of it while that shortens the path.
+#path[0] stays first, path[-1] stays last if closed. The cost of a move is its distance, or its
+#time with a motion model.
+def two_opt(path: List[Point], closed: bool, passes: int = TWO_OPT_PASSES, motion=None) -> List[int]:
+    if motion is None:
+        cost = [[max(abs(ax - bx), abs(ay - by)) for bx, by in path] for ax, ay in path]
+    else:
+        cost = [[motion.move_time((bx - ax) / NM_PER_MM, (by - ay) / NM_PER_MM) for bx, by in path] for ax, ay in path]
+    count = len(path)
+    order = list(range(count))
+    last = count - 1 if closed else count
+    for _ in range(passes):
+        improved = False
+        for i in range(1, last - 1):
+            from_a = cost[order[i - 1]]
+            b = order[i]
+            ab = from_a[b]
+            for j in range(i + 1, last):
+                c = order[j]
+                change = from_a[c] - ab
+                if j + 1 < count:
+                    d = order[j + 1]
+                    change += cost[b][d] - cost[c][d]
+                if change < -1e-9:
+                    order[i:j + 1] = order[j:i - 1:-1]
+                    b = order[i]
+                    ab = from_a[b]
+                    improved = True
+        if not improved:
+            break
+    return order
+
+
+#One block of work for the pool: the block's points between the fixed points before and after it
+def _improve_block(job) -> List[int]:
+    before, points, after, motion = job
+    path = ([before] if before is not None else []) + points + ([after] if after is not None else [])
+    order = two_opt(path, after is not None, motion=motion)
+    if before is not None:
+        order = [i - 1 for i in order[1:]]
+    if after is not None:
+        order = order[:-1]
+    return order
+
+
+#Reorder the moves of a routine to shorten the travel between them, see segments for what stays in place.
+#Blocks of all segments are improved in parallel by workers processes (all cores if None).
+#With a motion model the time of the moves is minimized and predicted, else their distance, the time
+#then assumes TRAVEL_SPEED.
+def optimize_order(kind, x, y, anchors: Iterable[int] = (), workers: Optional[int] = None, motion=None) -> Ordering:
+    count = len(kind)
+    order = array('l', range(count))
+    parts = segments(kind, x, y, anchors)
+    movable = sum(end - first for first, end in parts)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    pool = ProcessPoolExecutor(workers) if workers > 1 and movable >= PARALLEL_MIN else None
+    try:
+        ends = []
+        for first, end in parts:
+            before = _previous_position(kind, x, y, first)
+            after = (x[end], y[end]) if end < count and kind[end] == MOVE and NO_POSITION not in (x[end], y[end]) else None
+            points = [(x[row], y[row]) for row in range(first, end)]
+            rows = [first + i for i in nearest_neighbour(points, before)]
+            if before is None:
+                #the first point stays first, so every block has a fixed start
+                before = (x[rows[0]], y[rows[0]])
+                order[first] = rows.pop(0)
+                first += 1
+            ends.append((first, rows, before, after))
+        #second round is shifted by half a block, so points can move across the block borders of the first
+        for shift in (0, BLOCK_SIZE // 2):
+            jobs = []
+            targets = []
+            for first, rows, before, after in ends:
+                cuts = list(range(shift, len(rows), BLOCK_SIZE)) if shift < len(rows) else []
+                if not cuts or cuts[0] != 0:
+                    cuts.insert(0, 0)
+                for start, stop in zip(cuts, cuts[1:] + [len(rows)]):
+                    block = rows[start:stop]
+                    if len(block) < 2:
+                        continue
+                    prev = (x[rows[start - 1]], y[rows[start - 1]]) if start else before
+                    following = (x[rows[stop]], y[rows[stop]]) if stop < len(rows) else after
+                    jobs.append((prev, [(x[row], y[row]) for row in block], following, motion))
+                    targets.append((rows, start, block))
+            results = pool.map(_improve_block, jobs, chunksize=max(1, len(jobs) // (4 * workers))) if pool else map(_improve_block, jobs)
+            for (rows, start, block), local in zip(targets, results):
+                rows[start:start + len(block)] = [block[i] for i in local]
+        for first, rows, before, after in ends:
+            order[first:first + len(rows)] = array('l', rows)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    travel_before = travel(kind, x, y)
+    travel_after = travel(kind, x, y, order)
+    if motion is None:
+        return Ordering(order, travel_before, travel_after, travel_before / TRAVEL_SPEED, travel_after / TRAVEL_SPEED)
+    return Ordering(order, travel_before, travel_after, travel(kind, x, y, motion=motion), travel(kind, x, y, order, motion))
+
+
+#Position of the last move before row, None if there is none
+def _previous_position(kind, x, y, row: int) -> Optional[Point]:
+    for i in range(row - 1, -1, -1):
+        if kind[i] == MOVE and x[i] != NO_POSITION and y[i] != NO_POSITION:
+            return (x[i], y[i])
+    return None
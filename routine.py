@@ -0,0 +1,707 @@
+import math
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+from itertools import accumulate
+from typing import BinaryIO, Iterator, List, Optional, TextIO, Tuple
+
+from conex import reply_value
+
+
+#Kinds of routine steps, a LOOP repeats the steps up to its END t times
+MOVE = 0
+DELAY = 1
+LOOP = 2
+END = 3
+
+#Planned duration of a move (in ms) when nothing better is known
+MOVE_TIME = 1500
+
+#First line of every routine file in text format
+TEXT_HEADER = "####ACI####"
+
+#Binary format: header, then the columns kind (int8), t (float64, ms), x and y (int64 nm,
+#or int32 nm deltas with BINARY_DELTA), name offsets (uint64) and names (utf-8), each 8 byte aligned.
+#Delta encoded files are smaller but their positions have to be decoded, others are used as they are mapped.
+BINARY_SUFFIX = ".acib"
+BINARY_MAGIC = b"ACIROUT\x00"
+BINARY_VERSION = 1
+#magic, version, flags, repetitions, number of steps, size of the names
+BINARY_HEADER = struct.Struct("<8sHHIQQ")
+BINARY_DELTA = 0x1
+#Stored instead of a position where there is none
+NO_POSITION = -2**63
+NO_DELTA = -2**31
+
+#Positions are integer nm everywhere, mm only appear where they are talked to the controller or shown
+NM_PER_MM = 1000000
+
+
+#One element of a routine, x and y are the target positions in nm (NO_POSITION for delays and loops),
+#t is in ms or the number of repetitions of a LOOP
+Step = namedtuple('Step', 'name kind x y t')
+
+#Text stored instead of the x position of loop elements in text files
+LOOP_TEXT = {LOOP: "LOOP", END: "END"}
+
+
+#Position of a controller reply in nm, NO_POSITION if there is none (e.g. 'NA')
+def parse_position(text: str) -> int:
+    try:
+        return to_nm(reply_value(text))
+    except (ValueError, TypeError):
+        return NO_POSITION
+
+
+#Position in nm as the controller replies it, 'NA' for NO_POSITION
+def position_text(position: int) -> str:
+    if position == NO_POSITION:
+        return "NA"
+    return "1PA%s" %mm_text(position)
+
+
+class RoutineFormatError(ValueError):
+    pass
+
+
+#Parse one line of the text format: name;x;y;t
+def parse_text_step(line: str) -> Step:
+    data = line.split(";")
+    if len(data) < 4:
+        raise RoutineFormatError("Not a routine step: %s" %line)
+    t = data[3].strip()
+    t = 0.0 if t == "NA" else float(t)
+    if data[1] == LOOP_TEXT[LOOP]:
+        return Step(data[0], LOOP, NO_POSITION, NO_POSITION, t)
+    if data[1] == LOOP_TEXT[END]:
+        return Step(data[0], END, NO_POSITION, NO_POSITION, t)
+    if "Sleep" in data[0]:
+        return Step(data[0], DELAY, NO_POSITION, NO_POSITION, t)
+    return Step(data[0], MOVE, parse_position(data[1]), parse_position(data[2]), t)
+
+
+#Read the first line of a text routine file and return the number of repetitions it names
+def read_text_header(file: TextIO) -> int:
+    header = file.readline().strip()
+    if TEXT_HEADER not in header:
+        raise RoutineFormatError("Please only try to use ACI files")
+    repetitions = header[len(TEXT_HEADER):].strip(";")
+    try:
+        return max(int(repetitions), 1) if repetitions else 1
+    except ValueError:
+        return 1
+
+
+#Read the steps of a text routine file one by one, without loading the whole file, after read_text_header.
+#progress is called with the number of characters read so far every batch steps.
+def read_text_routine(file: TextIO, progress=None, batch: int = 10000) -> Iterator[Step]:
+    read = 0
+    count = 0
+    for line in file:
+        read += len(line)
+        line = line.strip("\r\n")
+        if not line.strip():
+            continue
+        yield parse_text_step(line)
+        count += 1
+        if progress is not None and count % batch == 0:
+            progress(read)
+
+
+#Write steps in text format, repetitions are noted in the header
+def write_text_routine(file: TextIO, steps, repetitions: int = 1) -> None:
+    file.write("%s;%s\r" %(TEXT_HEADER, repetitions))
+    for step in steps:
+        if step.kind in LOOP_TEXT:
+            file.write("%s;%s;NA;%s \r" %(step.name, LOOP_TEXT[step.kind], step.t))
+        else:
+            file.write("%s;%s;%s;%s \r" %(step.name, position_text(step.x), position_text(step.y), step.t))
+
+
+#Index of the matching END for every LOOP and the other way round, -1 for other steps
+def match_loops(kind) -> array:
+    match = array('l', [-1]) * len(kind)
+    open_loops = []
+    for index, k in enumerate(kind):
+        if k == LOOP:
+            open_loops.append(index)
+        elif k == END:
+            if not open_loops:
+                raise RoutineFormatError("Loop end without loop start at element %s" %(index + 1))
+            start = open_loops.pop()
+            match[start] = index
+            match[index] = start
+    if open_loops:
+        raise RoutineFormatError("Loop at element %s is not closed" %(open_loops[-1] + 1))
+    return match
+
+
+#Position in mm as integer nm, NO_POSITION for NaN
+def to_nm(position: float) -> int:
+    if math.isnan(position):
+        return NO_POSITION
+    return int(round(position * NM_PER_MM))
+
+
+#Position in nm as mm, NaN for NO_POSITION
+def from_nm(position: int) -> float:
+    if position == NO_POSITION:
+        return math.nan
+    return position / NM_PER_MM
+
+
+#Position in nm as exact mm text with 6 decimals, e.g. 24194633 -> '24.194633'
+def mm_text(position: int) -> str:
+    mm, nm = divmod(abs(position), NM_PER_MM)
+    return "%s%d.%06d" %('-' if position < 0 else '', mm, nm)
+
+
+def _padding(size: int) -> bytes:
+    return bytes(-size % 8)
+
+
+def _little_endian(column: array) -> array:
+    if sys.byteorder != 'little':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+#Differences between subsequent positions, None if one doesn't fit into int32
+def _delta_encode(positions) -> array:
+    deltas = array('i')
+    previous = 0
+    for position in positions:
+        if position == NO_POSITION:
+            deltas.append(NO_DELTA)
+            continue
+        delta = position - previous
+        if not NO_DELTA < delta < 2**31:
+            return None
+        deltas.append(delta)
+        previous = position
+    return deltas
+
+
+def _delta_decode(deltas) -> array:
+    positions = array('q')
+    previous = 0
+    for delta in deltas:
+        if delta == NO_DELTA:
+            positions.append(NO_POSITION)
+        else:
+            previous += delta
+            positions.append(previous)
+    return positions
+
+
+#Write steps in binary format, repetitions are stored in the header instead of repeating the steps
+def write_binary_routine(file: BinaryIO, steps, repetitions: int = 1, delta: bool = False) -> None:
+    names = []
+    kind = array('b')
+    t = array('d')
+    x = array('q')
+    y = array('q')
+    for step in steps:
+        names.append(step.name.encode())
+        kind.append(step.kind)
+        t.append(step.t)
+        x.append(step.x)
+        y.append(step.y)
+    flags = 0
+    if delta:
+        delta_x = _delta_encode(x)
+        delta_y = _delta_encode(y)
+        if delta_x is not None and delta_y is not None:
+            x, y = delta_x, delta_y
+            flags |= BINARY_DELTA
+    offsets = array('Q', [0])
+    offsets.extend(accumulate(len(name) for name in names))
+    blob = b"".join(names)
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags, repetitions, len(kind), len(blob))
+    file.write(header + _padding(len(header)))
+    for column in (kind, t, x, y, offsets):
+        data = _little_endian(column).tobytes()
+        file.write(data + _padding(len(data)))
+    file.write(blob + _padding(len(blob)))
+
+
+def is_binary_routine(path: str) -> bool:
+    with open(path, 'rb') as file:
+        return file.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+class MappedNames(object):
+    """Step names of a mapped routine, decoded when accessed."""
+
+    def __init__(self, blob: memoryview, offsets: memoryview):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return str(self.blob[self.offsets[index]:self.offsets[index + 1]], 'utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+class MappedRoutine(object):
+    """Binary routine file mapped into memory.
+
+    kind and t are read straight from the mapping, as are x and y (in nm)
+    unless the file is delta encoded, then they are decoded on opening.
+    Compiling uses the columns as they are, positions are not converted.
+    Close it (or use it as context manager) once done with its columns.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file:
+            try:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise RoutineFormatError("%s is empty" %path)
+        self._views = []
+        try:
+            self._read()
+        except Exception:
+            self.close()
+            raise
+
+    def _view(self, offset: int, size: int, typecode: str) -> memoryview:
+        if offset + size > len(self._map):
+            raise RoutineFormatError("Routine file is truncated")
+        view = memoryview(self._map)[offset:offset + size].cast(typecode)
+        self._views.append(view)
+        return view
+
+    def _read(self) -> None:
+        if len(self._map) < BINARY_HEADER.size:
+            raise RoutineFormatError("Not a binary ACI routine")
+        magic, version, flags, self.repetitions, count, names_size = BINARY_HEADER.unpack_from(self._map)
+        if magic != BINARY_MAGIC or sys.byteorder != 'little':
+            raise RoutineFormatError("Not a binary ACI routine")
+        if version > BINARY_VERSION:
+            raise RoutineFormatError("Routine file version %s is not supported" %version)
+        self.delta = bool(flags & BINARY_DELTA)
+        offset = BINARY_HEADER.size + len(_padding(BINARY_HEADER.size))
+        columns = []
+        for typecode, itemsize, length in (('b', 1, count), ('d', 8, count), ('i' if self.delta else 'q', 4 if self.delta else 8, count),
+                                           ('i' if self.delta else 'q', 4 if self.delta else 8, count), ('Q', 8, count + 1), ('B', 1, names_size)):
+            columns.append(self._view(offset, itemsize * length, typecode))
+            offset += itemsize * length + len(_padding(itemsize * length))
+        self.kind, self.t, self.x, self.y, offsets, blob = columns
+        if self.delta:
+            self.x = _delta_decode(self.x)
+            self.y = _delta_decode(self.y)
+        self.names = MappedNames(blob, offsets)
+
+    def __len__(self) -> int:
+        return len(self.kind)
+
+    def __iter__(self) -> Iterator[Step]:
+        for index in range(len(self)):
+            yield Step(self.names[index], self.kind[index], self.x[index], self.y[index], self.t[index])
+
+    #Compiled routine to run from the mapped columns
+    def compile(self, motion=None) -> 'CompiledRoutine':
+        return CompiledRoutine(self.names, self.kind, self.x, self.y, step_durations(self.kind, self.t, self.x, self.y, motion),
+                               self.repetitions, loop_counts(self.kind, self.t))
+
+    def close(self) -> None:
+        self.kind = self.t = self.x = self.y = self.names = None
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._map.close()
+
+    def __enter__(self) -> 'MappedRoutine':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class Routine(object):
+    """Plain description of a routine: steps run in order, the whole list `repetitions` times."""
+
+    def __init__(self, steps: List[Step] = None, repetitions: int = 1):
+        self.steps = list(steps) if steps is not None else []
+        self.repetitions = repetitions
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __getitem__(self, index: int) -> Step:
+        return self.steps[index]
+
+    #Planned duration of one step in ms, loop elements take no time themselves
+    @staticmethod
+    def step_time(step: Step) -> float:
+        if step.kind == DELAY:
+            return step.t
+        if step.kind == MOVE:
+            return MOVE_TIME
+        return 0
+
+    #Planned duration of all repetitions in ms
+    def total_time(self) -> float:
+        steps = self.steps
+        kind = [step.kind for step in steps]
+        return Timeline([self.step_time(step) for step in steps], self.repetitions, kind,
+                        loop_counts(kind, [step.t for step in steps])).total
+
+    def compile(self) -> 'CompiledRoutine':
+        store = RoutineStore()
+        store.extend(self.steps)
+        return store.compile(self.repetitions)
+
+
+class RoutineStore(object):
+    """Editable routine kept column wise: names, kind, x, y (in nm, NO_POSITION where there is none) and t (in ms).
+
+    Backs the routine list of the GUI, a million steps take a few tens of MB.
+    After use_mapped the columns are those of a mapped routine file, they are
+    only copied once the routine is changed.
+    """
+
+    def __init__(self):
+        self.mapped = None
+        self._empty()
+
+    def _empty(self) -> None:
+        self.names = []
+        self.kind = array('b')
+        self.x = array('q')
+        self.y = array('q')
+        self.t = array('d')
+
+    #Use the columns of routine as they are instead of copying them
+    def use_mapped(self, routine: MappedRoutine) -> None:
+        self.mapped = routine
+        self.names, self.kind, self.x, self.y, self.t = routine.names, routine.kind, routine.x, routine.y, routine.t
+
+    #Copy the columns of a mapped routine file (if path is given only if it is mapped from there),
+    #e.g. before that file is written. Routines compiled before keep using the mapping.
+    def detach(self, path: Optional[str] = None) -> None:
+        routine = self.mapped
+        if routine is None or path is not None and os.path.abspath(path) != os.path.abspath(routine.path):
+            return
+        self.mapped = None
+        self._empty()
+        self.extend_mapped(routine)
+
+    def columns(self):
+        return (self.names, self.kind, self.x, self.y, self.t)
+
+    def __len__(self) -> int:
+        return len(self.kind)
+
+    def __getitem__(self, index: int) -> Step:
+        return Step(self.names[index], self.kind[index], self.x[index], self.y[index], self.t[index])
+
+    def __iter__(self):
+        return map(Step._make, zip(*self.columns()))
+
+    def append(self, step: Step) -> None:
+        self.detach()
+        for column, value in zip(self.columns(), step):
+            column.append(value)
+
+    def extend(self, steps) -> None:
+        self.detach()
+        for column, values in zip(self.columns(), zip(*steps)):
+            column.extend(values)
+
+    #Append whole columns at once, e.g. generated ones
+    def extend_columns(self, names, kind, x, y, t) -> None:
+        self.detach()
+        for column, values in zip(self.columns(), (names, kind, x, y, t)):
+            column.extend(values)
+
+    #Append all steps of a mapped routine file at once
+    def extend_mapped(self, routine: MappedRoutine) -> None:
+        self.detach()
+        self.names.extend(routine.names)
+        self.kind.frombytes(routine.kind.cast('B'))
+        self.x.frombytes(memoryview(routine.x).cast('B'))
+        self.y.frombytes(memoryview(routine.y).cast('B'))
+        self.t.frombytes(routine.t.cast('B'))
+
+    def rename(self, index: int, name: str) -> None:
+        self.detach()
+        self.names[index] = name
+
+    def remove(self, first: int, count: int = 1) -> None:
+        self.detach()
+        for column in self.columns():
+            del column[first:first + count]
+
+    #Move count steps starting at first in front of the step at destination (index before the move)
+    def move(self, first: int, count: int, destination: int) -> None:
+        self.detach()
+        if destination > first:
+            destination -= count
+        for column in self.columns():
+            block = column[first:first + count]
+            del column[first:first + count]
+            column[destination:destination] = block
+
+    def clear(self) -> None:
+        if self.mapped is not None:
+            self.mapped = None
+            self._empty()
+        for column in self.columns():
+            del column[:]
+
+    #Rearrange the steps, step i becomes the step at order[i]
+    def reorder(self, order) -> None:
+        self.detach()
+        for column in self.columns():
+            column[:] = type(column)(column.typecode, [column[i] for i in order]) if isinstance(column, array) else [column[i] for i in order]
+
+    def to_routine(self, repetitions: int = 1) -> Routine:
+        return Routine(list(self), repetitions)
+
+    #Insert steps in front of the step at index
+    def insert(self, index: int, steps) -> None:
+        self.detach()
+        for column, values in zip(self.columns(), zip(*steps)):
+            column[index:index] = type(column)(column.typecode, values) if isinstance(column, array) else list(values)
+
+    #motion: optional model the planned duration of moves is taken from, see step_durations
+    #Mapped columns are used as they are, they are never changed
+    def compile(self, repetitions: int = 1, motion=None) -> 'CompiledRoutine':
+        if self.mapped is not None:
+            return CompiledRoutine(self.names, self.kind, self.x, self.y, step_durations(self.kind, self.t, self.x, self.y, motion),
+                                   repetitions, loop_counts(self.kind, self.t))
+        return CompiledRoutine(list(self.names), array('b', self.kind), array('q', self.x), array('q', self.y),
+                               step_durations(self.kind, self.t, self.x, self.y, motion), repetitions,
+                               loop_counts(self.kind, self.t))
+
+
+#Planned duration of every step in ms. With a motion model (anything with move_time(dx, dy) in s and mm)
+#and the positions x and y (in nm), moves take as long as the model predicts from the previous position.
+def step_durations(kind, t, x=None, y=None, motion=None) -> array:
+    if motion is None:
+        return array('d', (t if k == DELAY else MOVE_TIME if k == MOVE else 0 for k, t in zip(kind, t)))
+    durations = array('d', bytes(8 * len(kind)))
+    last_x = last_y = NO_POSITION
+    for index, k in enumerate(kind):
+        if k == DELAY:
+            durations[index] = t[index]
+        elif k == MOVE:
+            if NO_POSITION in (last_x, x[index], y[index]):
+                durations[index] = MOVE_TIME
+            else:
+                durations[index] = motion.move_time((x[index] - last_x) / NM_PER_MM, (y[index] - last_y) / NM_PER_MM) * 1000
+            last_x = x[index]
+            last_y = y[index]
+    return durations
+
+
+#Number of repetitions of every LOOP, 0 for other steps
+def loop_counts(kind, t) -> array:
+    return array('l', (max(int(t), 0) if k == LOOP else 0 for k, t in zip(kind, t)))
+
+
+class CommandTable(object):
+    """Encoded commands packed into one buffer, entries are returned as memoryview slices."""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array('L', [0])
+
+    def append(self, command: bytes) -> None:
+        self.data += command
+        self.offsets.append(len(self.data))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> memoryview:
+        return memoryview(self.data)[self.offsets[index]:self.offsets[index + 1]]
+
+
+#Encode an absolute move to position (in nm)
+def move_command(position: int) -> bytes:
+    return b'PA%s\r\n' %mm_text(position).encode()
+
+
+class CompiledRoutine(object):
+    """Columnar form of a routine as the engine runs it.
+
+    kind, x, y (in nm, NO_POSITION where there is none) and dwell (planned
+    duration in ms) are typed arrays (or memoryviews of a mapped file, they
+    are used as given) and the move commands of every axis are encoded up
+    front. Moves without a valid x or y position get an empty command.
+    Further axes (e.g. 'z' focus or a rotation) can be added with add_axis,
+    positions and commands hold the columns of all axes by name. Loops stay
+    as they are, counts holds the repetitions of every LOOP and match the
+    index of its END (and the other way round).
+    """
+
+    def __init__(self, names, kind, x, y, dwell, repetitions: int = 1, counts=None):
+        self.repetitions = repetitions
+        self.names = names
+        self.kind = kind
+        self.x = x
+        self.y = y
+        self.dwell = dwell
+        self.counts = counts if counts is not None else array('l', [0]) * len(kind)
+        self.match = match_loops(kind)
+        self.commands_x = CommandTable()
+        self.commands_y = CommandTable()
+        for kind, x, y in zip(self.kind, self.x, self.y):
+            if kind != MOVE or x == NO_POSITION or y == NO_POSITION:
+                self.commands_x.append(b'')
+                self.commands_y.append(b'')
+            else:
+                self.commands_x.append(move_command(x))
+                self.commands_y.append(move_command(y))
+        self.positions = {'x': self.x, 'y': self.y}
+        self.commands = {'x': self.commands_x, 'y': self.commands_y}
+        #axes that only move where they have a position, x and y are needed by every move
+        self.optional = set()
+        self.timeline = Timeline(self.dwell, self.repetitions, self.kind, self.counts)
+
+    def __len__(self) -> int:
+        return len(self.kind)
+
+    #Add the positions (in nm) of another axis, it stays where it is on moves it has NO_POSITION for
+    def add_axis(self, name: str, positions) -> None:
+        if name in self.positions:
+            raise ValueError("Routine already has a %s - Axis" %name)
+        if len(positions) != len(self.kind):
+            raise ValueError("%s positions for a routine of %s steps" %(len(positions), len(self.kind)))
+        commands = CommandTable()
+        for kind, position in zip(self.kind, positions):
+            commands.append(move_command(position) if kind == MOVE and position != NO_POSITION else b'')
+        self.positions[name] = positions
+        self.commands[name] = commands
+        self.optional.add(name)
+
+    #Planned duration of all repetitions in ms
+    def total_time(self) -> float:
+        return self.timeline.total
+
+
+class Timeline(object):
+    """Planned start of every step as prefix sums of the step durations (in ms).
+
+    Built once per run, afterwards elapsed and remaining time, progress and
+    the step running at a given time are looked up instead of summed up.
+    Loops are not unrolled: the body of every LOOP has its own prefix sums
+    and a step is placed by the iterations of its enclosing loops (outermost
+    first), so lookups cost O(depth) and O(depth log n).
+    """
+
+    def __init__(self, durations, repetitions: int = 1, kind=None, counts=None):
+        count = len(durations)
+        self.durations = durations
+        self.repetitions = repetitions
+        #enclosing LOOP of every step (-1 on top level) and its start within one iteration of that loop
+        self.parent = array('l', [-1]) * count
+        self.offset = array('d', [0]) * count
+        #one iteration of every LOOP, children and their starts of every block (-1 is the top level)
+        self.body = {}
+        self.children = {-1: array('l')}
+        self.starts = {-1: array('d')}
+        #deepest loop nesting
+        self.depth = 0
+        blocks = [-1]
+        elapsed = [0.0]
+        for index in range(count):
+            k = kind[index] if kind is not None else MOVE
+            if k == END:
+                loop = blocks.pop()
+                self.body[loop] = elapsed.pop()
+                elapsed[-1] += self.body[loop] * counts[loop]
+                self.parent[index] = blocks[-1]
+                self.offset[index] = elapsed[-1]
+                continue
+            block = blocks[-1]
+            self.parent[index] = block
+            self.offset[index] = elapsed[-1]
+            self.children[block].append(index)
+            self.starts[block].append(elapsed[-1])
+            if k == LOOP:
+                blocks.append(index)
+                elapsed.append(0.0)
+                if len(blocks) - 1 > self.depth:
+                    self.depth = len(blocks) - 1
+                self.children[index] = array('l')
+                self.starts[index] = array('d')
+            else:
+                elapsed[-1] += durations[index]
+        if len(blocks) > 1:
+            raise RoutineFormatError("Loop at element %s is not closed" %(blocks[-1] + 1))
+        self.cycle = elapsed[0]
+        self.total = self.cycle * repetitions
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+    #LOOPs enclosing a step, outermost first
+    def enclosing(self, index: int) -> List[int]:
+        loops = []
+        loop = self.parent[index]
+        while loop >= 0:
+            loops.append(loop)
+            loop = self.parent[loop]
+        loops.reverse()
+        return loops
+
+    #Planned time from the start of the routine to the start of a step
+    def start_of(self, repetition: int, index: int, iterations=()) -> float:
+        t = repetition * self.cycle + self.offset[index]
+        level = len(iterations) - 1
+        loop = self.parent[index]
+        while loop >= 0:
+            if level >= 0:
+                t += iterations[level] * self.body[loop]
+            t += self.offset[loop]
+            level -= 1
+            loop = self.parent[loop]
+        return t
+
+    #Planned time from the start of the routine to the end of a step
+    def end_of(self, repetition: int, index: int, iterations=()) -> float:
+        return self.start_of(repetition, index, iterations) + self.durations[index]
+
+    def remaining(self, repetition: int, index: int, iterations=()) -> float:
+        return self.total - self.end_of(repetition, index, iterations)
+
+    #Share of the routine done after a step finished, in percent
+    def progress(self, repetition: int, index: int, iterations=()) -> float:
+        if self.total <= 0:
+            return 100.0
+        return 100 * self.end_of(repetition, index, iterations) / self.total
+
+    #Repetition, index and loop iterations (outermost first) of the step planned to run at time t
+    def locate(self, t: float) -> Tuple[int, int, Tuple[int, ...]]:
+        if len(self) == 0 or t >= self.total or self.cycle <= 0:
+            return self.repetitions, 0, ()
+        repetition, offset = divmod(max(t, 0), self.cycle)
+        block = -1
+        iterations = []
+        while True:
+            starts = self.starts[block]
+            index = self.children[block][max(bisect_right(starts, offset) - 1, 0)]
+            body = self.body.get(index, 0)
+            if body <= 0:
+                return int(repetition), index, tuple(iterations)
+            iteration, offset = divmod(offset - self.offset[index], body)
+            iterations.append(int(iteration))
+            block = index
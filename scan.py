@@ -0,0 +1,148 @@
+import asyncio
+import time
+from collections import namedtuple
+from typing import Callable, List, Optional, Sequence
+
+from conex import ConexError, Controller, POSITION_TOLERANCE, SETTLE_TIMEOUT, move_together
+from grid import Grid
+from motion import STAGE_MAX, STAGE_MIN
+from routine import move_command, to_nm
+
+
+#Longest time a single line may take (in s)
+LINE_TIMEOUT = 600
+
+#One line of a continuous scan: the slow axis waits at slow while the fast axis runs from start to end
+#(all in mm), triggers are the fast axis positions that are reported when crossed, in the order they are met
+ScanLine = namedtuple('ScanLine', 'slow start end triggers')
+
+#A trigger position crossed during a scan: line and trigger number, the trigger position, the first position
+#read back at or behind it (all in mm) and the monotonic time in ns that reading arrived
+Crossing = namedtuple('Crossing', 'line index trigger position time')
+
+
+#Lines scanning all sites of grid row by row, grid rows have to run along the fast (x) axis and sites
+#in mask are not triggered. A row may drift by up to tolerance mm in y over its length (rounding of
+#corners taken from the stage), it is scanned at the y of its first site. The fast axis starts run_up
+#mm before the first and stops run_up behind the last site of a line, so the sites are crossed at
+#constant velocity. The run up is shortened where it would leave the travel of the stage, sites
+#outside of it raise ValueError.
+def grid_lines(grid: Grid, serpentine: bool = True, mask=(), run_up: float = 0,
+               tolerance: float = POSITION_TOLERANCE) -> List[ScanLine]:
+    if abs(grid.column_pitch[1]) * (grid.columns - 1) > tolerance:
+        raise ValueError("Rows of a scanned grid have to be parallel to the x axis")
+    x, y, columns, rows = grid.sites(serpentine, mask)
+    lines = []
+    first = 0
+    while first < len(rows):
+        end = first
+        while end < len(rows) and rows[end] == rows[first]:
+            end += 1
+        triggers = list(x[first:end])
+        if not all(STAGE_MIN <= position <= STAGE_MAX for position in (y[first], triggers[0], triggers[-1])):
+            raise ValueError("Sites of row %s are outside of the stage travel" %(rows[first] + 1))
+        direction = 1 if triggers[-1] >= triggers[0] else -1
+        start = min(max(triggers[0] - direction * run_up, STAGE_MIN), STAGE_MAX)
+        stop = min(max(triggers[-1] + direction * run_up, STAGE_MIN), STAGE_MAX)
+        lines.append(ScanLine(y[first], start, stop, triggers))
+        first = end
+    return lines
+
+
+class LineScanner(object):
+    """Continuous scan: the fast axis runs at constant velocity while its position is sampled.
+
+    Every line starts with both axes settled on its start, then the fast axis
+    is sent to the end and TP is polled back to back until it settled there.
+    Whenever a sample reaches or passes the next trigger position of the line
+    a Crossing with the reading and its arrival time is recorded and passed to
+    ``callback`` and kept in ``crossings``, so they are still there when the
+    scan fails. ``velocity`` (in mm/s) is set with VA for the scan and the
+    previous velocity is restored afterwards.
+    """
+
+    def __init__(self, fast: Controller, slow: Controller, velocity: Optional[float] = None,
+                 callback: Optional[Callable[[Crossing], None]] = None, tolerance: float = POSITION_TOLERANCE):
+        self.fast = fast
+        self.slow = slow
+        self.velocity = velocity
+        self.callback = callback
+        self.tolerance = tolerance
+        self.samples = 0
+        self.crossings = []
+        self._stop = None
+
+    @property
+    def running(self) -> bool:
+        return self._stop is not None and not self._stop.is_set()
+
+    def stop(self) -> None:
+        if self._stop is not None:
+            self._stop.set()
+
+    #Scan all lines, returns the crossings of all triggers reached before the scan ended or was stopped
+    async def run(self, lines: Sequence[ScanLine]) -> List[Crossing]:
+        self._stop = asyncio.Event()
+        self.samples = 0
+        self.crossings = []
+        previous = None
+        try:
+            if self.velocity is not None:
+                previous = (await self.fast.query('VA?')).value
+                self.fast.write('VA%.6f\r\n' %self.velocity)
+            for number, line in enumerate(lines):
+                if self._stop.is_set():
+                    break
+                await self._scan_line(number, line)
+        finally:
+            if previous is not None:
+                self.fast.write('VA%.6f\r\n' %previous)
+            self._stop.set()
+        return self.crossings
+
+    async def _scan_line(self, number: int, line: ScanLine) -> None:
+        fast = self.fast
+        finished = False
+        try:
+            moves = {fast: (move_command(to_nm(line.start)), line.start), self.slow: (move_command(to_nm(line.slow)), line.slow)}
+            result = await move_together(moves, self.tolerance, SETTLE_TIMEOUT)
+            if not result.done:
+                raise ConexError("Start of line %s not reached" %(number + 1))
+            forward = line.end >= line.start
+            triggers = line.triggers
+            index = 0
+            fast.send(move_command(to_nm(line.end)))
+            deadline = time.monotonic() + LINE_TIMEOUT
+            while not self._stop.is_set():
+                position = await fast.position()
+                now = fast.arrived['TP']
+                self.samples += 1
+                if position != position:
+                    raise ConexError("%s - Axis replied no position in line %s" %(fast.name, number + 1))
+                while index < len(triggers) and (position >= triggers[index] if forward else position <= triggers[index]):
+                    crossing = Crossing(number, index, triggers[index], position, now)
+                    self.crossings.append(crossing)
+                    if self.callback is not None:
+                        self.callback(crossing)
+                    index += 1
+                if abs(position - line.end) <= self.tolerance and await fast.is_ready():
+                    finished = True
+                    break
+                if time.monotonic() > deadline:
+                    raise ConexError("End of line %s not reached" %(number + 1))
+        finally:
+            if not finished:
+                #stopped, failed or cancelled, halt the fast axis where it is
+                try:
+                    fast.write('ST\r\n')
+                except ConexError:
+                    pass
+
+
+#Write crossings as CSV: line, trigger, trigger position, position read back (in mm), time (in s since the first)
+def write_crossings(file, crossings: Sequence[Crossing]) -> None:
+    file.write("line;site;trigger;position;time\n")
+    start = crossings[0].time if crossings else 0
+    for crossing in crossings:
+        file.write("%s;%s;%.6f;%.6f;%.6f\n" %(crossing.line + 1, crossing.index + 1, crossing.trigger, crossing.position,
+                                              (crossing.time - start) / 1000000000))
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from conex import Controller, SerialReader
+from emulator import ConexEmulator, EmulatedAxis
+from motion import AxisModel
+
+
+#Fast stage, so moves of a few mm take some 10 ms
+FAST_MOTION = AxisModel(velocity=50.0, acceleration=1000.0, settle=0.005)
+
+
+def run(coro, timeout: float = 30):
+    return asyncio.run(asyncio.wait_for(coro, timeout))
+
+
+class PtyPort(object):
+    """Just enough of serial.Serial on a pseudo terminal, for ports the tests open themselves."""
+
+    def __init__(self, path=None, baudrate=None):
+        self.port = path
+        self.baudrate = baudrate
+        self.is_open = False
+        self.fd = None
+        if path is not None:
+            self.open()
+
+    def open(self):
+        self.fd = os.open(self.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        self.is_open = True
+
+    def fileno(self):
+        return self.fd
+
+    @property
+    def in_waiting(self):
+        return 0
+
+    def read(self, size=1):
+        try:
+            return os.read(self.fd, max(size, 4096))
+        except BlockingIOError:
+            return b''
+
+    def write(self, data):
+        return os.write(self.fd, data)
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            os.close(self.fd)
+
+
+#Controllers by name for the emulators by name, homed and read by one SerialReader
+async def connected_axes(emulators):
+    controls = {}
+    ports = []
+    reader = SerialReader()
+    for name, emulated in emulators.items():
+        port = PtyPort(emulated.path)
+        ports.append(port)
+        control = controls[name] = Controller(port, name)
+        reader.add(name, port, control.feed)
+        control.write('OR\r\n')
+    await asyncio.sleep(0.1)
+    return controls, reader, ports
+
+
+@pytest.fixture
+def emulator():
+    emulators = []
+
+    def start(addresses=(1,), motion=FAST_MOTION, **options) -> ConexEmulator:
+        emulated = ConexEmulator({address: EmulatedAxis(motion) for address in addresses}, **options).start()
+        emulators.append(emulated)
+        return emulated
+
+    yield start
+    for emulated in emulators:
+        emulated.close()
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('serial')
+
+from axis import Axis, AxisRegistry, Link
+from conex import ConexError
+from conftest import PtyPort, run
+
+
+def test_link_routes_replies_by_address(emulator):
+    emulated = emulator(addresses=(1, 2))
+    link = Link('chain', PtyPort())
+    replies = []
+    axes = AxisRegistry([Axis(name, link=link, address=address, on_reply=lambda axis, reply: replies.append((axis.name, reply)))
+                         for name, address in (('x', 1), ('y', 2))])
+
+    async def main():
+        axes['x'].open(emulated.path, 921600)
+        axes['y'].open(emulated.path, 921600)
+        with pytest.raises(ConexError):
+            link.open('/dev/null', 921600)
+        for axis in axes:
+            axis.write('OR\r\n')
+        await asyncio.sleep(0.1)
+        axes['x'].write('PA1.5\r\n')
+        axes['y'].write('PA2.5\r\n')
+        await asyncio.sleep(0.2)
+        return await asyncio.gather(axes['x'].control.query('PA?'), axes['y'].control.query('PA?'))
+
+    x, y = run(main())
+    assert (x.address, x.value) == (1, 1.5)
+    assert (y.address, y.value) == (2, 2.5)
+    assert (axes['x'].position, axes['y'].position) == (1500000, 2500000)
+    assert {name for name, reply in replies} == {'x', 'y'}
+    assert link.unrouted == 0
+    #the shared port stays open until the last axis is closed
+    axes['x'].close()
+    assert link.port.is_open and axes['y'].is_open
+    axes['y'].close()
+    assert not link.port.is_open
+
+
+def test_addresses_on_a_link_are_unique():
+    link = Link('chain', PtyPort())
+    Axis('x', link=link, address=1)
+    with pytest.raises(ValueError):
+        Axis('y', link=link, address=1)
+    with pytest.raises(ValueError):
+        Axis('z', link=link)
+
+
+def test_axes_connect_side_by_side(emulator):
+    slow, slower = emulator(), emulator()
+    slow.stall(0.3)
+    slower.stall(0.6)
+    axes = AxisRegistry([Axis('x', PtyPort()), Axis('y', PtyPort())])
+
+    async def main():
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        await asyncio.gather(axes['x'].connect(slow.path, 921600, 3), axes['y'].connect(slower.path, 921600, 3))
+        return loop.time() - started
+
+    try:
+        assert run(main()) < 0.9
+        assert axes.all_open()
+    finally:
+        axes.close()
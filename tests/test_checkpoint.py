@@ -0,0 +1,53 @@
+import os
+
+from checkpoint import RECORD_SIZE, Checkpoint
+
+
+def recorded(tmp_path, steps=3):
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    checkpoint.start(b'h' * 32, 2)
+    for index in range(steps):
+        checkpoint.record(1, index, (index, 4))
+    checkpoint.close()
+    return checkpoint
+
+
+def corrupt(path, offset):
+    with open(path, 'r+b') as file:
+        file.seek(offset)
+        byte = file.read(1)
+        file.seek(offset)
+        file.write(bytes([byte[0] ^ 0xff]))
+
+
+def test_latest_record_is_read(tmp_path):
+    record = recorded(tmp_path).read()
+    assert (record.sequence, record.repetition, record.index, record.iterations) == (3, 1, 2, (2, 4))
+    assert record.hash == b'h' * 32
+
+
+def test_corrupt_slot_falls_back_to_the_previous_record(tmp_path):
+    checkpoint = recorded(tmp_path)
+    #record 3 went to the second slot
+    corrupt(checkpoint.path, RECORD_SIZE + 20)
+    record = checkpoint.read()
+    assert (record.sequence, record.index) == (2, 1)
+    corrupt(checkpoint.path, 20)
+    assert checkpoint.read() is None
+
+
+def test_torn_write_falls_back_to_the_previous_record(tmp_path):
+    checkpoint = recorded(tmp_path)
+    os.truncate(checkpoint.path, RECORD_SIZE + RECORD_SIZE // 2)
+    assert checkpoint.read().sequence == 2
+
+
+def test_finish_removes_the_checkpoint_unless_kept(tmp_path):
+    checkpoint = recorded(tmp_path)
+    checkpoint.start(b'h' * 32)
+    checkpoint.record(0, 0)
+    checkpoint.finish(keep=True)
+    assert checkpoint.read().index == 0
+    checkpoint.finish()
+    assert not os.path.exists(checkpoint.path)
+    assert checkpoint.read() is None
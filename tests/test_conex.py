@@ -0,0 +1,121 @@
+import asyncio
+import math
+
+import pytest
+
+from conex import Controller, QueueFull, QueryTimeout, ReplyParser, SerialReader, WriteQueue, parse_reply, probe, wait_ready
+from conftest import PtyPort, run
+
+
+class ListPort(object):
+    """Port without a file descriptor that keeps everything written to it."""
+
+    is_open = True
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+
+def test_parse_reply():
+    reply = parse_reply(b'1PA12.500000\r\n')
+    assert (reply.address, reply.mnemonic, reply.value) == (1, 'PA', 12.5)
+    state = parse_reply(b'2TS000033')
+    assert (state.address, state.mnemonic, state.text) == (2, 'TS', '33')
+    assert parse_reply(b'1VE CONEX-AGP 1.0').text.strip() == 'CONEX-AGP 1.0'
+    assert math.isnan(parse_reply(b'1TPxyz').value)
+
+
+def test_parser_frames_split_chunks():
+    parser = ReplyParser()
+    data = b'1TP1.000000\r\n2TP2.000000\r\n1TS000033\r\n'
+    replies = []
+    for i in range(0, len(data), 5):
+        replies.extend(parser.feed(data[i:i + 5]))
+    assert [(reply.address, reply.mnemonic) for reply in replies] == [(1, 'TP'), (2, 'TP'), (1, 'TS')]
+    assert replies[1].value == 2.0
+    assert not parser.buffer
+
+
+def test_write_queue_takes_turns_between_keys():
+    async def main():
+        port = ListPort()
+        queue = WriteQueue(port, 'chain', rate=1000, burst=1)
+        for i in range(3):
+            queue.put(b'a%d' %i, key='a')
+        for i in range(2):
+            queue.put(b'b%d' %i, key='b')
+        while len(queue):
+            await asyncio.sleep(0.01)
+        return port.written
+
+    assert run(main()) == [b'a0', b'a1', b'b0', b'a2', b'b1']
+
+
+def test_write_queue_depth_and_clear_per_key():
+    async def main():
+        port = ListPort()
+        queue = WriteQueue(port, 'chain', rate=1000, burst=1)
+        queue.put(b'first', key='a')
+        queue.put(b'a', key='a')
+        with pytest.raises(QueueFull):
+            queue.put(b'jog', depth=1, key='a')
+        queue.put(b'jog', depth=1, key='b')
+        queue.clear('a')
+        assert len(queue) == 1
+        while len(queue):
+            await asyncio.sleep(0.01)
+        return port.written
+
+    assert run(main()) == [b'first', b'jog']
+
+
+def connect(path, name='x', address=None):
+    port = PtyPort(path)
+    control = Controller(port, name, address=address)
+    reader = SerialReader()
+    reader.add(name, port, control.feed)
+    return port, reader, control
+
+
+def test_controller_queries_the_emulator(emulator):
+    emulated = emulator()
+
+    async def main():
+        port, reader, control = connect(emulated.path)
+        try:
+            assert 'Emulator' in (await probe(control)).text
+            control.write('OR\r\n')
+            assert await wait_ready(control, 5)
+            control.write('PA1.25\r\n')
+            assert await wait_ready(control, 5)
+            assert await control.position() == 1.25
+        finally:
+            reader.remove('x')
+            port.close()
+
+    run(main())
+
+
+def test_probe_waits_for_a_starting_controller(emulator):
+    emulated = emulator()
+    emulated.stall(0.5)
+
+    async def main():
+        port, reader, control = connect(emulated.path)
+        try:
+            loop = asyncio.get_event_loop()
+            started = loop.time()
+            await probe(control, 3)
+            assert loop.time() - started >= 0.4
+            emulated.stall(10)
+            with pytest.raises(QueryTimeout):
+                await probe(control, 0.5)
+        finally:
+            reader.remove('x')
+            port.close()
+
+    run(main())
@@ -0,0 +1,190 @@
+import asyncio
+import time
+
+from checkpoint import Checkpoint, MAX_DEPTH
+from conex import Controller
+from conftest import PtyPort, connected_axes, run
+from engine import ProgressBus, RoutineEngine, RoutineListener, Scheduler
+from motion import AxisModel
+from routine import DELAY, END, LOOP, MOVE, NO_POSITION, RoutineStore, Step, to_nm
+
+
+class Recorder(RoutineListener):
+    def __init__(self):
+        self.steps = []
+        self.times = []
+        self.messages = []
+        self.late = []
+        self.finished = None
+        self.finished_at = None
+
+    def step_started(self, repetition, index):
+        self.steps.append((repetition, index))
+        self.times.append(time.monotonic())
+
+    def step_late(self, repetition, index, late):
+        self.late.append(index)
+
+    def message(self, text):
+        self.messages.append(text)
+
+    def routine_finished(self, completed):
+        self.finished = completed
+        self.finished_at = time.monotonic()
+
+
+def move(x, y, name='P'):
+    return Step(name, MOVE, to_nm(x), to_nm(y), 0)
+
+
+def delay(t):
+    return Step('d', DELAY, NO_POSITION, NO_POSITION, t)
+
+
+def end_step():
+    return Step('end', END, NO_POSITION, NO_POSITION, 0)
+
+
+def compile_steps(steps, repetitions=1):
+    store = RoutineStore()
+    store.extend(steps)
+    return store.compile(repetitions)
+
+
+def test_engine_drives_two_emulated_axes(emulator):
+    emulators = {'x': emulator(), 'y': emulator()}
+    routine = compile_steps([move(1, 2), Step('loop', LOOP, NO_POSITION, NO_POSITION, 2), move(3, 1), delay(5), end_step(),
+                             move(2.5, 0.5)], 2)
+    listener = Recorder()
+
+    async def main():
+        controls, reader, ports = await connected_axes(emulators)
+        try:
+            completed = await RoutineEngine(controls, listener).run(routine)
+            return completed, await controls['x'].position(), await controls['y'].position()
+        finally:
+            for name, port in zip(controls, ports):
+                reader.remove(name)
+                port.close()
+
+    completed, x, y = run(main())
+    assert completed and listener.finished
+    assert (x, y) == (2.5, 0.5)
+    assert listener.steps == [(repetition, index) for repetition in range(2) for index in (0, 2, 3, 2, 3, 5)]
+    assert not listener.messages
+
+
+def test_overrun_is_reported_and_the_schedule_continues_from_then():
+    scheduler = Scheduler(late_after=1)
+    scheduler.start()
+    scheduler.plan(5)
+    time.sleep(0.03)
+    assert scheduler.reanchor() > 20
+    assert scheduler.late_steps == 1
+    assert scheduler.begin() == 0
+    #settling early lets the schedule continue from then as well
+    scheduler.plan(10000)
+    assert scheduler.reanchor() == 0
+    assert scheduler.next <= time.monotonic_ns()
+
+
+def test_delays_are_not_cut_to_catch_up():
+    scheduler = Scheduler()
+    scheduler.start()
+    scheduler.plan(0)
+    time.sleep(0.05)
+    deadline = scheduler.plan_delay(100)
+    assert deadline - time.monotonic_ns() > 95000000
+
+
+class Quick(object):
+    """Motion model that expects every move to be done in 10 ms."""
+
+    def move_time(self, dx, dy):
+        return 0.01
+
+
+def test_slow_move_followed_by_a_delay(emulator):
+    slow = AxisModel(velocity=4.0, acceleration=100.0, settle=0.005)
+    emulators = {'x': emulator(motion=slow), 'y': emulator(motion=slow)}
+    store = RoutineStore()
+    store.extend([move(0, 0), move(1, 1), delay(300)])
+    routine = store.compile(1, Quick())
+    listener = Recorder()
+
+    async def main():
+        controls, reader, ports = await connected_axes(emulators)
+        try:
+            return await RoutineEngine(controls, listener).run(routine)
+        finally:
+            for name, port in zip(controls, ports):
+                reader.remove(name)
+                port.close()
+
+    assert run(main())
+    #the move overran its 10 ms and is reported late, the delay still lasts its full 300 ms
+    assert listener.late == [1]
+    assert listener.finished_at - listener.times[2] >= 0.3
+
+
+class Snapshots(RoutineListener):
+    def __init__(self):
+        self.snapshots = []
+        self.finished_after = None
+
+    def progress(self, snapshot):
+        self.snapshots.append(snapshot)
+
+    def routine_finished(self, completed):
+        self.finished_after = len(self.snapshots)
+
+
+def test_progress_bus_coalesces_steps_and_flushes_at_the_end():
+    routine = compile_steps([delay(1)] * 1000)
+    consumer = Snapshots()
+    bus = ProgressBus(consumer, rate=2)
+
+    async def main():
+        bus.routine_started(routine)
+        for index in range(1000):
+            bus.step_started(0, index)
+            bus.step_finished(0, index)
+        #the first snapshot is due right away, everything after it waits for the interval
+        await asyncio.sleep(0.01)
+        for index in range(1000):
+            bus.step_started(1, index)
+        bus.routine_finished(True)
+
+    run(main())
+    assert bus.events == 3000
+    assert bus.snapshots == len(consumer.snapshots) == 2
+    assert bus.coalesced == 2998
+    #the pending state is delivered before the end
+    assert consumer.finished_after == 2
+    last = consumer.snapshots[-1]
+    assert (last.repetition, last.index) == (1, 999)
+    assert sum(snapshot.events for snapshot in consumer.snapshots) == 3000
+
+
+def test_unconnected_axis_aborts_and_keeps_the_checkpoint(tmp_path):
+    port = PtyPort()
+    controls = {'x': Controller(port, 'x'), 'y': Controller(port, 'y')}
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    listener = Recorder()
+    routine = compile_steps([delay(1), move(1, 1), move(2, 2)])
+    assert not run(RoutineEngine(controls, listener, checkpoint=checkpoint).run(routine))
+    assert listener.finished is False
+    assert listener.steps == [(0, 0), (0, 1)]
+    assert 'not connected' in listener.messages[-1]
+    assert checkpoint.read().index == 1
+
+
+def test_too_deeply_nested_loops_run_without_checkpoint(tmp_path):
+    depth = MAX_DEPTH + 1
+    loops = [Step('loop', LOOP, NO_POSITION, NO_POSITION, 1)] * depth
+    routine = compile_steps(loops + [delay(0)] + [end_step()] * depth)
+    checkpoint = Checkpoint(str(tmp_path / 'checkpoint'))
+    listener = Recorder()
+    assert run(RoutineEngine({}, listener, checkpoint=checkpoint).run(routine))
+    assert 'Progress is not saved' in listener.messages[0]
+    assert checkpoint.read() is None
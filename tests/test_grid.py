@@ -0,0 +1,35 @@
+import pytest
+
+from grid import Grid, parse_mask
+from routine import DELAY, MOVE, to_nm
+
+
+def test_serpentine_order():
+    grid = Grid.from_corners((1, 1), (3, 1), (1, 2), 3, 2)
+    x, y, columns, rows = grid.sites(True)
+    assert list(zip(columns, rows)) == [(0, 0), (1, 0), (2, 0), (2, 1), (1, 1), (0, 1)]
+    assert list(x) == [1, 2, 3, 3, 2, 1]
+    assert list(y) == [1, 1, 1, 2, 2, 2]
+    x, y, columns, rows = grid.sites(False)
+    assert list(zip(columns, rows)) == [(0, 0), (1, 0), (2, 0), (0, 1), (1, 1), (2, 1)]
+
+
+def test_masked_sites_are_skipped():
+    grid = Grid.from_corners((0, 0), (2, 0), (0, 2), 3, 3)
+    mask = parse_mask("2,1; 3,2\n1,3")
+    assert mask == [(1, 0), (2, 1), (0, 2)]
+    x, y, columns, rows = grid.sites(True, mask)
+    assert list(zip(columns, rows)) == [(0, 0), (2, 0), (1, 1), (0, 1), (1, 2), (2, 2)]
+    assert (x[2], y[2]) == grid.site(1, 1)
+
+
+def test_routine_with_dwell():
+    names, kind, x, y, t = Grid.from_corners((1, 1), (2, 1), (1, 1), 2, 1).routine(dwell=500)
+    assert list(kind) == [MOVE, DELAY, MOVE, DELAY]
+    assert list(x[::2]) == [to_nm(1), to_nm(2)]
+    assert names[0] == "Site 1/1" and t[1] == 500
+
+
+def test_empty_grid_is_rejected():
+    with pytest.raises(ValueError):
+        Grid((0, 0), (1, 0), (0, 1), 0, 3)
@@ -0,0 +1,28 @@
+import pytest
+
+from motion import CALIBRATION_DISTANCES, AxisModel, MotionModel, dump_axis, fit_axis, load_axis
+
+
+def test_fit_recovers_the_model_of_its_samples():
+    stage = AxisModel(velocity=0.4, acceleration=1.6, settle=0.02)
+    model = fit_axis([(distance, stage.move_time(distance)) for distance in CALIBRATION_DISTANCES])
+    assert model.velocity == pytest.approx(stage.velocity, rel=0.02)
+    assert model.acceleration == pytest.approx(stage.acceleration, rel=0.05)
+    assert model.settle == pytest.approx(stage.settle, abs=0.002)
+    for distance in (0.002, 0.3, 3, 20):
+        assert model.move_time(distance) == pytest.approx(stage.move_time(distance), rel=0.02)
+
+
+def test_fit_needs_samples():
+    with pytest.raises(ValueError):
+        fit_axis([])
+
+
+def test_slower_axis_counts_and_models_are_persisted():
+    fast = AxisModel(velocity=2.0, acceleration=10.0, settle=0.01)
+    slow = AxisModel(velocity=0.5, acceleration=10.0, settle=0.01)
+    motion = MotionModel(fast, slow)
+    assert motion.move_time(1, 1) == slow.move_time(1)
+    assert motion.move_time(-5, 0) == fast.move_time(5)
+    assert load_axis(dump_axis(slow)).to_dict() == slow.to_dict()
+    assert load_axis('') is None and load_axis('not json') is None
@@ -0,0 +1,46 @@
+import random
+from array import array
+
+from motion import AxisModel, MotionModel
+from optimize import optimize_order, segments
+from routine import DELAY, MOVE, NO_POSITION
+
+
+def scattered(count, seed=1):
+    rng = random.Random(seed)
+    kind = array('b', [MOVE] * count)
+    x = array('q', [rng.randrange(48000000) for _ in range(count)])
+    y = array('q', [rng.randrange(48000000) for _ in range(count)])
+    return kind, x, y
+
+
+def test_order_is_a_permutation_and_shorter():
+    kind, x, y = scattered(300)
+    ordering = optimize_order(kind, x, y, workers=1)
+    assert sorted(ordering.order) == list(range(300))
+    assert ordering.order[0] == 0
+    assert ordering.changed and ordering.saved > 0
+
+
+def test_anchors_and_moves_before_delays_stay_in_place():
+    kind, x, y = scattered(40)
+    for row in (10, 25):
+        kind[row] = DELAY
+        x[row] = y[row] = NO_POSITION
+    anchors = [5, 33]
+    ordering = optimize_order(kind, x, y, anchors, workers=1)
+    assert sorted(ordering.order) == list(range(40))
+    #the delays, the moves they wait at and the anchors
+    for row in (9, 10, 24, 25) + tuple(anchors):
+        assert ordering.order[row] == row
+    #moves are only reordered within their segment, never across a delay or an anchor
+    for first, end in segments(kind, x, y, anchors):
+        assert sorted(ordering.order[first:end]) == list(range(first, end))
+
+
+def test_motion_model_minimizes_time():
+    kind, x, y = scattered(100)
+    axis = AxisModel(velocity=2.0, acceleration=20.0, settle=0.01)
+    ordering = optimize_order(kind, x, y, workers=1, motion=MotionModel(axis, axis))
+    assert sorted(ordering.order) == list(range(100))
+    assert ordering.saved_time > 0
@@ -0,0 +1,88 @@
+from array import array
+
+import pytest
+
+from routine import (DELAY, END, LOOP, MOVE, NO_POSITION, MappedRoutine, Routine, RoutineFormatError, RoutineStore, Step,
+                     from_nm, mm_text, to_nm, write_binary_routine)
+
+
+def delay(t, name='d'):
+    return Step(name, DELAY, NO_POSITION, NO_POSITION, t)
+
+
+def loop(count):
+    return Step('loop', LOOP, NO_POSITION, NO_POSITION, count)
+
+
+def end():
+    return Step('end', END, NO_POSITION, NO_POSITION, 0)
+
+
+def test_nm_round_trip():
+    for mm in (0.0, 23.868719, 47.999999, 0.000001):
+        assert from_nm(to_nm(mm)) == mm
+        assert float(mm_text(to_nm(mm))) == mm
+    assert to_nm(float('nan')) == NO_POSITION
+
+
+def test_nested_loop_timeline():
+    routine = Routine([delay(1), loop(3), delay(10), loop(2), delay(100), end(), end(), delay(1000)], 2)
+    timeline = routine.compile().timeline
+    assert timeline.depth == 2
+    assert timeline.cycle == 1 + 3 * (10 + 2 * 100) + 1000
+    assert timeline.total == 2 * timeline.cycle
+    #second iteration of the outer loop, first of the inner one
+    assert timeline.start_of(0, 4, (1, 0)) == 1 + 210 + 10
+    assert timeline.locate(1 + 210 + 10 + 50) == (0, 4, (1, 0))
+    assert timeline.locate(timeline.cycle + 1 + 0.5) == (1, 2, (0,))
+
+
+@pytest.mark.parametrize('count', [2.7, -3, 0])
+def test_total_time_counts_loops_like_the_engine(count):
+    routine = Routine([loop(count), delay(10), end(), delay(5)], 3)
+    assert routine.total_time() == routine.compile().timeline.total
+
+
+def test_unbalanced_loops_are_rejected():
+    with pytest.raises(RoutineFormatError):
+        Routine([loop(2), delay(1)]).compile()
+    with pytest.raises(RoutineFormatError):
+        Routine([delay(1), end()]).compile()
+
+
+def store_of(count):
+    store = RoutineStore()
+    store.extend_columns(['P%s' %i for i in range(count)], array('b', [MOVE, DELAY] * (count // 2)),
+                         array('q', [i * 1000 if i % 2 == 0 else NO_POSITION for i in range(count)]),
+                         array('q', [i * 7 if i % 2 == 0 else NO_POSITION for i in range(count)]),
+                         array('d', [0.0, 2.5] * (count // 2)))
+    return store
+
+
+@pytest.mark.parametrize('delta', [False, True])
+def test_binary_round_trip(tmp_path, delta):
+    store = store_of(1000)
+    path = str(tmp_path / 'routine.acib')
+    with open(path, 'wb') as file:
+        write_binary_routine(file, store, 4, delta=delta)
+    with MappedRoutine(path) as routine:
+        assert routine.delta == delta
+        assert routine.repetitions == 4
+        assert list(routine) == list(store)
+
+
+def test_store_runs_from_the_mapping_until_edited(tmp_path):
+    store = store_of(100)
+    path = str(tmp_path / 'routine.acib')
+    with open(path, 'wb') as file:
+        write_binary_routine(file, store, 1)
+    mapped = RoutineStore()
+    mapped.use_mapped(MappedRoutine(path))
+    compiled = mapped.compile()
+    assert isinstance(compiled.positions['x'], memoryview)
+    assert list(mapped) == list(store)
+    mapped.rename(0, 'first')
+    assert mapped.mapped is None
+    assert mapped[0].name == 'first'
+    assert compiled.names[0] == 'P0'
+    assert list(mapped)[1:] == list(store)[1:]
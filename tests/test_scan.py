@@ -0,0 +1,56 @@
+import pytest
+
+from conex import ConexError
+from conftest import connected_axes, run
+from grid import Grid
+from motion import STAGE_MAX, STAGE_MIN
+from scan import LineScanner, grid_lines
+
+
+def test_run_up_stays_inside_the_stage_travel():
+    lines = grid_lines(Grid.from_corners((0, 1), (STAGE_MAX, 1), (0, 2), 3, 2), True, (), 0.05)
+    assert [(line.start, line.end) for line in lines] == [(STAGE_MIN, STAGE_MAX), (STAGE_MAX, STAGE_MIN)]
+    lines = grid_lines(Grid.from_corners((1, 1), (2, 1), (1, 2), 3, 1), True, (), 0.05)
+    assert (lines[0].start, lines[0].end) == (0.95, 2.05)
+
+
+def test_sites_outside_the_stage_travel_are_rejected():
+    with pytest.raises(ValueError):
+        grid_lines(Grid.from_corners((1, 1), (STAGE_MAX + 1, 1), (1, 2), 3, 1))
+
+
+def test_rows_may_drift_within_the_tolerance():
+    #corners read back from the stage are rarely exactly level
+    lines = grid_lines(Grid.from_corners((1, 1), (2, 1.00005), (1, 2), 3, 2))
+    assert [line.slow for line in lines] == pytest.approx([1, 2.00005])
+    with pytest.raises(ValueError):
+        grid_lines(Grid.from_corners((1, 1), (2, 1.001), (1, 2), 3, 2))
+
+
+class FailingScanner(LineScanner):
+    """Scanner whose second line fails like an axis that stopped replying."""
+
+    async def _scan_line(self, number, line):
+        if number == 1:
+            raise ConexError("Line %s failed" %(number + 1))
+        await super()._scan_line(number, line)
+
+
+def test_crossings_before_a_failed_line_are_kept(emulator):
+    emulators = {'x': emulator(), 'y': emulator()}
+    lines = grid_lines(Grid.from_corners((1, 1), (2, 1), (1, 2), 3, 2), True, (), 0.05)
+
+    async def main():
+        controls, reader, ports = await connected_axes(emulators)
+        scanner = FailingScanner(controls['x'], controls['y'])
+        try:
+            with pytest.raises(ConexError):
+                await scanner.run(lines)
+            return scanner.crossings
+        finally:
+            for name, port in zip(controls, ports):
+                reader.remove(name)
+                port.close()
+
+    crossings = run(main())
+    assert [(crossing.line, crossing.trigger) for crossing in crossings] == [(0, 1.0), (0, 1.5), (0, 2.0)]